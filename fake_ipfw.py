@@ -0,0 +1,95 @@
+#!/usr/bin/python
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# Fake ipfw executable for exercising um_firewall.py on a box without ipfw
+#
+# Point "ipfw_path" in um_firewall.conf to this script, every command
+# received is recorded, tables and rules are kept in a json state file
+# so that consecutive invocations behave like the kernel
+#
+#   FAKE_IPFW_LOG    file to append received commands, default /tmp/fake_ipfw.log
+#   FAKE_IPFW_STATE  json file keeping tables and rules, default /tmp/fake_ipfw.state
+#   FAKE_IPFW_DELAY  seconds to sleep per invocation, emulate fork/exec cost
+#   FAKE_IPFW_FAIL   regex, command matching it fails
+#
+# Tables and rules modelled by ipfw_sim.IPFWSimulator
+#
+# Same as ipfw, commands can be given on command line or within a file
+# given as the last absolute path argument, e.g. ipfw -q /dev/stdin
+# first failed line of a file stops processing with "Line N: ..." on stderr
+import json
+import os
+import re
+import sys
+import time
+
+from ipfw_sim import IPFWSimulator, IPFWSimError
+
+
+def load_state(path):
+    """
+    Load tables and rules from state file
+    """
+    try:
+        with open(path, 'r') as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    """
+    Save tables and rules to state file
+    """
+    with open(path, 'w') as state_file:
+        json.dump(state, state_file)
+
+
+def main(argv):
+    delay = float(os.environ.get("FAKE_IPFW_DELAY", "0"))
+    if delay:
+        time.sleep(delay)
+
+    log_path = os.environ.get("FAKE_IPFW_LOG", "/tmp/fake_ipfw.log")
+    state_path = os.environ.get("FAKE_IPFW_STATE", "/tmp/fake_ipfw.state")
+    fail_filter = None
+    if os.environ.get("FAKE_IPFW_FAIL"):
+        fail_filter = re.compile(os.environ["FAKE_IPFW_FAIL"])
+
+    args = [arg for arg in argv if arg not in ("-q", "-f", "-n")]
+    if args and args[-1].startswith('/'):
+        with open(args[-1], 'r') as cmd_file:
+            lines = [line.split() for line in cmd_file.read().splitlines()]
+        file_mode = True
+    else:
+        lines = [args]
+        file_mode = False
+
+    sim = IPFWSimulator(load_state(state_path))
+    out = []
+    status = 0
+    with open(log_path, 'a') as log_file:
+        for lineno, line in enumerate(lines, 1):
+            if not line or line[0].startswith('#'):
+                continue
+            log_file.write(" ".join(line) + "\n")
+            try:
+                if fail_filter and fail_filter.search(" ".join(line)):
+                    raise IPFWSimError("injected failure")
+                out.extend(sim.run(line))
+            except IPFWSimError as e:
+                prefix = "Line {num}".format(num=lineno) if file_mode else "ipfw"
+                sys.stderr.write("{prefix}: {msg}\n".format(prefix=prefix, msg=e))
+                status = 71
+                break
+
+    save_state(state_path, sim.state())
+    if out:
+        sys.stdout.write("\n".join(out) + "\n")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# Static ruleset compiler of Umbrella Firewall
+#
+# Builds the static rules and tables of ipfw.sh from the declarative
+# description conf/ipfw_rules.conf into one ipfw command file, loaded
+# by a single "ipfw -q FILE" without leaving the box unprotected
+#
+#   rules      built in disabled staging set, then "set swap" with the
+#              active static set, old rules deleted after the swap
+#   tables     static tables built in a staging table and "table swap"ped,
+#              dynamic tables (managed by um_firewall.py) created if
+#              missing and seeded, never flushed or destroyed
+#   strict host rules and t*** tables of um_firewall.py live in set 0,
+#   untouched by reload
+#
+#   python ipfw_rules.py [--var pif=ext0 ...] [--output FILE] [--kernel] [--load] [--flush] [--ipfw PATH] conf/ipfw_rules.conf
+#
+# --flush removes all rules first, boot or first switch from rules added
+# by the old ipfw.sh into set 0, --load runs ipfw on the compiled file
+import argparse
+import ipaddress
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+
+class IPFWRulesetError(Exception):
+    pass
+
+
+def normalize_entry(entry):
+    """
+    Normalize table entry the way ipfw lists it, e.g. 10.0.0.1/32
+    """
+    try:
+        return ipaddress.ip_network(entry, strict=False).with_prefixlen
+    except ValueError:
+        raise IPFWRulesetError("invalid table entry {entry}".format(entry=entry))
+
+
+def parse_table_list(data):
+    """
+    Parse "ipfw table all list" output into {table: set(entry)}
+    """
+    tables = {}
+    tbl_filter = re.compile(r"^--- table\(([^)]+)\), set\(\d+\) ---$")
+    entries = None
+    for line in data.splitlines():
+        tbl_match = tbl_filter.match(line.strip())
+        if tbl_match:
+            entries = tables.setdefault(tbl_match.group(1), set())
+        elif entries is not None and line.strip():
+            entries.add(normalize_entry(line.split()[0]))
+    return tables
+
+
+# IPFWRuleset declarative static ruleset
+#   vars       derived variables, may refer to other variables, e.g. "skip"
+#   commands   run before rules, e.g. "nat 10 config if $pif log"
+#   tables     {name: {"type", "valtype", "dynamic", "entries"}}, entry
+#              expanding to comma separated list gives one entry per item
+#   rules      "NUMBER body", $name replaced by variable value
+#   static_set/staging_set  rule sets swapped on reload, set 0 left to
+#              rules added by um_firewall.py
+class IPFWRuleset:
+    def __init__(self, description, variables=None):
+        """
+        IPFW ruleset initialization
+        """
+        self.variables = dict(description.get("vars", {}))
+        self.variables.update(variables or {})
+        self.commands = description.get("commands", [])
+        self.tables = description.get("tables", {})
+        self.rules = description.get("rules", [])
+        self.static_set = description.get("static_set", 1)
+        self.staging_set = description.get("staging_set", 2)
+        self.var_filter = re.compile(r"\$(\w+)")
+        if self.static_set == 0 or self.staging_set in (0, self.static_set):
+            raise IPFWRulesetError("static_set and staging_set must differ and not be set 0")
+
+    def expand(self, text, seen=()):
+        """
+        Replace $name with variable value, recursively
+        """
+        def replace(var_match):
+            name = var_match.group(1)
+            if name in seen:
+                raise IPFWRulesetError("variable {name} refers to itself".format(name=name))
+            if name not in self.variables:
+                raise IPFWRulesetError("variable {name} not defined".format(name=name))
+            return self.expand(str(self.variables[name]), seen + (name,))
+        return self.var_filter.sub(replace, text)
+
+    def table_entries(self, tbl):
+        """
+        Expanded and normalized entries of table, duplicates dropped
+        """
+        entries = []
+        for entry in self.tables[tbl].get("entries", []):
+            for item in self.expand(entry).split(","):
+                item = item.strip()
+                if item and normalize_entry(item) not in entries:
+                    entries.append(normalize_entry(item))
+        return entries
+
+    def create_command(self, tbl, name=None):
+        """
+        Create command of table under its own or staging name, not failing on existing table of same type
+        """
+        spec = self.tables[tbl]
+        command = "table {table} create type {type}".format(table=name or tbl, type=spec.get("type", "addr"))
+        if spec.get("valtype"):
+            command += " valtype {valtype}".format(valtype=spec["valtype"])
+        return command + " missing"
+
+    def compile(self, kernel_tables=None, flush=False):
+        """
+        Return ipfw command lines reloading static ruleset
+        kernel_tables {table: set(entry)} from kernel, seeds already in dynamic tables skipped
+        """
+        kernel_tables = kernel_tables or {}
+        lines = []
+        if flush:
+            lines.append("flush")
+        for command in self.commands:
+            lines.append(self.expand(command))
+
+        for tbl, spec in self.tables.items():
+            lines.append(self.create_command(tbl))
+            entries = self.table_entries(tbl)
+            if spec.get("dynamic"):
+                # Learned entries stay, only missing seeds added
+                present = kernel_tables.get(tbl, set())
+                for entry in entries:
+                    if entry not in present:
+                        lines.append("table {table} add {entry}".format(table=tbl, entry=entry))
+                continue
+            staged = "{table}_next".format(table=tbl)
+            lines.append(self.create_command(tbl, staged))
+            lines.append("table {table} flush".format(table=staged))
+            for entry in entries:
+                lines.append("table {table} add {entry}".format(table=staged, entry=entry))
+            lines.append("table {table} swap {staged}".format(table=tbl, staged=staged))
+            lines.append("table {table} destroy".format(table=staged))
+
+        # Staged rules inactive until swapped with active static set
+        lines.append("set enable {static}".format(static=self.static_set))
+        lines.append("set disable {staging}".format(staging=self.staging_set))
+        lines.append("delete set {staging}".format(staging=self.staging_set))
+        for rule in self.rules:
+            rule = self.expand(rule).split(None, 1)
+            if len(rule) != 2 or not rule[0].isdigit() or not 0 < int(rule[0]) < 65535:
+                raise IPFWRulesetError("rule {rule} needs number and body".format(rule=" ".join(rule)))
+            lines.append("add {num:05d} set {staging} {body}".format(num=int(rule[0]), staging=self.staging_set,
+                                                                     body=" ".join(rule[1].split())))
+        lines.append("set swap {static} {staging}".format(static=self.static_set, staging=self.staging_set))
+        lines.append("delete set {staging}".format(staging=self.staging_set))
+        return lines
+
+
+def load_description(path):
+    """
+    Load ruleset description json
+    """
+    with open(path, 'r') as description_file:
+        return json.load(description_file)
+
+
+def kernel_table_list(ipfw_path):
+    """
+    Read tables currently in kernel, empty if ipfw not available
+    """
+    try:
+        proc = subprocess.run([ipfw_path, "table", "all", "list"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        return {}
+    return parse_table_list(proc.stdout.decode("utf-8", "replace"))
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Umbrella Firewall static ruleset compiler")
+    arg_parser.add_argument("description", help="ruleset description json")
+    arg_parser.add_argument("--var", action="append", default=[], help="name=value, overrides description vars")
+    arg_parser.add_argument("--output", help="command file, default stdout")
+    arg_parser.add_argument("--ipfw", default="ipfw")
+    arg_parser.add_argument("--kernel", action="store_true", help="skip seeds already in kernel, implied by --load")
+    arg_parser.add_argument("--load", action="store_true", help="load compiled ruleset with ipfw -q")
+    arg_parser.add_argument("--flush", action="store_true", help="remove all rules before loading")
+    args = arg_parser.parse_args(argv)
+
+    variables = {}
+    for var in args.var:
+        name, sep, value = var.partition("=")
+        variables[name] = value
+    try:
+        ruleset = IPFWRuleset(load_description(args.description), variables)
+        lines = ruleset.compile(kernel_table_list(args.ipfw) if args.load or args.kernel else None, args.flush)
+    except (OSError, ValueError, IPFWRulesetError) as e:
+        sys.stderr.write("ipfw_rules: {error}\n".format(error=e))
+        return 1
+
+    data = "\n".join(lines) + "\n"
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(data)
+    elif not args.load:
+        sys.stdout.write(data)
+    if not args.load:
+        return 0
+
+    command_path = args.output
+    if not command_path:
+        command_fd, command_path = tempfile.mkstemp(prefix="ipfw_rules.")
+        with os.fdopen(command_fd, 'w') as command_file:
+            command_file.write(data)
+    try:
+        return subprocess.run([args.ipfw, "-q", command_path]).returncode
+    except OSError as e:
+        sys.stderr.write("ipfw_rules: {error}\n".format(error=e))
+        return 1
+    finally:
+        if not args.output:
+            os.unlink(command_path)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,430 @@
+#!/usr/bin/python
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# In-memory model of FreeBSD ipfw for the simulated firewall backend
+# and fake_ipfw.py, no kernel, no FreeBSD required
+#
+# Models what um_firewall.py and ipfw.sh rely on
+#   tables with values, e.g. strict_hosts_list valtype skipto
+#   numbered rules, several rules under one number
+#   rule sets 0-30, disabled sets skipped and hidden from list without -S,
+#   set swap/move/enable/disable and delete set for atomic ruleset reload
+#   table swap, nat config and one_pass accepted as no-op
+#   packet classification over rules with address/table/port matching,
+#   skipto N and skipto tablearg taking the value of the matched table entry
+#
+# Errors raised as IPFWSimError with the message ipfw would print
+import ipaddress
+import re
+
+
+class IPFWSimError(Exception):
+    pass
+
+
+def normalize_addr(addr):
+    """
+    Normalize table key the way ipfw prints it
+    """
+    try:
+        return ipaddress.ip_network(addr, strict=False).with_prefixlen
+    except ValueError:
+        raise IPFWSimError("Invalid address: {addr}".format(addr=addr))
+
+
+# IPFWSimulator tables and rules of one simulated kernel
+# state() and IPFWSimulator(state) round trip through json
+class IPFWSimulator:
+    # Actions ending rule processing, nat/count/check-state continue with
+    # next rule as one_pass disabled in ipfw.sh
+    allow_actions = ("allow", "accept", "pass", "permit")
+    deny_actions = ("deny", "drop", "reject", "unreach", "unreach6", "abort")
+    # Match options without effect on simulated packet
+    ignored_options = ("keep-state", "record-state", "setup", "log")
+
+    def __init__(self, state=None, me=("127.0.0.1",)):
+        """
+        IPFW simulator initialization
+        """
+        state = state or {}
+        self.tables = state.get("tables", {})
+        self.table_types = state.get("table_types", {})
+        # Sorted [rule_num, body, packets, bytes, set]
+        self.rules = []
+        for rule in state.get("rules", []):
+            self.rules.append([rule[0], rule[1], rule[2] if len(rule) > 2 else 0, rule[3] if len(rule) > 3 else 0,
+                               rule[4] if len(rule) > 4 else 0])
+        self.disabled_sets = set(state.get("disabled_sets", []))
+        self.me = [ipaddress.ip_network(addr) for addr in me]
+        # Parsed rule bodies and prefix lengths present per table, for matching
+        self.parsed = {}
+        self.prefixlens = {}
+        self.tbl_filter = re.compile(r"^'?table\(([^,)]+)(?:,(\d+))?\)'?$")
+        self.range_filter = re.compile(r"^(.+)\{(\d+)-(\d+)\}$")
+
+    def state(self):
+        """
+        Return json serializable tables and rules
+        """
+        return {"tables": self.tables, "table_types": self.table_types, "rules": self.rules,
+                "disabled_sets": sorted(self.disabled_sets)}
+
+    def run(self, args):
+        """
+        Run one ipfw command given as argument list, return output lines
+        """
+        args = [arg for arg in args if arg not in ("-q", "-f", "-n")]
+        out = []
+        if not args:
+            return out
+        show_counters = False
+        show_sets = False
+        while args and args[0] in ("-a", "-S"):
+            show_counters = show_counters or args[0] == "-a"
+            show_sets = show_sets or args[0] == "-S"
+            args = args[1:]
+        if args[0] == "table":
+            self.run_table(args[1:], out)
+        elif args[0] == "set":
+            self.run_set(args[1:])
+        elif args[0] == "add":
+            if len(args) < 3 or not args[1].isdigit():
+                raise IPFWSimError("add needs rule number and body")
+            rule_set = 0
+            if args[2] == "set":
+                if len(args) < 5 or not args[3].isdigit() or int(args[3]) > 30:
+                    raise IPFWSimError("illegal set number")
+                rule_set = int(args[3])
+                args = args[:2] + args[4:]
+            self.rules.append([int(args[1]), " ".join(args[2:]), 0, 0, rule_set])
+            self.rules.sort(key=lambda rule: rule[0])
+        elif args[0] == "delete":
+            if len(args) > 2 and args[1] == "set":
+                self.rules = [rule for rule in self.rules if rule[4] != int(args[2])]
+                return out
+            nums = [int(num) for num in args[1:] if num.isdigit()]
+            remain = [rule for rule in self.rules if rule[0] not in nums]
+            if len(remain) == len(self.rules):
+                raise IPFWSimError("rule {nums} not found".format(nums=nums))
+            self.rules = remain
+        elif args[0] == "flush":
+            self.rules = []
+        elif args[0] in ("enable", "disable", "nat"):
+            # one_pass stays disabled, nat instances not modelled
+            pass
+        elif args[0] in ("list", "show"):
+            nums = [int(num) for num in args[1:] if num.isdigit()]
+            for num, body, packets, octets, rule_set in self.rules:
+                if nums and num not in nums:
+                    continue
+                if rule_set in self.disabled_sets and not show_sets:
+                    continue
+                if show_sets:
+                    body = "set {rule_set} {body}".format(rule_set=rule_set, body=body)
+                if show_counters or args[0] == "show":
+                    out.append("{num:05d} {packets} {octets} {body}".format(num=num, packets=packets, octets=octets, body=body))
+                else:
+                    out.append("{num:05d} {body}".format(num=num, body=body))
+        elif args[0] == "zero":
+            for rule in self.rules:
+                rule[2] = rule[3] = 0
+        else:
+            raise IPFWSimError("unknown command {cmd}".format(cmd=args[0]))
+        return out
+
+    def run_set(self, args):
+        """
+        ipfw set disable|enable N, set swap N M, set move N to M
+        """
+        if len(args) < 2:
+            raise IPFWSimError("set needs command and set number")
+        op = args[0]
+        nums = [int(num) for num in args[1:] if num.isdigit()]
+        if not nums or [num for num in nums if num > 30]:
+            raise IPFWSimError("invalid set number")
+        if op == "disable":
+            self.disabled_sets.update(nums)
+        elif op == "enable":
+            self.disabled_sets.difference_update(nums)
+        elif op == "swap" and len(nums) == 2:
+            for rule in self.rules:
+                if rule[4] in nums:
+                    rule[4] = nums[1] if rule[4] == nums[0] else nums[0]
+        elif op == "move" and len(nums) == 2 and "to" in args:
+            for rule in self.rules:
+                if rule[4] == nums[0]:
+                    rule[4] = nums[1]
+        else:
+            raise IPFWSimError("invalid set command {op}".format(op=op))
+
+    def run_table(self, args, out):
+        """
+        ipfw table NAME create|destroy|add|delete|flush|list
+        """
+        if len(args) < 2:
+            raise IPFWSimError("table needs name and command")
+        name, op = args[0], args[1]
+        tables = self.tables
+
+        if name == "all" and op == "list":
+            for tbl in sorted(tables):
+                self.run_table([tbl, "list"], out)
+            return
+        if op != "list":
+            self.prefixlens.pop(name, None)
+
+        if op == "create":
+            if name in tables:
+                if "missing" in args:
+                    return
+                raise IPFWSimError("Table creation failed: File exists")
+            tables[name] = {}
+            if "valtype" in args[2:-1]:
+                self.table_types[name] = args[args.index("valtype") + 1]
+        elif op == "destroy":
+            if name not in tables:
+                raise IPFWSimError("failed to destroy table({name}): No such process".format(name=name))
+            del tables[name]
+            self.table_types.pop(name, None)
+        elif op == "add":
+            if len(args) < 3:
+                raise IPFWSimError("table add needs address")
+            entries = tables.setdefault(name, {})
+            key = normalize_addr(args[2])
+            if key in entries:
+                raise IPFWSimError("Adding record failed: record already exists")
+            value = args[3] if len(args) > 3 else "0"
+            if value.isdigit():
+                value = str(int(value))
+            entries[key] = value
+        elif op in ("delete", "del"):
+            if len(args) < 3:
+                raise IPFWSimError("table delete needs address")
+            entries = tables.get(name)
+            key = normalize_addr(args[2])
+            if entries is None or key not in entries:
+                raise IPFWSimError("Deleting record failed: record not found")
+            del entries[key]
+        elif op == "swap":
+            if len(args) < 3 or name not in tables or args[2] not in tables:
+                raise IPFWSimError("Table swap failed: No such process")
+            if self.table_types.get(name) != self.table_types.get(args[2]):
+                raise IPFWSimError("Table swap failed: Invalid argument")
+            tables[name], tables[args[2]] = tables[args[2]], tables[name]
+            self.prefixlens.pop(args[2], None)
+        elif op == "flush":
+            if name not in tables:
+                raise IPFWSimError("Table {name} not found".format(name=name))
+            tables[name] = {}
+        elif op == "list":
+            if name not in tables:
+                raise IPFWSimError("Table {name} not found".format(name=name))
+            out.append("--- table({name}), set(0) ---".format(name=name))
+            for key, value in tables[name].items():
+                out.append("{key} {value}".format(key=key, value=value))
+        else:
+            raise IPFWSimError("invalid table command {op}".format(op=op))
+
+    def lookup(self, tbl, addr):
+        """
+        Longest prefix match of address in table, return value or None
+        """
+        entries = self.tables.get(tbl)
+        if not entries:
+            return None
+        prefixlens = self.prefixlens.get(tbl)
+        if prefixlens is None:
+            prefixlens = sorted(set(int(key.rsplit("/", 1)[1]) for key in entries), reverse=True)
+            self.prefixlens[tbl] = prefixlens
+        for prefixlen in prefixlens:
+            if prefixlen > addr.max_prefixlen:
+                continue
+            value = entries.get(ipaddress.ip_network((addr, prefixlen), strict=False).with_prefixlen)
+            if value is not None:
+                return value
+        return None
+
+    def parse_addr(self, spec):
+        """
+        Parse address spec into list of networks/table names, None for any
+        """
+        if spec == "any":
+            return None
+        matchers = []
+        for item in spec.split(","):
+            tbl_match = self.tbl_filter.match(item)
+            if tbl_match:
+                matchers.append(("table", tbl_match.group(1)))
+                continue
+            if item in ("me", "me6"):
+                matchers.append(("me", item))
+                continue
+            range_match = self.range_filter.match(item)
+            if range_match:
+                network = ipaddress.ip_network(range_match.group(1), strict=False)
+                base = int(network.network_address)
+                matchers.append(("range", (network.version, base + int(range_match.group(2)), base + int(range_match.group(3)))))
+                continue
+            matchers.append(("net", ipaddress.ip_network(item, strict=False)))
+        return matchers
+
+    def parse_ports(self, spec):
+        """
+        Parse port list "22,80,1000-2000" into list of (low, high), None if not ports
+        """
+        ports = []
+        for item in spec.split(","):
+            low, sep, high = item.partition("-")
+            if not low.isdigit() or (high and not high.isdigit()):
+                return None
+            ports.append((int(low), int(high or low)))
+        return ports
+
+    def parse_rule(self, body):
+        """
+        Parse rule body into (action, proto, src, dst, options), None if not understood
+        """
+        words = body.replace("'", "").split()
+        try:
+            if words[0] == "set":
+                words = words[2:]
+            action = [words.pop(0)]
+            if action[0] in ("skipto", "fwd", "nat", "unreach", "unreach6"):
+                action.append(words.pop(0))
+            while words and words[0] in ("log",):
+                words.pop(0)
+            proto = words.pop(0)
+            if words.pop(0) != "from":
+                return None
+            src_not = words[0] == "not"
+            if src_not:
+                words.pop(0)
+            src = self.parse_addr(words.pop(0))
+            src_ports = None
+            if words[0] != "to":
+                src_ports = self.parse_ports(words.pop(0))
+            if words.pop(0) != "to":
+                return None
+            dst_not = words[0] == "not"
+            if dst_not:
+                words.pop(0)
+            dst = self.parse_addr(words.pop(0))
+            dst_ports = None
+            if words and self.parse_ports(words[0]) is not None:
+                dst_ports = self.parse_ports(words.pop(0))
+        except (IndexError, ValueError):
+            return None
+
+        options = []
+        while words:
+            word = words.pop(0)
+            if word in self.ignored_options:
+                continue
+            if word in ("in", "out"):
+                options.append(("direction", word))
+            elif word in ("via", "recv", "xmit") and words:
+                options.append(("iface", words.pop(0)))
+            elif word == "dst-port" and words:
+                dst_ports = self.parse_ports(words.pop(0))
+            else:
+                # Option not modelled, rule never matches
+                options.append(("unknown", word))
+        return action, proto, (src_not, src, src_ports), (dst_not, dst, dst_ports), options
+
+    def match_addr(self, spec, addr, port):
+        """
+        Match address/port against parsed spec, return (matched, table value)
+        """
+        negate, matchers, ports = spec
+        matched = matchers is None
+        value = None
+        for kind, matcher in matchers or []:
+            if kind == "table":
+                value = self.lookup(matcher, addr)
+                matched = value is not None
+            elif kind == "me":
+                matched = any(addr in network for network in self.me if network.version == addr.version)
+            elif kind == "range":
+                matched = matcher[0] == addr.version and matcher[1] <= int(addr) <= matcher[2]
+            else:
+                matched = addr.version == matcher.version and addr in matcher
+            if matched:
+                break
+        if negate:
+            matched = not matched
+            value = None
+        if matched and ports is not None:
+            matched = port is not None and any(low <= port <= high for low, high in ports)
+        return matched, value
+
+    def match(self, src, dst, proto="ip", dport=None, iface=None, direction="in", size=64):
+        """
+        Classify packet over rules, return (rule_num, action) of final rule
+        skipto jumps to first rule numbered not less than target,
+        skipto tablearg takes target from table entry matched by the rule
+        """
+        src = ipaddress.ip_address(src)
+        dst = ipaddress.ip_address(dst)
+        idx = 0
+        while idx < len(self.rules):
+            rule = self.rules[idx]
+            idx += 1
+            if rule[4] in self.disabled_sets:
+                continue
+            parsed = self.parsed.get(rule[1])
+            if parsed is None:
+                parsed = self.parsed[rule[1]] = self.parse_rule(rule[1]) or False
+            if not parsed:
+                continue
+            action, rule_proto, src_spec, dst_spec, options = parsed
+
+            if rule_proto in ("ip", "all"):
+                pass
+            elif rule_proto == "ip4" or rule_proto == "ip6":
+                if (rule_proto == "ip6") != (src.version == 6):
+                    continue
+            elif rule_proto != proto:
+                continue
+            src_matched, src_value = self.match_addr(src_spec, src, None)
+            if not src_matched:
+                continue
+            dst_matched, dst_value = self.match_addr(dst_spec, dst, dport)
+            if not dst_matched:
+                continue
+            matched = True
+            for kind, option in options:
+                if kind == "direction":
+                    matched = option == direction
+                elif kind == "iface":
+                    matched = iface is None or option == iface
+                else:
+                    matched = False
+                if not matched:
+                    break
+            if not matched:
+                continue
+
+            rule[2] += 1
+            rule[3] += size
+            if action[0] == "skipto":
+                if action[1] == "tablearg":
+                    target = src_value if src_value is not None else dst_value
+                    if target is None or not target.isdigit():
+                        continue
+                    target = int(target)
+                else:
+                    target = int(action[1])
+                # skipto only jumps forward
+                while idx < len(self.rules) and self.rules[idx][0] < max(target, rule[0] + 1):
+                    idx += 1
+                continue
+            if action[0] in ("nat", "count", "check-state"):
+                continue
+            if action[0] in self.allow_actions:
+                return rule[0], "allow"
+            if action[0] in self.deny_actions:
+                return rule[0], "deny"
+            return rule[0], " ".join(action)
+        return 65535, "deny"
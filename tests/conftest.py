@@ -0,0 +1,10 @@
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# um_firewall.py and its helpers live next to each other at top level,
+# not as package, tests import them from there
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
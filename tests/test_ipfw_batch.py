@@ -0,0 +1,120 @@
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# IPFWBatch against fake_ipfw.py, commands of several callers go through
+# one "ipfw -q /dev/stdin", failed line reported to its caller only and
+# the commands after it resubmitted
+import json
+import os
+import stat
+import sys
+
+import pytest
+
+import um_firewall
+
+FAKE_IPFW = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fake_ipfw.py")
+
+
+@pytest.fixture
+def fake_ipfw(tmp_path, monkeypatch):
+    """
+    ipfw executable running fake_ipfw.py with fresh state, one line per invocation in runs file
+    """
+    monkeypatch.setenv("FAKE_IPFW_STATE", str(tmp_path / "fake_ipfw.state"))
+    monkeypatch.setenv("FAKE_IPFW_LOG", str(tmp_path / "fake_ipfw.log"))
+    monkeypatch.delenv("FAKE_IPFW_FAIL", raising=False)
+    monkeypatch.delenv("FAKE_IPFW_DELAY", raising=False)
+    ipfw_path = tmp_path / "ipfw"
+    ipfw_path.write_text("#!/bin/sh\necho \"$@\" >> {runs}\nexec {python} {fake} \"$@\"\n".format(
+        runs=tmp_path / "runs", python=sys.executable, fake=FAKE_IPFW))
+    ipfw_path.chmod(ipfw_path.stat().st_mode | stat.S_IXUSR)
+    return tmp_path
+
+
+def received(fake_dir):
+    """
+    Commands recorded by fake ipfw, in order received
+    """
+    with open(str(fake_dir / "fake_ipfw.log"), 'r') as log_file:
+        return log_file.read().splitlines()
+
+
+def invocations(fake_dir):
+    """
+    Number of ipfw processes started
+    """
+    with open(str(fake_dir / "runs"), 'r') as runs_file:
+        return len(runs_file.read().splitlines())
+
+
+def kernel_tables(fake_dir):
+    """
+    Tables kept in fake ipfw state
+    """
+    with open(str(fake_dir / "fake_ipfw.state"), 'r') as state_file:
+        return json.load(state_file)["tables"]
+
+
+def make_batch(fake_dir, window=0.5):
+    """
+    Batch on top of fake ipfw, window long enough for all callers to join one batch
+    """
+    return um_firewall.IPFWBatch(um_firewall.IPFWBatchBackend(str(fake_dir / "ipfw")), window=window)
+
+
+def test_callers_share_one_ipfw_process(fake_ipfw):
+    batch = make_batch(fake_ipfw)
+    first = batch.submit(["table blocklist create type addr", "table blocklist add 10.0.0.1"])
+    second = batch.submit(["table blocklist add 10.0.0.2"])
+
+    assert [request.wait() for request in first] == [True, True]
+    assert [request.wait() for request in second] == [True]
+    assert invocations(fake_ipfw) == 1
+    assert received(fake_ipfw) == ["table blocklist create type addr", "table blocklist add 10.0.0.1",
+                                   "table blocklist add 10.0.0.2"]
+
+
+def test_mid_batch_failure_reported_to_its_caller(fake_ipfw):
+    batch = make_batch(fake_ipfw)
+    assert batch.execute("table blocklist create type addr")
+    os.unlink(str(fake_ipfw / "runs"))
+
+    first = batch.submit(["table blocklist add 10.0.0.1", "table blocklist add 10.0.0.2"])
+    # Invalid address, fake ipfw stops at "Line 3:"
+    failing = batch.submit(["table blocklist add 10.0.0.300"])
+    last = batch.submit(["table blocklist add 10.0.0.4", "table blocklist add 10.0.0.5"])
+
+    assert [request.wait() for request in first] == [True, True]
+    assert [request.wait() for request in failing] == [False]
+    assert [request.wait() for request in last] == [True, True]
+
+    # Commands after the failed line resubmitted with second ipfw process
+    assert invocations(fake_ipfw) == 2
+    assert received(fake_ipfw)[1:] == ["table blocklist add 10.0.0.1", "table blocklist add 10.0.0.2",
+                                       "table blocklist add 10.0.0.300",
+                                       "table blocklist add 10.0.0.4", "table blocklist add 10.0.0.5"]
+    assert sorted(kernel_tables(fake_ipfw)["blocklist"]) == [
+        "10.0.0.1/32", "10.0.0.2/32", "10.0.0.4/32", "10.0.0.5/32"]
+
+
+def test_injected_failure_with_callbacks(fake_ipfw, monkeypatch):
+    batch = make_batch(fake_ipfw)
+    assert batch.execute("table fwdlist create type addr")
+    monkeypatch.setenv("FAKE_IPFW_FAIL", "add 10.0.0.2$")
+
+    statuses = {}
+    requests = batch.submit(["table fwdlist add 10.0.0.{num}".format(num=num) for num in range(1, 5)],
+                            [lambda status, num=num: statuses.__setitem__(num, status) for num in range(1, 5)])
+
+    assert [request.wait() for request in requests] == [True, False, True, True]
+    assert statuses == {1: True, 2: False, 3: True, 4: True}
+    assert sorted(kernel_tables(fake_ipfw)["fwdlist"]) == ["10.0.0.1/32", "10.0.0.3/32", "10.0.0.4/32"]
+
+
+def test_unlocated_failure_fails_whole_batch(fake_ipfw):
+    batch = make_batch(fake_ipfw)
+    batch.backend.ipfw_path = str(fake_ipfw / "missing_ipfw")
+
+    assert batch.execute_many(["table blocklist create type addr", "table blocklist add 10.0.0.1"]) == [False, False]
@@ -0,0 +1,144 @@
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# REST API regression on simulated ipfw, static ruleset of
+# conf/ipfw_rules.conf compiled into the simulator so strict host rules
+# are classified through skipto tablearg the way the kernel does
+import os
+
+import pytest
+
+import ipfw_rules
+import um_firewall
+
+RULESET = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "conf", "ipfw_rules.conf")
+RULESET_VARS = {"pif": "ext0", "bif": "bridge0", "dmzip": "192.168.10.84", "int_subnet": "192.168.10.0/24",
+                "router_gw": "192.168.10.1", "gateway_subnet": "192.168.1.0/24", "gateway": "192.168.1.1",
+                "satelite_ip": "192.168.1.1", "router_manage_client": "192.168.10.0/24", "routeraddr": "203.0.113.2"}
+
+
+@pytest.fixture
+def sim(monkeypatch):
+    """
+    Fresh simulated kernel with static ruleset loaded, um_firewall wired to it
+    """
+    backend = um_firewall.IPFWSimBackend()
+    ruleset = ipfw_rules.IPFWRuleset(ipfw_rules.load_description(RULESET), RULESET_VARS)
+    for line in ruleset.compile(flush=True):
+        backend.sim.run(line.split())
+
+    batch = um_firewall.IPFWBatch(backend, window=0.001)
+    cache = um_firewall.IPFWTableCache(batch)
+    intf = um_firewall.IPFWIntf(batch, cache)
+    monkeypatch.setattr(um_firewall, "g_ipfw_batch", batch)
+    monkeypatch.setattr(um_firewall, "g_ipfw_cache", cache)
+    monkeypatch.setattr(um_firewall, "g_ipfw_intf", intf)
+    monkeypatch.setattr(um_firewall, "g_psk", None)
+    cache.load()
+    return backend.sim
+
+
+@pytest.fixture
+def client(sim):
+    return um_firewall.app.test_client()
+
+
+def kernel_entries(sim, tbl):
+    """
+    Entries of simulated kernel table
+    """
+    return sorted(sim.tables.get(tbl, {}))
+
+
+def test_add_del_ip(client, sim):
+    assert client.post("/add_block_src_ip", json={"ip_addr": "192.168.10.50"}).get_json() == {"result": "success"}
+    assert client.post("/add_block_src_ip", json={"ip_addr": "192.168.10.50"}).get_json() == {"result": "unchanged"}
+    assert kernel_entries(sim, "blocklist") == ["192.168.10.50/32"]
+    assert sim.match("192.168.10.50", "198.18.0.1", iface="bridge0")[1] == "deny"
+
+    listed = client.get("/list_block_src_ip").get_json()["list_blocked_src_ip"]
+    assert listed["ip_list"] == ["192.168.10.50/32"]
+
+    assert client.post("/del_block_src_ip", json={"ip_addr": "192.168.10.50"}).get_json() == {"result": "success"}
+    assert kernel_entries(sim, "blocklist") == []
+    assert client.post("/add_block_src_ip", json={}).get_json() == {"add_block_src_ip": "malformed request"}
+
+
+def test_bulk_add_del(client, sim):
+    result = client.post("/add_bulk_ip", json={"table": "fwdlist",
+                                               "ip_addrs": ["198.18.0.1", "198.18.1.0/24", "bogus"]}).get_json()
+    assert result["ip_results"] == {"198.18.0.1": "success", "198.18.1.0/24": "success", "bogus": "malformed"}
+    assert kernel_entries(sim, "fwdlist") == ["198.18.0.1/32", "198.18.1.0/24"]
+
+    result = client.post("/del_bulk_ip", json={"table": "fwdlist", "ip_addrs": ["198.18.0.1", "198.18.1.0/24"]}).get_json()
+    assert result["result"] == "success"
+    assert kernel_entries(sim, "fwdlist") == []
+
+    assert client.post("/add_bulk_ip", json={"table": "nosuchtable", "ip_addrs": ["198.18.0.1"]}).get_json() == {
+        "add_bulk_ip": "wrong table provided"}
+
+
+@pytest.mark.parametrize("rule_base,pool_size", [(4000, 999), (10000, 5000)])
+def test_strict_host_skipto_tablearg(client, sim, rule_base, pool_size):
+    um_firewall.g_ipfw_intf.strict_ids.configure(rule_base, pool_size)
+
+    assert client.post("/add_strict_mon_host", json={"ip_addr": "192.168.10.60"}).get_json() == {"result": "success"}
+    assert sim.tables["strict_hosts_list"] == {"192.168.10.60/32": str(rule_base + 1)}
+    assert client.post("/add_target_for_strict_host",
+                       json={"mon_addr": "192.168.10.60", "ip_addr": "198.18.0.2"}).get_json() == {"result": "success"}
+    assert kernel_entries(sim, "t001") == ["198.18.0.2/32"]
+
+    # skipto tablearg lands on host rule pair, allowed target falls through to final accept
+    assert sim.match("192.168.10.60", "198.18.0.2", iface="bridge0") == (65001, "allow")
+    assert sim.match("192.168.10.60", "198.18.0.3", iface="bridge0") == (rule_base + 1, "deny")
+
+    listed = client.get("/list_target_for_strict_host", json={"mon_addr": "192.168.10.60"}).get_json()
+    assert listed["ip_list"] == ["198.18.0.2/32"]
+
+    assert client.post("/del_strict_mon_host", json={"ip_addr": "192.168.10.60"}).get_json() == {"result": "success"}
+    assert sim.tables["strict_hosts_list"] == {}
+    assert "t001" not in sim.tables
+    assert [rule for rule in sim.rules if rule[0] == rule_base + 1] == []
+
+
+def test_strict_pool_reaching_nat_rule_refused():
+    with pytest.raises(ValueError):
+        um_firewall.IPFWIDAllocator().configure(10000, 55000)
+
+
+def test_sync_table(client, sim):
+    client.post("/add_bulk_ip", json={"table": "blocklist", "ip_addrs": ["1.1.1.1", "1.1.1.2"]})
+
+    result = client.put("/sync_table", json={"table": "blocklist", "ip_addrs": ["1.1.1.1", "3.3.3.3", "bogus"]}).get_json()
+    assert result["added"] == 1
+    assert result["deleted"] == 1
+    # Adds and deletes keyed the same way, malformed by request string
+    assert result["ip_results"] == {"bogus": "malformed", "3.3.3.3/32": "success", "1.1.1.2/32": "success"}
+    assert kernel_entries(sim, "blocklist") == ["1.1.1.1/32", "3.3.3.3/32"]
+
+    result = client.put("/sync_table", json={"table": "blocklist", "ip_addrs": ["1.1.1.1", "3.3.3.3"]}).get_json()
+    assert result == {"result": "unchanged", "added": 0, "deleted": 0, "ip_results": {}}
+
+    # Empty array empties table, missing array is malformed
+    assert client.put("/sync_table", json={"table": "blocklist", "ip_addrs": []}).get_json()["deleted"] == 2
+    assert kernel_entries(sim, "blocklist") == []
+    assert client.put("/sync_table", json={"table": "blocklist"}).get_json() == {"sync_table": "malformed request"}
+
+
+def test_sync_table_kernel_reload(client, sim):
+    # Entry added behind um_firewall's back found once cache reloaded from kernel
+    sim.run("table blocklist add 2.2.2.2".split())
+    result = client.put("/sync_table", json={"table": "blocklist", "ip_addrs": ["1.1.1.1"], "kernel": True}).get_json()
+    assert result["ip_results"] == {"1.1.1.1/32": "success", "2.2.2.2/32": "success"}
+    assert kernel_entries(sim, "blocklist") == ["1.1.1.1/32"]
+
+
+def test_sync_table_releases_mac_block(client, sim):
+    assert client.post("/add_block_src_mac", json={"mac": "aa:bb:cc:dd:ee:01", "table": "blocklist"}).get_json()["result"] == "success"
+    um_firewall.g_ipfw_intf.apply_leases([("aa:bb:cc:dd:ee:01", "192.168.10.50", True)])
+    assert kernel_entries(sim, "blocklist") == ["192.168.10.50/32"]
+
+    client.put("/sync_table", json={"table": "blocklist", "ip_addrs": []})
+    assert kernel_entries(sim, "blocklist") == []
+    assert um_firewall.g_ipfw_intf.devices.blocked["blocklist"]["aa:bb:cc:dd:ee:01"] == set()
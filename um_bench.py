@@ -0,0 +1,1472 @@
+#!/usr/bin/python
+#
+# LICENSE: Apache 2.0
+# Copyright 2021-2023 Zhao Zhe, Alex Zhao
+#
+# Umbrella Dynamic Firewall benchmarks
+#
+# Every benchmark prints one json object to stdout, so results can be
+# collected and compared between releases
+#
+#   python um_bench.py parser [--lines 100000]
+#   python um_bench.py load [--url URL] [--concurrency 16] [--requests 2000]
+#   python um_bench.py tls [--requests 500]
+#   python um_bench.py aggregate [--blocks 200] [--sparse 5000]
+#   python um_bench.py restore [--entries 100000]
+#   python um_bench.py auth [--requests 20000]
+#   python um_bench.py endpoints [--requests 200]
+#   python um_bench.py burst [--ips 10000] [--concurrency 32]
+#   python um_bench.py priority [--ips 3000] [--bulk-rate 0] [--no-priority]
+#   python um_bench.py strict [--hosts 254] [--concurrency 1]
+#   python um_bench.py common [--hosts 50] [--targets 200] [--threshold 8]
+#   python um_bench.py domains [--domains 500] [--ips 8] [--pool 1000]
+#   python um_bench.py leases [--devices 5000] [--blocked 500] [--moves 50] [--rounds 20]
+#   python um_bench.py reload [--entries 1000] [--ruleset conf/ipfw_rules.conf]
+#   python um_bench.py counters [--strict-hosts 500] [--packets 5000] [--intervals 10]
+#   python um_bench.py list_scaling [--sizes 100,1000,10000,50000]
+#   python um_bench.py --output results.json suite [--baseline previous.json] [--tolerance 0.2]
+#
+# Without --url, benchmarks start um_firewall in-process on top of
+# simulated ipfw (--backend sim) or fake_ipfw.py processes (--backend
+# batch|cli), --fork-delay emulates the fork/exec cost of one ipfw call
+#
+# suite runs every benchmark in its own process and records version,
+# with --baseline metrics worse by more than tolerance are listed under
+# "regressions" and exit status is 1
+import argparse
+import http.client
+import io
+import json
+import os
+import random
+import re
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import ipfw_rules
+import ipfw_sim
+import um_firewall
+
+# Tables ipfw.sh creates before um_firewall starts
+g_base_tables = ["blocklist", "tblocklist", "fwdlist", "lockdownlist", "dmzallowlist"]
+
+
+def synthetic_table_list(lines, ipv6_ratio=0.1, seed=1):
+    """
+    Generate "ipfw table all list" like output with given number of entries
+    """
+    rnd = random.Random(seed)
+    out = ["--- table(fwdlist), set(0) ---"]
+    for i in range(lines):
+        if rnd.random() < ipv6_ratio:
+            out.append("2001:db8:{a:x}::{b:x}/128 0".format(a=rnd.randrange(65536), b=rnd.randrange(65536)))
+        else:
+            out.append("{a}.{b}.{c}.{d}/32 {v}".format(a=rnd.randrange(1, 224), b=rnd.randrange(256),
+                                                    c=rnd.randrange(256), d=rnd.randrange(256),
+                                                    v=rnd.choice(["0", "0", "4005"])))
+    return ("\n".join(out) + "\n").encode("ascii")
+
+
+def legacy_parse(data):
+    """
+    Parser used by list endpoints before the streaming parser
+    readlines, decode every line, IPv4 only regex
+    """
+    ip_addr_filter = re.compile(r"(\d+\.\d+\.\d+\.\d+\/\d+)", re.IGNORECASE)
+    ip_list = []
+    for line in io.BytesIO(data).readlines():
+        ip_addr_str = line.decode("utf-8")
+        ip_addr_match = ip_addr_filter.match(ip_addr_str)
+        if ip_addr_match:
+            if ip_addr_match.group(1):
+                ip_list.append(ip_addr_match.group(1))
+    return ip_list
+
+
+def bench_parser(args):
+    """
+    Streaming ipfw table list parser against legacy readlines/regex parser
+    """
+    data = synthetic_table_list(args.lines)
+
+    start = time.perf_counter()
+    legacy_entries = len(legacy_parse(data))
+    legacy_sec = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stream_entries = 0
+    for tbl, ip_addr, value, family in um_firewall.parse_table_list(io.BytesIO(data)):
+        if ip_addr:
+            stream_entries += 1
+    stream_sec = time.perf_counter() - start
+
+    return {
+        "benchmark": "parser",
+        "lines": args.lines,
+        "legacy": {"entries": legacy_entries, "seconds": legacy_sec,
+                   "lines_per_sec": args.lines / legacy_sec},
+        "stream": {"entries": stream_entries, "seconds": stream_sec,
+                   "lines_per_sec": args.lines / stream_sec}
+    }
+
+
+def percentile(samples, pct):
+    """
+    Return percentile of sorted samples
+    """
+    if not samples:
+        return 0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def setup_fake_ipfw(args):
+    """
+    Point um_firewall to simulated or fake ipfw with fresh state, return state directory
+    """
+    state_dir = tempfile.mkdtemp(prefix="um_bench_")
+    os.environ["FAKE_IPFW_STATE"] = os.path.join(state_dir, "fake_ipfw.state")
+    os.environ["FAKE_IPFW_LOG"] = os.path.join(state_dir, "fake_ipfw.log")
+    os.environ["FAKE_IPFW_DELAY"] = str(args.fork_delay)
+    if args.backend == "sim":
+        um_firewall.g_ipfw_batch.backend = um_firewall.IPFWSimBackend(delay=args.fork_delay)
+    else:
+        um_firewall.g_ipfw_batch.backend = um_firewall.make_backend(args.backend, fake_ipfw_path(args.ipfw, state_dir))
+    return state_dir
+
+
+def fake_ipfw_path(ipfw_path, state_dir):
+    """
+    Executable running python fake ipfw with this interpreter, shebang python may not exist
+    """
+    if not ipfw_path.endswith(".py"):
+        return ipfw_path
+    wrapper_path = os.path.join(state_dir, "ipfw")
+    with open(wrapper_path, 'w') as wrapper_file:
+        wrapper_file.write("#!/bin/sh\nexec {python} {fake} \"$@\"\n".format(python=sys.executable,
+                                                                             fake=os.path.abspath(ipfw_path)))
+    os.chmod(wrapper_path, 0o755)
+    return wrapper_path
+
+
+def start_local_server(args):
+    """
+    Start um_firewall with pooled server on top of fake ipfw, return base url
+    """
+    setup_fake_ipfw(args)
+    um_firewall.g_ipfw_batch.execute_many(["table {tbl} create type addr".format(tbl=tbl) for tbl in g_base_tables] +
+                                          ["table strict_hosts_list create type addr valtype skipto"])
+    um_firewall.g_ipfw_cache.start(0)
+
+    server = um_firewall.PooledWSGIServer("127.0.0.1", 0, um_firewall.app, args.workers)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{port}".format(port=server.port)
+
+
+def bench_load(args):
+    """
+    Concurrent mix of table updates and list requests against REST API
+    """
+    url = args.url or start_local_server(args)
+    target = urllib.parse.urlsplit(url)
+    conn_class = http.client.HTTPSConnection if target.scheme == "https" else http.client.HTTPConnection
+
+    latencies = {"write": [], "read": []}
+    errors = [0]
+    counter = iter(range(args.requests))
+    counter_lock = threading.Lock()
+    rnd = random.Random(1)
+    kinds = ["read" if rnd.random() < args.read_ratio else "write" for i in range(args.requests)]
+
+    def worker():
+        while True:
+            with counter_lock:
+                seq = next(counter, None)
+            if seq is None:
+                return
+            if kinds[seq] == "write":
+                ip_addr = "10.{a}.{b}.{c}".format(a=(seq >> 16) & 255, b=(seq >> 8) & 255, c=seq & 255)
+                method, path = "POST", "/add_fwd_target_ip"
+                body = json.dumps({"ip_addr": ip_addr, "psk": args.psk})
+            else:
+                method, path, body = "GET", "/list_dmz_target_ip", None
+            start = time.perf_counter()
+            try:
+                conn = conn_class(target.hostname, target.port, timeout=30)
+                conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+                response = conn.getresponse()
+                response.read()
+                conn.close()
+                if response.status != 200:
+                    errors[0] += 1
+            except (OSError, http.client.HTTPException):
+                errors[0] += 1
+            latencies[kinds[seq]].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "benchmark": "load",
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "backend": args.backend,
+        "fork_delay": args.fork_delay,
+        "errors": errors[0],
+        "seconds": elapsed,
+        "requests_per_sec": args.requests / elapsed
+    }
+    for kind, samples in latencies.items():
+        samples.sort()
+        result[kind] = {"count": len(samples),
+                        "p50_ms": percentile(samples, 50) * 1000,
+                        "p99_ms": percentile(samples, 99) * 1000}
+    return result
+
+
+def make_test_cert(cert_dir):
+    """
+    Generate self-signed localhost certificate with openssl, return paths
+    """
+    cert = os.path.join(cert_dir, "um_firewall.crt")
+    key = os.path.join(cert_dir, "um_firewall.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-keyout", key, "-out", cert, "-subj", "/CN=localhost",
+                    "-addext", "subjectAltName=DNS:localhost"],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def tls_request(client_context, port, session=None):
+    """
+    One request on new TLS connection, return (handshake sec, total sec, session, reused)
+    """
+    start = time.perf_counter()
+    raw_sock = socket.create_connection(("127.0.0.1", port))
+    tls_sock = client_context.wrap_socket(raw_sock, server_hostname="localhost", session=session)
+    handshake = time.perf_counter() - start
+    tls_sock.sendall(b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    while tls_sock.recv(65536):
+        pass
+    total = time.perf_counter() - start
+    # TLS 1.3 ticket arrives after handshake, take session after reading
+    new_session = tls_sock.session
+    reused = tls_sock.session_reused
+    tls_sock.close()
+    return handshake, total, new_session, reused
+
+
+def bench_tls(args):
+    """
+    Full handshake per request against session resumption and keep-alive
+    """
+    cert_dir = tempfile.mkdtemp(prefix="um_bench_")
+    cert, key = make_test_cert(cert_dir)
+    server_context = um_firewall.make_ssl_context(cert, key)
+    server = um_firewall.PooledWSGIServer("127.0.0.1", 0, um_firewall.app, args.workers, ssl_context=server_context)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Client pins persistent certificate
+    client_context = ssl.create_default_context(cafile=cert)
+
+    result = {"benchmark": "tls", "requests": args.requests}
+
+    handshakes = []
+    start = time.perf_counter()
+    for i in range(args.requests):
+        handshake, total, session, reused = tls_request(client_context, server.port)
+        handshakes.append(handshake)
+    elapsed = time.perf_counter() - start
+    result["full_handshake"] = {"handshake_ms": sum(handshakes) / len(handshakes) * 1000,
+                                "requests_per_sec": args.requests / elapsed}
+
+    handshakes = []
+    resumed = 0
+    handshake, total, session, reused = tls_request(client_context, server.port)
+    start = time.perf_counter()
+    for i in range(args.requests):
+        handshake, total, session, reused = tls_request(client_context, server.port, session)
+        handshakes.append(handshake)
+        resumed += 1 if reused else 0
+    elapsed = time.perf_counter() - start
+    result["session_resumption"] = {"handshake_ms": sum(handshakes) / len(handshakes) * 1000,
+                                    "resumed": resumed,
+                                    "requests_per_sec": args.requests / elapsed}
+
+    conn = http.client.HTTPSConnection("localhost", server.port, context=client_context)
+    start = time.perf_counter()
+    for i in range(args.requests):
+        conn.request("GET", "/")
+        conn.getresponse().read()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    result["keep_alive"] = {"requests_per_sec": args.requests / elapsed}
+    return result
+
+
+def synthetic_cdn_targets(blocks, sparse, fill=0.9, seed=1):
+    """
+    Generate learned target addresses, densely used CDN /24 blocks plus sparse hosts
+    """
+    rnd = random.Random(seed)
+    ip_addrs = []
+    for i in range(blocks):
+        base = "{a}.{b}.{c}".format(a=rnd.randrange(1, 224), b=rnd.randrange(256), c=rnd.randrange(256))
+        for d in range(256):
+            if rnd.random() < fill:
+                ip_addrs.append("{base}.{d}".format(base=base, d=d))
+    for i in range(sparse):
+        ip_addrs.append("{a}.{b}.{c}.{d}".format(a=rnd.randrange(1, 224), b=rnd.randrange(256),
+                                                 c=rnd.randrange(256), d=rnd.randrange(256)))
+    return ip_addrs
+
+
+def bench_aggregate(args):
+    """
+    Kernel entries and update cost with CIDR aggregation of learned targets
+    """
+    ip_addrs = synthetic_cdn_targets(args.blocks, args.sparse, args.fill)
+    aggregator = um_firewall.IPFWAggregator()
+    aggregator.tbl_prefixlen = {"fwdlist": args.prefixlen}
+    aggregator.seed("fwdlist", [])
+    kernel_ops = 0
+
+    start = time.perf_counter()
+    for ip_addr in ip_addrs:
+        network = um_firewall.ipaddress.ip_network(ip_addr)
+        changed, adds, deletes = aggregator.update("fwdlist", [network], "add")
+        for network in adds:
+            aggregator.commit("fwdlist", network, "add")
+        for network in deletes:
+            aggregator.commit("fwdlist", network, "delete")
+        kernel_ops += len(adds) + len(deletes)
+    elapsed = time.perf_counter() - start
+
+    stats = aggregator.stats()["fwdlist"]
+    return {
+        "benchmark": "aggregate",
+        "prefixlen": args.prefixlen,
+        "learned_entries": stats["learned_entries"],
+        "kernel_entries": stats["aggregated_entries"],
+        "kernel_ops": kernel_ops,
+        "seconds": elapsed,
+        "updates_per_sec": len(ip_addrs) / elapsed
+    }
+
+
+def bench_restore(args):
+    """
+    Warm restart from journal after reboot, against replaying entries one by one
+    """
+    state_dir = setup_fake_ipfw(args)
+    # Kernel right after ipfw.sh, base tables exist but empty
+    um_firewall.g_ipfw_batch.execute_many(["table fwdlist create type addr",
+                                           "table strict_hosts_list create type addr"])
+    um_firewall.g_ipfw_cache.start(0)
+
+    # Legacy recovery, telescope replays every learned IP with its own request
+    start = time.perf_counter()
+    for i in range(args.replay_sample):
+        um_firewall.g_ipfw_batch.execute("table fwdlist add 10.255.{a}.{b}".format(a=i >> 8, b=i & 255))
+    replay_sec = (time.perf_counter() - start) / args.replay_sample * args.entries
+
+    journal_path = os.path.join(state_dir, "um_firewall.journal")
+    rnd = random.Random(1)
+    with open(journal_path, 'w') as journal_file:
+        for i in range(args.entries):
+            ip_addr = "{a}.{b}.{c}.{d}/32".format(a=rnd.randrange(1, 224), b=rnd.randrange(256),
+                                                  c=rnd.randrange(256), d=rnd.randrange(256))
+            journal_file.write(json.dumps(["a", "fwdlist", ip_addr, "0"]) + "\n")
+        for idx in range(2, 2 + args.strict_hosts):
+            ip_addr = "192.168.10.{idx}".format(idx=idx)
+            journal_file.write(json.dumps(["a", "strict_hosts_list", ip_addr + "/32", str(4000 + idx)]) + "\n")
+            journal_file.write(json.dumps(["c", "t{idx:03d}".format(idx=idx)]) + "\n")
+            journal_file.write(json.dumps(["r", 4000 + idx, [
+                "skipto 502 ip from {ip} to table(t{idx:03d}) via bridge0".format(ip=ip_addr, idx=idx),
+                "deny ip from {ip} to not table(t{idx:03d}) via bridge0".format(ip=ip_addr, idx=idx)]]) + "\n")
+
+    start = time.perf_counter()
+    restore = um_firewall.g_ipfw_intf.start_journal(um_firewall.IPFWJournal(journal_path))
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "benchmark": "restore",
+        "entries": args.entries,
+        "strict_hosts": args.strict_hosts,
+        "restored": restore["restored"],
+        "failed": restore["failed"],
+        "seconds": elapsed,
+        "entries_per_sec": args.entries / elapsed,
+        "replay_estimate_seconds": replay_sec
+    }
+    # Timing of a restore that didn't restore is meaningless
+    if restore["failed"] or restore["restored"] < args.entries:
+        result["error"] = "restored {restored} of {entries} entries, {failed} failed".format(
+            restored=restore["restored"], entries=args.entries, failed=restore["failed"])
+        del result["seconds"], result["entries_per_sec"]
+    return result
+
+
+def bench_auth(args):
+    """
+    Per request authentication and argument parsing overhead
+    """
+    psk = "bench-psk"
+    um_firewall.g_psk = psk
+    body = json.dumps({"ip_addr": "10.0.0.1", "psk": psk}).encode("utf-8")
+    result = {"benchmark": "auth", "requests": args.requests}
+
+    def run(name, headers, handler):
+        start = time.perf_counter()
+        for i in range(args.requests):
+            with um_firewall.app.test_request_context("/add_fwd_target_ip", method="POST", data=body,
+                                                      headers=headers(i)):
+                handler()
+        elapsed = time.perf_counter() - start
+        result[name] = {"us_per_request": elapsed / args.requests * 1e6}
+
+    def baseline():
+        pass
+
+    def legacy():
+        # psk compared with != and arguments parsed again per field
+        if um_firewall.parser.parse_args()['psk'] != psk:
+            raise RuntimeError("authentication failed")
+        um_firewall.parser.parse_args()['ip_addr']
+        um_firewall.parser.parse_args()['ttl']
+
+    def middleware():
+        if um_firewall.authenticate() is not None:
+            raise RuntimeError("authentication failed")
+        um_firewall.request_args()['ip_addr']
+        um_firewall.request_args()['ttl']
+
+    json_headers = lambda i: {"Content-Type": "application/json"}
+
+    def signed_headers(i):
+        timestamp = str(time.time())
+        nonce = "bench-{i}".format(i=i)
+        return {"Content-Type": "application/json", "X-UM-Timestamp": timestamp, "X-UM-Nonce": nonce,
+                "X-UM-Signature": um_firewall.PSKAuth.sign(psk, timestamp, nonce, "POST", "/add_fwd_target_ip", body)}
+
+    run("request_context", json_headers, baseline)
+    run("legacy_psk", json_headers, legacy)
+    run("constant_time_psk", json_headers, middleware)
+    run("hmac_signed", signed_headers, middleware)
+    return result
+
+
+# APIClient one keep-alive connection to REST API, one per client thread
+class APIClient:
+    def __init__(self, url, psk=""):
+        """
+        API client initialization
+        """
+        self.target = urllib.parse.urlsplit(url)
+        self.conn_class = http.client.HTTPSConnection if self.target.scheme == "https" else http.client.HTTPConnection
+        self.psk = psk
+        self.conn = None
+
+    def call(self, method, path, **fields):
+        """
+        One request with JSON body, return (status, decoded body, seconds)
+        """
+        fields["psk"] = self.psk
+        body = json.dumps(fields)
+        start = time.perf_counter()
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = self.conn_class(self.target.hostname, self.target.port, timeout=30)
+            try:
+                self.conn.request(method, path, body=body, headers={"Content-Type": "application/json"})
+                response = self.conn.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException):
+                # Server closed idle keep-alive connection, reconnect once
+                self.conn.close()
+                self.conn = None
+                if attempt:
+                    return 0, None, time.perf_counter() - start
+        elapsed = time.perf_counter() - start
+        try:
+            data = json.loads(data)
+        except ValueError:
+            pass
+        return response.status, data, elapsed
+
+    def close(self):
+        """
+        Close connection
+        """
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+def latency_summary(samples):
+    """
+    Return count, mean, p50 and p99 of latency samples in ms
+    """
+    samples = sorted(samples)
+    return {"count": len(samples),
+            "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000}
+
+
+def ipfw_invocations():
+    """
+    Number of backend calls so far, one ipfw process each with the batch backend
+    """
+    return sum(um_firewall.g_metrics.batch_size.counts)
+
+
+def run_clients(url, psk, concurrency, calls):
+    """
+    Run (method, path, fields) calls over concurrent clients, return (seconds, latencies, errors)
+    """
+    latencies = []
+    errors = [0]
+    counter = iter(range(len(calls)))
+    counter_lock = threading.Lock()
+
+    def worker():
+        client = APIClient(url, psk)
+        while True:
+            with counter_lock:
+                seq = next(counter, None)
+            if seq is None:
+                break
+            method, path, fields = calls[seq]
+            status, data, elapsed = client.call(method, path, **fields)
+            if status != 200 or (isinstance(data, dict) and data.get("result") == "failed"):
+                errors[0] += 1
+            latencies.append(elapsed)
+        client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, latencies, errors[0]
+
+
+def bench_endpoints(args):
+    """
+    Sequential throughput and latency of single add/delete/list per endpoint
+    """
+    url = start_local_server(args)
+    client = APIClient(url, args.psk)
+    mon_addr = "192.168.10.20"
+    client.call("POST", "/add_strict_mon_host", ip_addr=mon_addr)
+
+    def addr(i):
+        return "10.{a}.{b}.{c}".format(a=(i >> 16) & 255, b=(i >> 8) & 255, c=i & 255)
+
+    # (endpoint, method, fields of i-th request)
+    cases = [
+        ("/add_block_src_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/del_block_src_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/add_block_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/del_block_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/add_fwd_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/del_fwd_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/add_lockdown_dev_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/del_lockdown_dev_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/add_dmz_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/del_dmz_target_ip", "POST", lambda i: {"ip_addr": addr(i)}),
+        ("/add_target_for_strict_host", "POST", lambda i: {"mon_addr": mon_addr, "ip_addr": addr(i)}),
+        ("/del_target_for_strict_host", "POST", lambda i: {"mon_addr": mon_addr, "ip_addr": addr(i)}),
+        ("/add_bulk_ip", "POST", lambda i: {"table": "fwdlist", "ip_addrs": [addr(i * 16 + j) for j in range(16)]}),
+        ("/del_bulk_ip", "POST", lambda i: {"table": "fwdlist", "ip_addrs": [addr(i * 16 + j) for j in range(16)]}),
+        ("/list_block_src_ip", "GET", lambda i: {}),
+        ("/list_block_target_ip", "GET", lambda i: {}),
+        ("/list_lockdown_dev_ip", "GET", lambda i: {}),
+        ("/list_dmz_target_ip", "GET", lambda i: {}),
+        ("/list_strict_mon_host", "GET", lambda i: {}),
+        ("/list_target_for_strict_host", "GET", lambda i: {"mon_addr": mon_addr}),
+        ("/table_stats", "GET", lambda i: {}),
+    ]
+
+    result = {"benchmark": "endpoints", "backend": args.backend, "fork_delay": args.fork_delay,
+              "requests": args.requests, "endpoints": {}}
+    for path, method, fields in cases:
+        latencies = []
+        errors = 0
+        invocations = ipfw_invocations()
+        start = time.perf_counter()
+        for i in range(args.requests):
+            status, data, elapsed = client.call(method, path, **fields(i))
+            if status != 200 or (isinstance(data, dict) and data.get("result") == "failed"):
+                errors += 1
+            latencies.append(elapsed)
+        elapsed = time.perf_counter() - start
+        endpoint = latency_summary(latencies)
+        endpoint.update({"errors": errors, "requests_per_sec": args.requests / elapsed,
+                         "ipfw_invocations": ipfw_invocations() - invocations})
+        result["endpoints"][path] = endpoint
+    client.close()
+    return result
+
+
+def synthetic_dns_answers(ip_total, seed=1):
+    """
+    Generate (domain, ip_addrs) DNS answers adding up to ip_total addresses,
+    CDN hosted domains share addresses of a few popular /24 blocks
+    """
+    rnd = random.Random(seed)
+    cdn_blocks = ["{a}.{b}.{c}".format(a=rnd.randrange(1, 224), b=rnd.randrange(256), c=rnd.randrange(256))
+                  for i in range(64)]
+    answers = []
+    count = 0
+    while count < ip_total:
+        domain = "host{idx}.example{zone}.com".format(idx=len(answers), zone=rnd.randrange(500))
+        ip_addrs = []
+        for i in range(min(rnd.choice([1, 1, 2, 4, 8]), ip_total - count)):
+            if rnd.random() < 0.6:
+                ip_addrs.append("{block}.{d}".format(block=rnd.choice(cdn_blocks), d=rnd.randrange(1, 255)))
+            else:
+                ip_addrs.append("{a}.{b}.{c}.{d}".format(a=rnd.randrange(1, 224), b=rnd.randrange(256),
+                                                         c=rnd.randrange(256), d=rnd.randrange(1, 255)))
+        answers.append((domain, ip_addrs))
+        count += len(ip_addrs)
+    return answers
+
+
+def bench_burst(args):
+    """
+    Burst ingestion of DNS derived target IPs, one request per IP and one per DNS answer
+    """
+    url = start_local_server(args)
+    answers = synthetic_dns_answers(args.ips)
+    ip_addrs = [ip_addr for domain, answer in answers for ip_addr in answer]
+    result = {"benchmark": "burst", "backend": args.backend, "fork_delay": args.fork_delay,
+              "concurrency": args.concurrency, "ips": len(ip_addrs), "unique_ips": len(set(ip_addrs)),
+              "dns_answers": len(answers)}
+
+    modes = [
+        ("per_ip", "fwdlist", [("POST", "/add_fwd_target_ip", {"ip_addr": ip_addr}) for ip_addr in ip_addrs]),
+        ("per_answer", "dmzallowlist", [("POST", "/add_bulk_ip", {"table": "dmzallowlist", "ip_addrs": answer})
+                                        for domain, answer in answers])
+    ]
+    for mode, tbl, calls in modes:
+        invocations = ipfw_invocations()
+        elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency, calls)
+        summary = latency_summary(latencies)
+        summary.update({"table": tbl, "requests": len(calls), "errors": errors, "seconds": elapsed,
+                        "ips_per_sec": len(ip_addrs) / elapsed,
+                        "kernel_entries": len(um_firewall.g_ipfw_cache.list(tbl)),
+                        "ipfw_invocations": ipfw_invocations() - invocations})
+        result[mode] = summary
+    return result
+
+
+def histogram_summary(histogram):
+    """
+    Return count, mean and upper bucket bound of p99 of histogram in ms
+    """
+    count = sum(histogram.counts)
+    p99 = float("inf")
+    cumulative = 0
+    for bound, bucket_count in zip(histogram.buckets, histogram.counts):
+        cumulative += bucket_count
+        if cumulative >= count * 0.99:
+            p99 = bound
+            break
+    return {"count": count, "mean_ms": histogram.total / count * 1000 if count else 0,
+            "p99_le_ms": p99 * 1000 if count else 0}
+
+
+def bench_priority(args):
+    """
+    Block requests issued during burst of DNS learning traffic
+    reports latency of both and ipfw queue wait per priority class
+    """
+    scheduler = um_firewall.g_ipfw_intf.scheduler
+    scheduler.enabled = not args.no_priority
+    scheduler.bulk_rate = args.bulk_rate
+    scheduler.max_queue = args.max_queue
+    um_firewall.g_ipfw_intf.aggregator.tbl_prefixlen = {"fwdlist": 24}
+    url = start_local_server(args)
+    answers = synthetic_dns_answers(args.ips)
+    calls = []
+    for domain, answer in answers:
+        calls.append(("POST", "/add_bulk_ip", {"table": "dmzallowlist", "ip_addrs": answer}))
+        calls.extend(("POST", "/add_fwd_target_ip", {"ip_addr": ip_addr}) for ip_addr in answer)
+    result = {"benchmark": "priority", "backend": args.backend, "fork_delay": args.fork_delay,
+              "prioritize": scheduler.enabled, "bulk_rate": args.bulk_rate, "max_queue": args.max_queue,
+              "concurrency": args.concurrency, "bulk_requests": len(calls)}
+
+    statuses = {}
+    bulk_latencies = []
+    counter = iter(range(len(calls)))
+    counter_lock = threading.Lock()
+
+    def flood():
+        client = APIClient(url, args.psk)
+        while True:
+            with counter_lock:
+                seq = next(counter, None)
+            if seq is None:
+                break
+            method, path, fields = calls[seq]
+            status, data, elapsed = client.call(method, path, **fields)
+            statuses[status] = statuses.get(status, 0) + 1
+            bulk_latencies.append(elapsed)
+        client.close()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=flood) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    # Block requests on their own connection while the burst runs
+    client = APIClient(url, args.psk)
+    block_latencies = []
+    block_errors = 0
+    while any(thread.is_alive() for thread in threads):
+        seq = len(block_latencies)
+        status, data, elapsed = client.call("POST", "/add_block_src_ip", ip_addr="10.{b}.{c}.1".format(b=seq // 250, c=seq % 250))
+        if status != 200 or data.get("result") != "success":
+            block_errors += 1
+        block_latencies.append(elapsed)
+        time.sleep(args.interval)
+    client.close()
+    for thread in threads:
+        thread.join()
+
+    bulk = latency_summary(bulk_latencies)
+    bulk.update({"seconds": time.perf_counter() - start, "accepted": statuses.get(200, 0),
+                 "throttled": statuses.get(429, 0),
+                 "errors": sum(count for status, count in statuses.items() if status not in (200, 429))})
+    block = latency_summary(block_latencies)
+    block["errors"] = block_errors
+    result["bulk"] = bulk
+    result["block"] = block
+    result["queue_wait"] = {priority: histogram_summary(histogram)
+                            for priority, histogram in sorted(um_firewall.g_metrics.queue_wait.items())}
+    result["coalesced"] = sum(stats["coalesced"] for stats in scheduler.stats().values())
+    return result
+
+
+def bench_strict(args):
+    """
+    Provision strict hosts with their tables and rule pairs, then remove them
+    hosts beyond 254 spread over following /24s, same last octets on each
+    """
+    if args.hosts > um_firewall.g_ipfw_intf.strict_ids.size:
+        um_firewall.g_ipfw_intf.strict_ids.configure(10000, args.hosts)
+    url = start_local_server(args)
+    hosts = ["192.168.{subnet}.{idx}".format(subnet=10 + i // 254, idx=i % 254 + 1) for i in range(args.hosts)]
+    result = {"benchmark": "strict", "backend": args.backend, "fork_delay": args.fork_delay,
+              "concurrency": args.concurrency, "hosts": len(hosts)}
+
+    invocations = ipfw_invocations()
+    elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency,
+                                             [("POST", "/add_strict_mon_host", {"ip_addr": host}) for host in hosts])
+    provision = latency_summary(latencies)
+    rule_base = um_firewall.g_ipfw_intf.strict_ids.base
+    rules = [line for line in um_firewall.g_ipfw_batch.backend.list_rules().splitlines()
+             if rule_base < int(line.split()[0]) <= rule_base + args.hosts]
+    provision.update({"errors": errors, "seconds": elapsed, "hosts_per_sec": len(hosts) / elapsed,
+                      "strict_hosts": len(um_firewall.g_ipfw_cache.list("strict_hosts_list")),
+                      "rules": len(rules), "ipfw_invocations": ipfw_invocations() - invocations})
+    result["pool"] = um_firewall.g_ipfw_intf.strict_ids.stats()
+    result["provision"] = provision
+
+    # Re-adding provisioned hosts must not touch the kernel
+    invocations = ipfw_invocations()
+    elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency,
+                                             [("POST", "/add_strict_mon_host", {"ip_addr": host}) for host in hosts])
+    reprovision = latency_summary(latencies)
+    reprovision.update({"errors": errors, "seconds": elapsed, "hosts_per_sec": len(hosts) / elapsed,
+                        "ipfw_invocations": ipfw_invocations() - invocations})
+    result["reprovision"] = reprovision
+
+    invocations = ipfw_invocations()
+    elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency,
+                                             [("POST", "/del_strict_mon_host", {"ip_addr": host}) for host in hosts])
+    remove = latency_summary(latencies)
+    remove.update({"errors": errors, "seconds": elapsed, "hosts_per_sec": len(hosts) / elapsed,
+                   "ipfw_invocations": ipfw_invocations() - invocations})
+    result["remove"] = remove
+    return result
+
+
+def bench_common(args):
+    """
+    Strict hosts learning the same popular targets, then forgetting them
+    kernel entries and ipfw commands compared between thresholds, 0 keeps one entry per host
+    """
+    um_firewall.g_ipfw_intf.common.threshold = args.threshold
+    url = start_local_server(args)
+    hosts = ["192.168.10.{idx}".format(idx=i + 1) for i in range(args.hosts)]
+    popular = ["203.0.{block}.{idx}".format(block=113 + i // 254, idx=i % 254 + 1) for i in range(args.targets)]
+    result = {"benchmark": "common", "backend": args.backend, "fork_delay": args.fork_delay, "threshold": args.threshold,
+              "hosts": len(hosts), "targets": len(popular), "private": args.private}
+
+    elapsed, latencies, errors = run_clients(url, args.psk, 1, [("POST", "/add_strict_mon_host", {"ip_addr": host}) for host in hosts])
+    tables = [um_firewall.g_ipfw_intf.strict_host_table(host) for host in hosts]
+
+    def kernel_entries():
+        return sum(len(um_firewall.g_ipfw_cache.list(tbl)) for tbl in tables + [um_firewall.g_ipfw_intf.common.table])
+
+    def run_phase(calls):
+        commands = um_firewall.g_metrics.batch_size.total
+        invocations = ipfw_invocations()
+        elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency, calls)
+        phase = latency_summary(latencies)
+        phase.update({"errors": errors, "seconds": elapsed, "requests_per_sec": len(calls) / elapsed,
+                      "ipfw_commands": um_firewall.g_metrics.batch_size.total - commands,
+                      "ipfw_invocations": ipfw_invocations() - invocations, "kernel_entries": kernel_entries()})
+        return phase
+
+    rnd = random.Random(1)
+    calls = []
+    for host_idx, host in enumerate(hosts):
+        targets = popular + ["198.18.{block}.{idx}".format(block=host_idx, idx=i + 1) for i in range(args.private)]
+        calls.extend(("POST", "/add_bulk_ip", {"mon_addr": host, "ip_addrs": targets[start:start + 16]})
+                     for start in range(0, len(targets), 16))
+    rnd.shuffle(calls)
+    result["learn"] = run_phase(calls)
+
+    # Popular targets forgotten by most hosts, demoted back when few owners left
+    calls = [("POST", "/del_bulk_ip", {"mon_addr": host, "ip_addrs": popular}) for host in hosts[:len(hosts) * 3 // 4]]
+    result["forget"] = run_phase(calls)
+    result["common"] = um_firewall.g_ipfw_intf.common.stats()
+    return result
+
+
+def bench_domains(args):
+    """
+    Domains resolving to overlapping CDN addresses, learned then revoked one by one
+    every revoke deletes only addresses no remaining domain owns, within one ipfw call
+    """
+    url = start_local_server(args)
+    rnd = random.Random(1)
+    pool = ["198.51.{block}.{idx}".format(block=100 + i // 254, idx=i % 254 + 1) for i in range(args.pool)]
+    domains = {"d{num}.example.com".format(num=num): rnd.sample(pool, args.ips) for num in range(args.domains)}
+    result = {"benchmark": "domains", "backend": args.backend, "fork_delay": args.fork_delay,
+              "domains": len(domains), "ips_per_domain": args.ips, "pool": len(pool)}
+
+    invocations = ipfw_invocations()
+    elapsed, latencies, errors = run_clients(url, args.psk, args.concurrency,
+                                             [("POST", "/add_domain_ip", {"table": "dmzallowlist", "domain": domain, "ip_addrs": ip_addrs})
+                                              for domain, ip_addrs in domains.items()])
+    learn = latency_summary(latencies)
+    learn.update({"errors": errors, "seconds": elapsed, "domains_per_sec": len(domains) / elapsed,
+                  "ipfw_invocations": ipfw_invocations() - invocations,
+                  "kernel_entries": len(um_firewall.g_ipfw_cache.list("dmzallowlist"))})
+    result["learn"] = learn
+
+    # Sequential revokes, kernel entries checked against addresses still owned
+    client = APIClient(url, args.psk)
+    latencies = []
+    errors = 0
+    invocations = ipfw_invocations()
+    max_invocations = 0
+    remaining = dict(domains)
+    for domain in list(domains):
+        before = ipfw_invocations()
+        status, data, elapsed = client.call("POST", "/revoke_domain", table="dmzallowlist", domain=domain)
+        max_invocations = max(max_invocations, ipfw_invocations() - before)
+        latencies.append(elapsed)
+        del remaining[domain]
+        owned = set(um_firewall.normalize_ip_addr(ip_addr) for ip_addrs in remaining.values() for ip_addr in ip_addrs)
+        if status != 200 or data.get("result") == "failed" or \
+                set(ip_addr for ip_addr, value in um_firewall.g_ipfw_cache.list("dmzallowlist")) != owned:
+            errors += 1
+    client.close()
+    revoke = latency_summary(latencies)
+    revoke.update({"errors": errors, "revokes_per_sec": len(domains) / sum(latencies),
+                   "ipfw_invocations": ipfw_invocations() - invocations, "max_invocations_per_revoke": max_invocations,
+                   "kernel_entries": len(um_firewall.g_ipfw_cache.list("dmzallowlist"))})
+    result["revoke"] = revoke
+    return result
+
+
+def bench_leases(args):
+    """
+    Devices moving between DHCP leases, part of them blocked by MAC
+    every lease file rewrite applies only moved devices, blocklist checked
+    against addresses currently leased to blocked devices
+    """
+    url = start_local_server(args)
+    lease_dir = tempfile.mkdtemp()
+    lease_path = os.path.join(lease_dir, "dnsmasq.leases")
+    rnd = random.Random(1)
+    macs = ["02:00:00:{a:02x}:{b:02x}:{c:02x}".format(a=(i >> 16) & 255, b=(i >> 8) & 255, c=i & 255)
+            for i in range(args.devices)]
+    free = ["10.{a}.{b}.{c}".format(a=20 + i // 65024, b=(i // 254) % 256, c=i % 254 + 1) for i in range(args.devices * 2)]
+    rnd.shuffle(free)
+    leased = {mac: free.pop() for mac in macs}
+    blocked = set(rnd.sample(macs, args.blocked))
+    result = {"benchmark": "leases", "backend": args.backend, "fork_delay": args.fork_delay,
+              "devices": len(macs), "blocked": len(blocked), "moves_per_round": args.moves}
+
+    def write_leases():
+        with open(lease_path + ".tmp", 'w') as lease_file:
+            for mac, ip_addr in leased.items():
+                lease_file.write("0 {mac} {ip_addr} host-{mac} *\n".format(mac=mac, ip_addr=ip_addr))
+        os.replace(lease_path + ".tmp", lease_path)
+
+    def expected():
+        return set(um_firewall.normalize_ip_addr(leased[mac]) for mac in blocked)
+
+    feed = um_firewall.IPFWLeaseFeed(lease_path, um_firewall.g_ipfw_intf.apply_leases, "dnsmasq")
+    write_leases()
+    start = time.perf_counter()
+    feed.poll()
+    initial = {"seconds": time.perf_counter() - start}
+
+    client = APIClient(url, args.psk)
+    commands = um_firewall.g_metrics.batch_size.total
+    errors = 0
+    for mac in blocked:
+        status, data, elapsed = client.call("POST", "/add_block_src_mac", mac=mac)
+        if status != 200 or data.get("result") == "failed":
+            errors += 1
+    initial.update({"errors": errors, "commands": um_firewall.g_metrics.batch_size.total - commands,
+                    "kernel_entries": len(um_firewall.g_ipfw_cache.list("blocklist"))})
+    result["initial"] = initial
+
+    # Lease file rewritten with moved devices, as dnsmasq does on every lease change
+    latencies = []
+    errors = 0
+    events = 0
+    commands = um_firewall.g_metrics.batch_size.total
+    invocations = ipfw_invocations()
+    for i in range(args.rounds):
+        for mac in rnd.sample(macs, args.moves):
+            free.append(leased[mac])
+            leased[mac] = free.pop(0)
+        write_leases()
+        feed.mtime = None
+        start = time.perf_counter()
+        events += len(feed.poll())
+        latencies.append(time.perf_counter() - start)
+        if set(ip_addr for ip_addr, value in um_firewall.g_ipfw_cache.list("blocklist")) != expected():
+            errors += 1
+    rewrite = latency_summary(latencies)
+    rewrite.update({"errors": errors, "lease_events": events, "rounds_per_sec": args.rounds / sum(latencies),
+                    "commands": um_firewall.g_metrics.batch_size.total - commands,
+                    "ipfw_invocations": ipfw_invocations() - invocations,
+                    "commands_per_round": (um_firewall.g_metrics.batch_size.total - commands) / args.rounds,
+                    "kernel_entries": len(um_firewall.g_ipfw_cache.list("blocklist"))})
+    result["rewrite"] = rewrite
+
+    # Lease events pushed by DHCP server hook, one device at a time
+    latencies = []
+    errors = 0
+    commands = um_firewall.g_metrics.batch_size.total
+    for mac in rnd.sample(macs, args.moves * args.rounds // 2):
+        free.append(leased[mac])
+        leased[mac] = free.pop(0)
+        status, data, elapsed = client.call("POST", "/update_lease", mac=mac, ip_addr=leased[mac])
+        latencies.append(elapsed)
+        if status != 200 or data.get("result") == "failed":
+            errors += 1
+    client.close()
+    if set(ip_addr for ip_addr, value in um_firewall.g_ipfw_cache.list("blocklist")) != expected():
+        errors += 1
+    push = latency_summary(latencies)
+    push.update({"errors": errors, "events_per_sec": len(latencies) / sum(latencies),
+                 "commands_per_event": (um_firewall.g_metrics.batch_size.total - commands) / len(latencies)})
+    result["push"] = push
+    return result
+
+
+def legacy_reload_commands(ruleset):
+    """
+    Commands of flush based ipfw.sh for same ruleset, each run as its own ipfw process
+    every table destroyed and recreated, rules added to set 0 one by one
+    """
+    commands = ["-f flush"] + [ruleset.expand(command) for command in ruleset.commands]
+    for tbl in ruleset.tables:
+        commands.append("table {table} destroy".format(table=tbl))
+        commands.append(ruleset.create_command(tbl).rsplit(" ", 1)[0])
+        for entry in ruleset.table_entries(tbl):
+            commands.append("table {table} add {entry}".format(table=tbl, entry=entry))
+    for rule in ruleset.rules:
+        commands.append("add " + " ".join(ruleset.expand(rule).split()))
+    return commands
+
+
+def reload_probes(args):
+    """
+    Packets with verdict given by static rules, learned tables and strict host rules
+    (src, dst, proto, dport, iface)
+    """
+    return [("192.168.10.50", "8.8.8.8", "tcp", 443, "bridge0"),
+            ("192.168.10.51", "198.18.0.1", "tcp", 443, "bridge0"),
+            ("192.168.10.51", "10.1.2.3", "tcp", 443, "bridge0"),
+            ("192.168.10.70", "8.8.8.8", "udp", 443, "bridge0"),
+            ("192.168.10.84", "1.1.1.1", "tcp", 443, "bridge0"),
+            ("192.168.10.84", "192.168.1.1", "udp", 53, "bridge0"),
+            ("198.51.100.7", "127.0.0.1", "tcp", 22, "ext0"),
+            ("192.168.10.60", "198.18.0.2", "tcp", 443, "bridge0"),
+            ("192.168.10.60", "203.0.113.9", "tcp", 443, "bridge0")]
+
+
+def reload_kernel(args, ruleset, commands):
+    """
+    Simulated kernel after boot with given ruleset commands, then learned state of um_firewall
+    """
+    sim = ipfw_sim.IPFWSimulator()
+    for command in commands:
+        try:
+            sim.run(command.split())
+        except ipfw_sim.IPFWSimError:
+            pass
+    for i in range(args.entries):
+        sim.run("table fwdlist add 198.18.{a}.{b}".format(a=i >> 8, b=i & 255).split())
+    sim.run("table blocklist add 192.168.10.50".split())
+    sim.run("table lockdownlist add 192.168.10.70".split())
+    # Strict host 60 learned 198.18.0.2, rule pair in set 0 like um_firewall adds it
+    sim.run("table strict_hosts_list add 192.168.10.60 4060".split())
+    sim.run("table t060 create type addr".split())
+    sim.run("table t060 add 198.18.0.2".split())
+    sim.run("add 4060 skipto 502 ip from 192.168.10.60 to table(t060) via bridge0".split())
+    sim.run("add 4060 deny ip from 192.168.10.60 to not table(t060) via bridge0".split())
+    return sim
+
+
+def replay_reload(sim, commands, probes):
+    """
+    Apply reload commands one by one, classify probes after each
+    return (failed commands, commands leaving any probe with wrong verdict, wrong verdicts, wrong once reloaded)
+    """
+    expected = [sim.match(src, dst, proto, dport, iface)[1] for src, dst, proto, dport, iface in probes]
+    failed = 0
+    wrong_steps = 0
+    wrong = 0
+    mismatched = 0
+    for command in commands:
+        try:
+            sim.run(command.split())
+        except ipfw_sim.IPFWSimError:
+            failed += 1
+        mismatched = sum(1 for probe, verdict in zip(probes, expected) if sim.match(*probe)[1] != verdict)
+        if mismatched:
+            wrong_steps += 1
+            wrong += mismatched
+    return failed, wrong_steps, wrong, mismatched
+
+
+def bench_reload(args):
+    """
+    Static ruleset reload of flush based ipfw.sh against compiled set swap reload
+    window of wrong verdicts classified on simulated ipfw after every command,
+    reload time measured on fake_ipfw.py processes with fork delay
+    """
+    variables = {"pif": "ext0", "bif": "bridge0", "dmzip": "192.168.10.84", "int_subnet": "192.168.10.0/24",
+                 "router_gw": "192.168.10.1", "gateway_subnet": "192.168.1.0/24", "gateway": "192.168.1.1",
+                 "satelite_ip": "192.168.1.1", "router_manage_client": "192.168.10.0/24", "routeraddr": "203.0.113.2"}
+    ruleset = ipfw_rules.IPFWRuleset(ipfw_rules.load_description(args.ruleset), variables)
+    probes = reload_probes(args)
+    result = {"benchmark": "reload", "fork_delay": args.fork_delay, "rules": len(ruleset.rules),
+              "tables": len(ruleset.tables), "learned_entries": args.entries, "probes": len(probes)}
+
+    cases = {}
+    for name, boot, reload in (("legacy", legacy_reload_commands(ruleset), legacy_reload_commands(ruleset)),
+                               ("compiled", ruleset.compile(flush=True), None)):
+        sim = reload_kernel(args, ruleset, boot)
+        compile_sec = 0
+        if reload is None:
+            start = time.perf_counter()
+            reload = ruleset.compile(ipfw_rules.parse_table_list("\n".join(sim.run(["table", "all", "list"]))))
+            compile_sec = time.perf_counter() - start
+        state = json.dumps(sim.state())
+        failed, wrong_steps, wrong, wrong_after = replay_reload(sim, reload, probes)
+
+        # Same reload on fake ipfw processes, legacy one process per command
+        state_dir = tempfile.mkdtemp(prefix="um_bench_")
+        env = dict(os.environ, FAKE_IPFW_STATE=os.path.join(state_dir, "fake_ipfw.state"),
+                   FAKE_IPFW_LOG=os.devnull, FAKE_IPFW_DELAY=str(args.fork_delay))
+        with open(env["FAKE_IPFW_STATE"], 'w') as state_file:
+            state_file.write(state)
+        start = time.perf_counter()
+        if name == "legacy":
+            for command in reload:
+                subprocess.run([sys.executable, args.ipfw, "-q"] + command.split(), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            invocations = len(reload)
+        else:
+            command_path = os.path.join(state_dir, "ipfw_rules.cmd")
+            with open(command_path, 'w') as command_file:
+                command_file.write("\n".join(reload) + "\n")
+            subprocess.run([sys.executable, args.ipfw, "-q", command_path], env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            invocations = 1
+        elapsed = time.perf_counter() - start
+
+        cases[name] = {"commands": len(reload), "ipfw_invocations": invocations, "failed_commands": failed,
+                       "seconds": elapsed, "reload_ms": elapsed * 1000,
+                       "compile_ms": compile_sec * 1000,
+                       "wrong_verdict_commands": wrong_steps, "wrong_verdicts": wrong, "wrong_after_reload": wrong_after,
+                       "learned_entries_kept": len(sim.tables.get("fwdlist", {})),
+                       "strict_rules_kept": len([rule for rule in sim.rules if rule[0] == 4060])}
+    result.update(cases)
+    result["speedup"] = cases["legacy"]["seconds"] / cases["compiled"]["seconds"]
+    return result
+
+
+def bench_counters(args):
+    """
+    Rule counter sampling against log rule syslog volume for same traffic
+    strict hosts add rule pairs, every interval classifies random traffic
+    on simulated ipfw, then one sample reads all counters
+    """
+    variables = {"pif": "ext0", "bif": "bridge0", "dmzip": "192.168.10.84", "int_subnet": "192.168.10.0/24",
+                 "router_gw": "192.168.10.1", "gateway_subnet": "192.168.1.0/24", "gateway": "192.168.1.1",
+                 "satelite_ip": "192.168.1.1", "router_manage_client": "192.168.10.0/24", "routeraddr": "203.0.113.2"}
+    ruleset = ipfw_rules.IPFWRuleset(ipfw_rules.load_description(args.ruleset), variables)
+    backend = um_firewall.IPFWSimBackend(delay=args.fork_delay)
+    sim = backend.sim
+    for command in ruleset.compile(flush=True):
+        sim.run(command.split())
+    hosts = ["192.168.{subnet}.{idx}".format(subnet=20 + i // 254, idx=i % 254 + 1) for i in range(args.strict_hosts)]
+    for idx, host in enumerate(hosts, 1):
+        sim.run("table strict_hosts_list add {host} {num}".format(host=host, num=4000 + idx).split())
+        sim.run("table t{idx:03d} create type addr".format(idx=idx).split())
+        sim.run("table t{idx:03d} add 198.18.{a}.{b}".format(idx=idx, a=idx >> 8, b=idx & 255).split())
+        sim.run("add {num} skipto 502 ip from {host} to table(t{idx:03d}) via bridge0".format(num=4000 + idx, host=host, idx=idx).split())
+        sim.run("add {num} deny ip from {host} to not table(t{idx:03d}) via bridge0".format(num=4000 + idx, host=host, idx=idx).split())
+    for idx in range(2, 30):
+        sim.run("table blocklist add 192.168.10.{idx}".format(idx=idx).split())
+    log_rules = set(rule[0] for rule in sim.rules if " log " in " " + rule[1] + " ")
+
+    batch = um_firewall.IPFWBatch()
+    batch.backend = backend
+    counters = um_firewall.IPFWCounters(batch)
+    counters.interval = args.interval
+    counters.sample()
+
+    rnd = random.Random(1)
+    lan = ["192.168.10.{idx}".format(idx=idx) for idx in range(2, 254)]
+    latencies = []
+    syslog_bytes = 0
+    log_lines = 0
+    rule_bytes = 0
+    table_bytes = 0
+    for i in range(args.intervals):
+        for k in range(args.packets):
+            kind = rnd.random()
+            if kind < 0.5:
+                packet = (rnd.choice(lan), "8.8.{a}.{b}".format(a=rnd.randrange(256), b=rnd.randrange(256)), "tcp", 443, "bridge0", "in")
+            elif kind < 0.8 and hosts:
+                idx = rnd.randrange(len(hosts))
+                dst = "198.18.{a}.{b}".format(a=(idx + 1) >> 8, b=(idx + 1) & 255) if rnd.random() < 0.7 else "203.0.113.9"
+                packet = (hosts[idx], dst, "tcp", 443, "bridge0", "in")
+            else:
+                packet = ("203.0.113.2", "198.51.100.{b}".format(b=rnd.randrange(256)), "tcp", rnd.choice([6881, 3389, 5060]), "ext0", "out")
+            src, dst, proto, dport, iface, direction = packet
+            rule_num, action = sim.match(src, dst, proto, dport, iface, direction)
+            if rule_num in log_rules:
+                # What ipfw logs to security.* for every hit of a log rule
+                syslog_bytes += len("Oct 18 12:00:00 router kernel: ipfw: {num} {action} TCP {src}:{sport} {dst}:{dport} {direction} via {iface}\n".format(
+                    num=rule_num, action=action.capitalize(), src=src, sport=rnd.randrange(1024, 65536), dst=dst, dport=dport,
+                    direction=direction, iface=iface))
+                log_lines += 1
+        start = time.perf_counter()
+        counters.sample()
+        latencies.append(time.perf_counter() - start)
+        rule_bytes += len(json.dumps(counters.rule_counters(1, counters.layout_id), separators=(',', ':')))
+        table_bytes += len(json.dumps(counters.table_counters(1), separators=(',', ':')))
+
+    # Client keeps rule texts, fetched again only when layout changes
+    layout_bytes = len(json.dumps(counters.rule_counters(1), separators=(',', ':'))) - rule_bytes / args.intervals
+    hot = counters.hot_rules(top=5)
+    sample = latency_summary(latencies)
+    sample.update({"rules": len(counters.layout), "samples": len(counters.samples)})
+    return {"benchmark": "counters", "fork_delay": args.fork_delay, "strict_hosts": len(hosts),
+            "packets_per_interval": args.packets, "intervals": args.intervals, "sample": sample,
+            "syslog": {"log_rules": len(log_rules), "lines_per_interval": log_lines / args.intervals,
+                       "bytes_per_interval": syslog_bytes / args.intervals},
+            "telemetry": {"layout_bytes": layout_bytes,
+                          "rule_counters_bytes_per_interval": rule_bytes / args.intervals,
+                          "table_counters_bytes_per_interval": table_bytes / args.intervals,
+                          "rule_counters_to_syslog_ratio": rule_bytes / max(1, syslog_bytes),
+                          "table_counters_to_syslog_ratio": table_bytes / max(1, syslog_bytes)},
+            "hot": [entry["rule"] for entry in hot["hot"]], "dead_rules": len(hot["dead"])}
+
+
+def bench_list_scaling(args):
+    """
+    List latency of cached and kernel reads against table size
+    """
+    url = start_local_server(args)
+    client = APIClient(url, args.psk)
+    result = {"benchmark": "list_scaling", "backend": args.backend, "fork_delay": args.fork_delay,
+              "samples": args.samples, "sizes": {}}
+    size = 0
+    for target in sorted(int(size) for size in args.sizes.split(",")):
+        while size < target:
+            chunk = min(args.chunk, target - size)
+            client.call("POST", "/add_bulk_ip", table="blocklist",
+                        ip_addrs=["10.{a}.{b}.{c}".format(a=(i >> 16) & 255, b=(i >> 8) & 255, c=i & 255)
+                                  for i in range(size, size + chunk)])
+            size += chunk
+
+        cases = [("list", "/list_block_src_ip", {}),
+                 ("stream", "/stream_table", {"table": "blocklist"}),
+                 ("stream_kernel", "/stream_table", {"table": "blocklist", "kernel": True})]
+        size_result = {"entries": len(um_firewall.g_ipfw_cache.list("blocklist"))}
+        for name, path, fields in cases:
+            latencies = []
+            for i in range(args.samples):
+                status, data, elapsed = client.call("GET", path, **fields)
+                latencies.append(elapsed)
+            summary = latency_summary(latencies)
+            summary["us_per_entry"] = summary["p50_ms"] * 1000 / max(1, target)
+            size_result[name] = summary
+        result["sizes"][str(target)] = size_result
+    client.close()
+    return result
+
+
+def compare_results(baseline, current, tolerance, path="", regressions=None):
+    """
+    Walk results and collect metrics worse than baseline by more than tolerance,
+    *_per_sec higher is better, *_ms, us_per_* and seconds lower is better
+    """
+    if regressions is None:
+        regressions = []
+    for key, value in current.items():
+        name = "{path}.{key}".format(path=path, key=key) if path else key
+        base = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare_results(base, value, tolerance, name, regressions)
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or not isinstance(base, (int, float)) or base <= 0:
+            continue
+        if key.endswith("_per_sec"):
+            change = (base - value) / base
+        elif key.endswith("_ms") or key.startswith("us_per_") or key == "seconds":
+            change = (value - base) / base
+        else:
+            continue
+        if change > tolerance:
+            regressions.append({"metric": name, "baseline": base, "current": value, "change": change})
+    return regressions
+
+
+def bench_suite(args):
+    """
+    Run benchmark cases in separate processes, compare with baseline results
+    """
+    common = ["--backend", args.backend, "--fork-delay", str(args.fork_delay)]
+    cases = [
+        ("parser", ["parser", "--lines", "100000"]),
+        ("endpoints", ["endpoints", "--requests", "200"] + common),
+        ("burst", ["burst", "--ips", "10000"] + common),
+        ("priority", ["priority", "--ips", "3000"] + common),
+        ("strict", ["strict", "--hosts", "254"] + common),
+        ("common", ["common", "--threshold", "0"] + common),
+        ("common_shared", ["common", "--threshold", "8"] + common),
+        ("domains", ["domains", "--domains", "500"] + common),
+        ("leases", ["leases", "--devices", "5000"] + common),
+        ("reload", ["reload", "--fork-delay", str(args.fork_delay)]),
+        ("counters", ["counters", "--fork-delay", str(args.fork_delay)]),
+        ("list_scaling", ["list_scaling", "--sizes", "100,1000,10000,50000"] + common),
+        ("load", ["load", "--requests", "2000"] + common),
+        ("aggregate", ["aggregate"]),
+        ("restore", ["restore", "--entries", "100000"]),
+        ("auth", ["auth"]),
+    ]
+    selected = args.cases.split(",") if args.cases else [name for name, argv in cases]
+
+    try:
+        version = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode("utf-8").strip()
+    except OSError:
+        version = ""
+    result = {"benchmark": "suite", "version": version or "unknown", "python": sys.version.split()[0],
+              "platform": sys.platform, "time": int(time.time()), "results": {}}
+    for name, argv in cases:
+        if name not in selected:
+            continue
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__)] + argv,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            result["results"][name] = json.loads(proc.stdout)
+        except ValueError:
+            result["results"][name] = {"error": proc.stderr.decode("utf-8", "replace")[-2000:]}
+
+    failed = [name for name, case in result["results"].items() if "error" in case]
+    if failed:
+        result["error"] = "failed cases: {names}".format(names=", ".join(failed))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        result["baseline"] = baseline.get("version", "unknown")
+        result["regressions"] = compare_results(baseline.get("results", {}), result["results"], args.tolerance)
+    return result
+
+
+def add_server_arguments(sub_parser):
+    """
+    Arguments of benchmarks running local um_firewall on fake ipfw
+    """
+    sub_parser.add_argument("--psk", default="")
+    sub_parser.add_argument("--workers", type=int, default=8)
+    sub_parser.add_argument("--backend", choices=["sim", "batch", "cli"], default="sim")
+    sub_parser.add_argument("--ipfw", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ipfw.py"))
+    sub_parser.add_argument("--fork-delay", type=float, default=0.005)
+
+
+def main(argv):
+    arg_parser = argparse.ArgumentParser(description="Umbrella Dynamic Firewall benchmarks")
+    arg_parser.add_argument("--output", help="also write result json to file")
+    sub_parsers = arg_parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_bench = sub_parsers.add_parser("parser", help="ipfw table list parser")
+    parser_bench.add_argument("--lines", type=int, default=100000)
+    parser_bench.set_defaults(func=bench_parser)
+
+    load_bench = sub_parsers.add_parser("load", help="concurrent REST API load")
+    load_bench.add_argument("--url", help="running um_firewall, default start one locally")
+    load_bench.add_argument("--psk", default="")
+    load_bench.add_argument("--concurrency", type=int, default=16)
+    load_bench.add_argument("--requests", type=int, default=2000)
+    load_bench.add_argument("--read-ratio", type=float, default=0.5)
+    load_bench.add_argument("--workers", type=int, default=8)
+    load_bench.add_argument("--backend", choices=["sim", "batch", "cli"], default="sim")
+    load_bench.add_argument("--ipfw", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ipfw.py"))
+    load_bench.add_argument("--fork-delay", type=float, default=0.005)
+    load_bench.set_defaults(func=bench_load)
+
+    tls_bench = sub_parsers.add_parser("tls", help="TLS handshake, session resumption and keep-alive")
+    tls_bench.add_argument("--requests", type=int, default=500)
+    tls_bench.add_argument("--workers", type=int, default=8)
+    tls_bench.set_defaults(func=bench_tls)
+
+    aggregate_bench = sub_parsers.add_parser("aggregate", help="CIDR aggregation of learned targets")
+    aggregate_bench.add_argument("--blocks", type=int, default=200)
+    aggregate_bench.add_argument("--sparse", type=int, default=5000)
+    aggregate_bench.add_argument("--fill", type=float, default=0.9)
+    aggregate_bench.add_argument("--prefixlen", type=int, default=24)
+    aggregate_bench.set_defaults(func=bench_aggregate)
+
+    restore_bench = sub_parsers.add_parser("restore", help="warm restart from journal")
+    restore_bench.add_argument("--entries", type=int, default=100000)
+    restore_bench.add_argument("--strict-hosts", type=int, default=100)
+    restore_bench.add_argument("--replay-sample", type=int, default=100)
+    restore_bench.add_argument("--backend", choices=["sim", "batch", "cli"], default="batch")
+    restore_bench.add_argument("--ipfw", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ipfw.py"))
+    restore_bench.add_argument("--fork-delay", type=float, default=0.005)
+    restore_bench.set_defaults(func=bench_restore)
+
+    auth_bench = sub_parsers.add_parser("auth", help="authentication and argument parsing per request")
+    auth_bench.add_argument("--requests", type=int, default=20000)
+    auth_bench.set_defaults(func=bench_auth)
+
+    endpoints_bench = sub_parsers.add_parser("endpoints", help="single add/delete/list per endpoint")
+    endpoints_bench.add_argument("--requests", type=int, default=200)
+    add_server_arguments(endpoints_bench)
+    endpoints_bench.set_defaults(func=bench_endpoints)
+
+    burst_bench = sub_parsers.add_parser("burst", help="burst ingestion of DNS derived IPs")
+    burst_bench.add_argument("--ips", type=int, default=10000)
+    burst_bench.add_argument("--concurrency", type=int, default=32)
+    add_server_arguments(burst_bench)
+    burst_bench.set_defaults(func=bench_burst)
+
+    priority_bench = sub_parsers.add_parser("priority", help="block requests during learning burst")
+    priority_bench.add_argument("--ips", type=int, default=3000)
+    priority_bench.add_argument("--concurrency", type=int, default=6)
+    priority_bench.add_argument("--interval", type=float, default=0.05)
+    priority_bench.add_argument("--bulk-rate", type=int, default=0)
+    priority_bench.add_argument("--max-queue", type=int, default=10000)
+    priority_bench.add_argument("--no-priority", action="store_true")
+    add_server_arguments(priority_bench)
+    priority_bench.set_defaults(func=bench_priority)
+
+    strict_bench = sub_parsers.add_parser("strict", help="strict host provisioning")
+    strict_bench.add_argument("--hosts", type=int, default=254)
+    strict_bench.add_argument("--concurrency", type=int, default=1)
+    add_server_arguments(strict_bench)
+    strict_bench.set_defaults(func=bench_strict)
+
+    common_bench = sub_parsers.add_parser("common", help="targets shared by strict hosts")
+    common_bench.add_argument("--hosts", type=int, default=50)
+    common_bench.add_argument("--targets", type=int, default=200)
+    common_bench.add_argument("--private", type=int, default=20)
+    common_bench.add_argument("--threshold", type=int, default=0)
+    common_bench.add_argument("--concurrency", type=int, default=8)
+    add_server_arguments(common_bench)
+    common_bench.set_defaults(func=bench_common)
+
+    domains_bench = sub_parsers.add_parser("domains", help="domain owned targets, learn and revoke")
+    domains_bench.add_argument("--domains", type=int, default=500)
+    domains_bench.add_argument("--ips", type=int, default=8)
+    domains_bench.add_argument("--pool", type=int, default=1000)
+    domains_bench.add_argument("--concurrency", type=int, default=8)
+    add_server_arguments(domains_bench)
+    domains_bench.set_defaults(func=bench_domains)
+
+    leases_bench = sub_parsers.add_parser("leases", help="MAC blocks following devices across DHCP leases")
+    leases_bench.add_argument("--devices", type=int, default=5000)
+    leases_bench.add_argument("--blocked", type=int, default=500)
+    leases_bench.add_argument("--moves", type=int, default=50)
+    leases_bench.add_argument("--rounds", type=int, default=20)
+    add_server_arguments(leases_bench)
+    leases_bench.set_defaults(func=bench_leases)
+
+    reload_bench = sub_parsers.add_parser("reload", help="static ruleset reload, flush based against set swap")
+    reload_bench.add_argument("--entries", type=int, default=1000)
+    reload_bench.add_argument("--ruleset", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf", "ipfw_rules.conf"))
+    reload_bench.add_argument("--ipfw", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_ipfw.py"))
+    reload_bench.add_argument("--fork-delay", type=float, default=0.005)
+    reload_bench.set_defaults(func=bench_reload)
+
+    counters_bench = sub_parsers.add_parser("counters", help="rule counter sampling against log rule syslog volume")
+    counters_bench.add_argument("--strict-hosts", type=int, default=500)
+    counters_bench.add_argument("--packets", type=int, default=5000)
+    counters_bench.add_argument("--intervals", type=int, default=10)
+    counters_bench.add_argument("--interval", type=float, default=10)
+    counters_bench.add_argument("--ruleset", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "conf", "ipfw_rules.conf"))
+    counters_bench.add_argument("--fork-delay", type=float, default=0.005)
+    counters_bench.set_defaults(func=bench_counters)
+
+    list_bench = sub_parsers.add_parser("list_scaling", help="list latency against table size")
+    list_bench.add_argument("--sizes", default="100,1000,10000,50000")
+    list_bench.add_argument("--samples", type=int, default=20)
+    list_bench.add_argument("--chunk", type=int, default=1000)
+    add_server_arguments(list_bench)
+    list_bench.set_defaults(func=bench_list_scaling)
+
+    suite_bench = sub_parsers.add_parser("suite", help="run benchmarks, compare with baseline results")
+    suite_bench.add_argument("--cases", help="comma separated benchmarks, default all")
+    suite_bench.add_argument("--baseline", help="results json of previous release")
+    suite_bench.add_argument("--tolerance", type=float, default=0.2)
+    suite_bench.add_argument("--backend", choices=["sim", "batch", "cli"], default="sim")
+    suite_bench.add_argument("--fork-delay", type=float, default=0.005)
+    suite_bench.set_defaults(func=bench_suite)
+
+    args = arg_parser.parse_args(argv)
+    result = args.func(args)
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(result, output_file, indent=4)
+    if result.get("regressions") or result.get("error"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
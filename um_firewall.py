@@ -43,290 +43,3736 @@
 #   regex match in Fedora Bunker for domain name direct bypass GFW
 #   ipfw table fwdlist
 import os
+import array
+import bisect
+import calendar
+import heapq
+import hashlib
+import hmac
+import ipaddress
+import io
 import json
+import logging
+import logging.handlers
+import math
+import queue
 import subprocess
 import re
+import selectors
+import socket
+import ssl
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-from flask import Flask
-from flask_restful import reqparse, Resource, Api
+from flask import Flask, Response, g, request, stream_with_context
+from flask_restful import inputs, reqparse, Resource, Api
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler, generate_adhoc_ssl_context
+
+try:
+    from ipfw_sim import IPFWSimulator, IPFWSimError
+except ImportError:
+    IPFWSimulator = None
 
 g_dummy_test = False
 # Basic preshared key based authentication
 g_psk = None
+g_logger = logging.getLogger("um_firewall")
 
 app = Flask(__name__)
 api = Api(app)
 
-# IPFWIntf direct opeate on ipfw firewall command
-# This is the operating system kernel relevant part
-class IPFWIntf:
+# Request hooks run around every resource, metrics timer and PSK check
+# of write requests, globals they use are looked up per request
+@app.before_request
+def metrics_start():
+    """
+    Start request timer
+    """
+    g.metrics_start = time.perf_counter()
+
+@app.after_request
+def metrics_finish(response):
+    """
+    Count request per resource class with status and latency
+    """
+    view = app.view_functions.get(request.endpoint)
+    resource = getattr(view, "view_class", None)
+    g_metrics.observe_request(resource.__name__ if resource else "unknown", response.status_code,
+                              time.perf_counter() - g.metrics_start)
+    return response
+
+@app.before_request
+def authenticate():
+    """
+    Authenticate write requests once, before any resource parses them
+    """
+    if not g_psk or request.method not in ("POST", "PUT"):
+        return None
+    if g_psk_auth.check(g_psk):
+        return None
+    g_metrics.auth_failure()
+    return {request.path.strip("/"): "authentication failed"}
+
+def log_extra(**fields):
+    """
+    Structured fields of log record, logger.info("event", extra=log_extra(key=value))
+    """
+    return {"fields": fields}
+
+# StructuredFormatter event message followed by key=value fields,
+# values json encoded so one record always stays on one line
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        """
+        Format record as "time level event key=value ..."
+        """
+        line = "{time} {level} {msg}".format(time=self.formatTime(record), level=record.levelname, msg=record.getMessage())
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += " " + " ".join("{key}={value}".format(key=key, value=json.dumps(value, default=str)) for key, value in fields.items())
+        return line
+
+# BatchStreamHandler stream handler without flush per record,
+# AsyncLogHandler flushes once per batch
+class BatchStreamHandler(logging.StreamHandler):
+    def emit(self, record):
+        """
+        Write record without flush
+        """
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+# AsyncLogHandler hot path only rate limits and queues the record,
+# background writer formats and hands records to target handler in batches
+#
+# Each event message is one rate limit key, records over rate_limit
+# within rate_interval are suppressed and reported as count later,
+# records over full queue dropped and counted as well
+class AsyncLogHandler(logging.Handler):
+    def __init__(self, target, rate_limit=20, rate_interval=1.0, max_queue=10000, max_batch=256):
+        """
+        Async log handler initialization
+        """
+        super().__init__()
+        self.target = target
+        self.rate_limit = rate_limit
+        self.rate_interval = rate_interval
+        self.max_batch = max_batch
+        self.queue = queue.Queue(max_queue)
+        self.rate = {}
+        self.suppressed = {}
+        self.dropped = 0
+        self.last_report = time.monotonic()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def emit(self, record):
+        """
+        Rate limit and queue record, never block on output
+        """
+        now = time.monotonic()
+        window = self.rate.get(record.msg)
+        if window is None or now - window[0] >= self.rate_interval:
+            window = self.rate[record.msg] = [now, 0]
+        window[1] += 1
+        if self.rate_limit and window[1] > self.rate_limit:
+            self.suppressed[record.msg] = self.suppressed.get(record.msg, 0) + 1
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        """
+        Log writer, drain queue in batches and flush target once per batch
+        """
+        stopped = False
+        while not stopped:
+            records = [self.queue.get()]
+            while len(records) < self.max_batch and records[-1] is not None:
+                try:
+                    records.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in records:
+                if record is None:
+                    stopped = True
+                else:
+                    self.target.handle(record)
+            for record in records:
+                self.queue.task_done()
+
+            now = time.monotonic()
+            if now - self.last_report >= self.rate_interval and (self.suppressed or self.dropped):
+                with self.lock:
+                    suppressed = self.suppressed
+                    self.suppressed = {}
+                    dropped = self.dropped
+                    self.dropped = 0
+                self.last_report = now
+                for msg, count in suppressed.items():
+                    self.target.handle(logging.makeLogRecord({"name": g_logger.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                                                              "msg": "log records suppressed", "fields": {"event": msg, "count": count}}))
+                if dropped:
+                    self.target.handle(logging.makeLogRecord({"name": g_logger.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                                                              "msg": "log records dropped", "fields": {"count": dropped}}))
+            self.target.flush()
+
+    def flush(self):
+        """
+        Wait for queued records written, called by logging.shutdown at exit
+        """
+        self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        """
+        Stop writer after queued records written, None is the stop sentinel
+        """
+        if self.worker.is_alive():
+            self.queue.put(None)
+            self.worker.join()
+        self.target.close()
+        super().close()
+
+def setup_logging(level="INFO", syslog=None, rate_limit=20):
+    """
+    Log to stdout, or syslog socket e.g. /var/run/log, through async handler
+    """
+    if syslog:
+        target = logging.handlers.SysLogHandler(address=syslog)
+    else:
+        target = BatchStreamHandler(sys.stdout)
+    target.setFormatter(StructuredFormatter())
+    for handler in list(g_logger.handlers):
+        g_logger.removeHandler(handler)
+        handler.flush()
+        handler.close()
+    g_logger.addHandler(AsyncLogHandler(target, rate_limit))
+    g_logger.setLevel(level)
+    g_logger.propagate = False
+
+# MetricHistogram fixed bucket histogram, bucket counters allocated once
+# observe only increments integers, no lock, a lost increment under
+# contention is acceptable for monitoring
+class MetricHistogram:
+    def __init__(self, buckets):
+        """
+        Metric histogram initialization, buckets are sorted upper bounds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+
+    def observe(self, value):
+        """
+        Count one observation
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def render(self, name, labels, lines):
+        """
+        Append Prometheus text lines of histogram, labels as 'key="value",'
+        """
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{name}_bucket{{{labels}le="{bound}"}} {count}'.format(name=name, labels=labels, bound=bound, count=cumulative))
+        cumulative += self.counts[-1]
+        lines.append('{name}_bucket{{{labels}le="+Inf"}} {count}'.format(name=name, labels=labels, count=cumulative))
+        labels = "{{{labels}}}".format(labels=labels.rstrip(",")) if labels else ""
+        lines.append('{name}_sum{labels} {total}'.format(name=name, labels=labels, total=self.total))
+        lines.append('{name}_count{labels} {count}'.format(name=name, labels=labels, count=cumulative))
+
+# Metrics of REST requests and ipfw processes, rendered on /metrics
+# series created on first use, afterwards only integers updated
+class Metrics:
+    latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    batch_buckets = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
     def __init__(self):
         """
-        IPFW intf initialization
+        Metrics initialization
         """
-        self.ip_addr_filter = re.compile("(\d+\.\d+\.\d+\.\d+\/\d+)", re.IGNORECASE)
+        self.requests = {}
+        self.request_latency = {}
+        self.ipfw_duration = {}
+        self.batch_size = MetricHistogram(self.batch_buckets)
+        self.queue_wait = {}
+        self.auth_failures = 0
+        self.throttled = {}
 
-    def list_src_ip(self):
+    def observe_request(self, resource, code, seconds):
+        """
+        Count request of resource class with status code and latency
+        """
+        key = (resource, code)
+        self.requests[key] = self.requests.get(key, 0) + 1
+        histogram = self.request_latency.get(resource)
+        if histogram is None:
+            histogram = self.request_latency.setdefault(resource, MetricHistogram(self.latency_buckets))
+        histogram.observe(seconds)
+
+    def observe_ipfw(self, kind, seconds):
+        """
+        Count one ipfw process with its duration
+        """
+        histogram = self.ipfw_duration.get(kind)
+        if histogram is None:
+            histogram = self.ipfw_duration.setdefault(kind, MetricHistogram(self.latency_buckets))
+        histogram.observe(seconds)
+
+    def observe_queue_wait(self, priority, seconds):
+        """
+        Observe time command of priority class waited for its batch
+        """
+        histogram = self.queue_wait.get(priority)
+        if histogram is None:
+            histogram = self.queue_wait.setdefault(priority, MetricHistogram(self.latency_buckets))
+        histogram.observe(seconds)
+
+    def throttle(self, tbl):
+        """
+        Count learning request of table refused by admission control
+        """
+        self.throttled[tbl] = self.throttled.get(tbl, 0) + 1
+
+    def auth_failure(self):
+        """
+        Count request rejected by preshared key
+        """
+        self.auth_failures += 1
+
+    def render(self, gauges):
+        """
+        Return Prometheus text format, gauges as {name: [(labels, value)]}
+        """
+        lines = ["# TYPE um_firewall_requests_total counter"]
+        for (resource, code), count in sorted(self.requests.items()):
+            lines.append('um_firewall_requests_total{{resource="{resource}",code="{code}"}} {count}'.format(resource=resource, code=code, count=count))
+        lines.append("# TYPE um_firewall_request_duration_seconds histogram")
+        for resource, histogram in sorted(self.request_latency.items()):
+            histogram.render("um_firewall_request_duration_seconds", 'resource="{resource}",'.format(resource=resource), lines)
+        lines.append("# TYPE um_firewall_ipfw_duration_seconds histogram")
+        for kind, histogram in sorted(self.ipfw_duration.items()):
+            histogram.render("um_firewall_ipfw_duration_seconds", 'kind="{kind}",'.format(kind=kind), lines)
+        lines.append("# TYPE um_firewall_ipfw_queue_wait_seconds histogram")
+        for priority, histogram in sorted(self.queue_wait.items()):
+            histogram.render("um_firewall_ipfw_queue_wait_seconds", 'priority="{priority}",'.format(priority=priority), lines)
+        lines.append("# TYPE um_firewall_throttled_total counter")
+        for tbl, count in sorted(self.throttled.items()):
+            lines.append('um_firewall_throttled_total{{table="{table}"}} {count}'.format(table=tbl, count=count))
+        lines.append("# TYPE um_firewall_ipfw_batch_size histogram")
+        self.batch_size.render("um_firewall_ipfw_batch_size", "", lines)
+        lines.append("# TYPE um_firewall_auth_failures_total counter")
+        lines.append("um_firewall_auth_failures_total {count}".format(count=self.auth_failures))
+        for name, samples in gauges.items():
+            lines.append("# TYPE {name} gauge".format(name=name))
+            for labels, value in samples:
+                lines.append("{name}{labels} {value}".format(name=name, labels=labels, value=value))
+        return "\n".join(lines) + "\n"
+
+g_metrics = Metrics()
+
+# IPFWRequest single ipfw command queued into IPFWBatch
+# caller wait on done until the batch it belongs to finished
+# callback runs on batch worker in the order kernel applied commands
+class IPFWRequest:
+    def __init__(self, command, callback=None, priority="normal"):
+        """
+        IPFW request initialization
+        """
+        self.command = command
+        self.callback = callback
+        self.priority = priority
+        self.queued = time.perf_counter()
+        self.status = False
+        self.done = threading.Event()
+
+    def finish(self, status):
+        """
+        Set command status, run callback and wake up caller
+        """
+        self.status = status
+        if self.callback:
+            try:
+                self.callback(status)
+            except Exception as e:
+                g_logger.warning("ipfw request callback failed", extra=log_extra(command=self.command, error=str(e)))
+        self.done.set()
+
+    def wait(self):
+        """
+        Wait for batch finished and return command status
+        """
+        self.done.wait()
+        return self.status
+
+# IPFWProcessBackend reads kernel through ipfw processes,
+# shared by CLI and batch backends
+#
+# A backend applies commands in order and stops at the first failed one,
+# apply() returns number of commands applied before it, None if unknown
+class IPFWProcessBackend:
+    def __init__(self, ipfw_path="ipfw"):
+        """
+        IPFW process backend initialization
+        """
+        self.ipfw_path = ipfw_path
+
+    def list_rules(self):
+        """
+        Return "ipfw list" output
+        """
+        start = time.perf_counter()
+        proc = subprocess.run([self.ipfw_path, "list"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        g_metrics.observe_ipfw("list", time.perf_counter() - start)
+        return proc.stdout.decode("utf-8", "replace")
+
+    def list_counters(self):
+        """
+        Return "ipfw -a list" output, rules with packet and byte counters
+        """
+        start = time.perf_counter()
+        proc = subprocess.run([self.ipfw_path, "-a", "list"],
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        g_metrics.observe_ipfw("counters", time.perf_counter() - start)
+        return proc.stdout.decode("utf-8", "replace")
+
+    def stream_table(self, tbl):
+        """
+        Stream parsed entries of table or all tables as they are listed
+        """
+        start = time.perf_counter()
+        proc = subprocess.Popen([self.ipfw_path, "table", tbl, "list"],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for entry in parse_table_list(proc.stdout):
+                yield entry
+        finally:
+            proc.stdout.close()
+            proc.wait()
+            g_metrics.observe_ipfw("table_list", time.perf_counter() - start)
+
+# IPFWCLIBackend one ipfw process per command
+class IPFWCLIBackend(IPFWProcessBackend):
+    def apply(self, commands):
+        """
+        Apply commands one ipfw process each, until first failure
+        """
+        for idx, command in enumerate(commands):
+            start = time.perf_counter()
+            try:
+                proc = subprocess.run([self.ipfw_path, "-q"] + command.split(),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            except OSError as e:
+                g_logger.error("ipfw command failed", extra=log_extra(ipfw_path=self.ipfw_path, error=str(e)))
+                return idx
+            g_metrics.observe_ipfw("command", time.perf_counter() - start)
+            if proc.returncode != 0:
+                return idx
+        return len(commands)
+
+# IPFWBatchBackend all commands through one "ipfw -q /dev/stdin"
+#
+# ipfw read commands from file line by line, first failed line
+# terminate the whole process with "Line N: ..." on stderr
+class IPFWBatchBackend(IPFWProcessBackend):
+    def __init__(self, ipfw_path="ipfw"):
+        """
+        IPFW batch backend initialization
+        """
+        super().__init__(ipfw_path)
+        self.line_filter = re.compile(r"Line (\d+):")
+
+    def apply(self, commands):
+        """
+        Apply commands with single ipfw process, locate failed one from stderr
+        """
+        script = "".join(command + "\n" for command in commands)
+        start = time.perf_counter()
+        try:
+            proc = subprocess.run([self.ipfw_path, "-q", "/dev/stdin"],
+                                  input=script.encode("utf-8"),
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except OSError as e:
+            g_logger.error("ipfw batch failed", extra=log_extra(ipfw_path=self.ipfw_path, error=str(e)))
+            return None
+        g_metrics.observe_ipfw("batch", time.perf_counter() - start)
+
+        if proc.returncode == 0:
+            return len(commands)
+        line_match = self.line_filter.search(proc.stderr.decode("utf-8", "replace"))
+        if line_match and 1 <= int(line_match.group(1)) <= len(commands):
+            return int(line_match.group(1)) - 1
+        return None
+
+# IPFWSimBackend in-memory simulated ipfw, no FreeBSD needed
+# used by dummy test mode, benchmarks and regression tests
+# delay emulates fork/exec cost of one ipfw process per call
+class IPFWSimBackend:
+    def __init__(self, sim=None, delay=0):
+        """
+        IPFW simulated backend initialization
+        """
+        if IPFWSimulator is None:
+            raise RuntimeError("ipfw_sim.py not found next to um_firewall.py")
+        self.sim = sim or IPFWSimulator()
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def apply(self, commands):
+        """
+        Apply commands to simulator until first failure
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            for idx, command in enumerate(commands):
+                try:
+                    self.sim.run(command.split())
+                except IPFWSimError:
+                    return idx
+        return len(commands)
+
+    def list_rules(self):
+        """
+        Return "ipfw list" output of simulator
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            return "\n".join(self.sim.run(["list"])) + "\n"
+
+    def list_counters(self):
+        """
+        Return "ipfw -a list" output of simulator
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            return "\n".join(self.sim.run(["-a", "list"])) + "\n"
+
+    def stream_table(self, tbl):
+        """
+        Stream parsed entries of simulated table or all tables
+        """
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            try:
+                out = self.sim.run(["table", tbl, "list"])
+            except IPFWSimError:
+                out = []
+        return parse_table_list(io.BytesIO(("\n".join(out) + "\n").encode("ascii")))
+
+def make_backend(backend="batch", ipfw_path="ipfw"):
+    """
+    Create backend by name, batch, cli or sim
+    """
+    if backend == "cli":
+        return IPFWCLIBackend(ipfw_path)
+    if backend == "sim":
+        return IPFWSimBackend()
+    return IPFWBatchBackend(ipfw_path)
+
+# IPFWBatch gathers table mutations within a short time window
+# and hands them to backend together, the batch backend runs them
+# through one ipfw process
+#
+# commands before the failed one applied, failed one reported,
+# left commands resubmitted
+#
+# Commands queued per priority, critical ones end the window at once and
+# go first into next batch, normal before bulk learning. Commands of one
+# table always share priority, so per table order is kept
+class IPFWBatch:
+    priorities = ("critical", "normal", "bulk")
+
+    def __init__(self, backend=None, window=0.02, max_batch=1024):
+        """
+        IPFW batch initialization
+        """
+        self.backend = backend or IPFWBatchBackend()
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = {priority: [] for priority in self.priorities}
+        # Seconds per command of last batch, for queue drain estimate
+        self.command_seconds = 0.0
+        self.cond = threading.Condition()
+        self.worker = None
+        # Batch worker and bulk load never run ipfw concurrently
+        self.run_lock = threading.Lock()
+
+    def submit(self, commands, callbacks=None, priority="normal"):
+        """
+        Queue commands with priority and return IPFWRequest for each command
+        """
+        if callbacks is None:
+            callbacks = [None] * len(commands)
+        requests = [IPFWRequest(command, callback, priority) for command, callback in zip(commands, callbacks)]
+        with self.cond:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+            self.pending[priority].extend(requests)
+            self.cond.notify()
+        return requests
+
+    def queued(self, priority=None):
+        """
+        Number of commands of priority, or of all priorities, waiting for batch
+        """
+        with self.cond:
+            if priority is None:
+                return sum(len(pending) for pending in self.pending.values())
+            return len(self.pending[priority])
+
+    def drain_seconds(self, priority):
+        """
+        Estimated seconds until commands of priority queued now are applied
+        """
+        with self.cond:
+            ahead = sum(len(self.pending[level]) for level in self.priorities[:self.priorities.index(priority) + 1])
+            return (ahead // self.max_batch + 1) * self.window + ahead * self.command_seconds
+
+    def execute(self, command):
+        """
+        Execute one ipfw command within batch, return True if succeeded
+        """
+        return self.submit([command])[0].wait()
+
+    def execute_many(self, commands):
+        """
+        Execute ipfw commands in order within batch, return status list
+        """
+        return [request.wait() for request in self.submit(commands)]
+
+    def run(self):
+        """
+        Batch worker, collect pending commands and run them together
+        """
+        while True:
+            with self.cond:
+                while not any(self.pending.values()):
+                    self.cond.wait()
+                # Let the burst settle, more commands join the same batch
+                deadline = time.monotonic() + self.window
+                while not self.pending["critical"] and time.monotonic() < deadline:
+                    self.cond.wait(deadline - time.monotonic())
+                batch = []
+                for priority in self.priorities:
+                    taken = self.pending[priority][:self.max_batch - len(batch)]
+                    del self.pending[priority][:len(taken)]
+                    batch.extend(taken)
+            now = time.perf_counter()
+            for request in batch:
+                g_metrics.observe_queue_wait(request.priority, now - request.queued)
+            with self.run_lock:
+                start = time.perf_counter()
+                self.run_batch(batch)
+                self.command_seconds = (time.perf_counter() - start) / len(batch)
+
+    def load(self, commands, callbacks=None):
+        """
+        Run commands through single ipfw process on caller thread, for bulk restore
+        """
+        if callbacks is None:
+            callbacks = [None] * len(commands)
+        requests = [IPFWRequest(command, callback) for command, callback in zip(commands, callbacks)]
+        with self.run_lock:
+            self.run_batch(requests)
+        return [request.status for request in requests]
+
+    def run_batch(self, batch):
+        """
+        Run one batch through backend, set status per request
+        """
+        while batch:
+            g_metrics.batch_size.observe(len(batch))
+            applied = self.backend.apply([request.command for request in batch])
+            if applied is None:
+                # Not able to locate failed command, report whole batch failed
+                for request in batch:
+                    request.finish(False)
+                return
+
+            for request in batch[:applied]:
+                request.finish(True)
+            if applied < len(batch):
+                batch[applied].finish(False)
+            batch = batch[applied + 1:]
+
+# IPFWBusyError learning update refused by admission control,
+# answered with 429 and Retry-After seconds
+class IPFWBusyError(TooManyRequests):
+    def __init__(self, tbl, retry_after):
+        """
+        IPFW busy error initialization
+        """
+        super().__init__(retry_after=max(1, math.ceil(retry_after)))
+        self.data = {"result": "busy", "table": tbl, "retry_after": round(retry_after, 3)}
+
+# IPFWScheduler priority and admission of table updates in front of IPFWIntf
+# commands of critical tables (block/lockdown) jump the batch queue,
+# learning tables are bulk, everything else normal
+#
+# Learning adds admitted per table by token bucket of bulk_rate entries
+# per second, and refused with retry hint once max_queue bulk commands
+# wait for batch. Learned updates of aggregated/shared tables hold their
+# lock over kernel wait, run one group per table and requests arriving
+# meanwhile coalesced into next group
+class IPFWScheduler:
+    def __init__(self, batch):
+        """
+        IPFW scheduler initialization
+        """
+        self.batch = batch
+        # Disabled, all commands normal and every update admitted
+        self.enabled = True
+        self.critical_tables = {"blocklist", "tblocklist", "lockdownlist"}
+        self.bulk_tables = {"fwdlist", "dmzallowlist", "strict_common"}
+        self.bulk_tbl_filter = re.compile(r"^t\d+$")
+        # Entries per second per learning table, 0 unlimited, burst defaults to one second
+        self.bulk_rate = 0
+        self.bulk_burst = 0
+        self.max_queue = 10000
+        self.buckets = {}
+        self.groups = {}
+        self.tbl_locks = {}
+        self.lock = threading.Lock()
+        self.coalesced = {}
+
+    def priority(self, tbl):
+        """
+        Return batch priority of table commands
+        """
+        if not self.enabled:
+            return "normal"
+        if tbl in self.critical_tables:
+            return "critical"
+        if tbl in self.bulk_tables or self.bulk_tbl_filter.match(tbl):
+            return "bulk"
+        return "normal"
+
+    def admit(self, tbl, entries):
+        """
+        Admit learning add of entries into table, IPFWBusyError with retry hint if refused
+        """
+        if self.priority(tbl) != "bulk":
+            return
+        if self.max_queue and self.batch.queued("bulk") >= self.max_queue:
+            self.refuse(tbl, self.batch.drain_seconds("bulk"))
+        if not self.bulk_rate:
+            return
+        burst = self.bulk_burst or self.bulk_rate
+        # Request larger than bucket admitted once bucket full
+        cost = min(entries, burst)
+        with self.lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(tbl, (burst, now))
+            tokens = min(burst, tokens + (now - last) * self.bulk_rate)
+            if tokens >= cost:
+                self.buckets[tbl] = (tokens - cost, now)
+                return
+            self.buckets[tbl] = (tokens, now)
+        self.refuse(tbl, (cost - tokens) / self.bulk_rate)
+
+    def refuse(self, tbl, retry_after):
+        """
+        Count and raise refused learning update
+        """
+        g_metrics.throttle(tbl)
+        g_logger.debug("learning update throttled", extra=log_extra(table=tbl, retry_after=retry_after))
+        raise IPFWBusyError(tbl, retry_after)
+
+    def coalesce(self, key, ip_addrs, apply, *args):
+        """
+        Join pending group of key (table, op, ttl), group leader runs apply(ip_addrs, *args)
+        once previous group of table finished, return result of own addresses
+        """
+        with self.lock:
+            group = self.groups.get(key)
+            leader = group is None
+            if leader:
+                group = self.groups[key] = {"ip_addrs": [], "result": None, "done": threading.Event()}
+            else:
+                self.coalesced[key[0]] = self.coalesced.get(key[0], 0) + 1
+            group["ip_addrs"].extend(ip_addrs)
+            tbl_lock = self.tbl_locks.setdefault(key[0], threading.Lock())
+
+        if leader:
+            try:
+                with tbl_lock:
+                    # Later requests start next group
+                    with self.lock:
+                        del self.groups[key]
+                    group["result"] = apply(group["ip_addrs"], *args)
+            finally:
+                group["done"].set()
+        else:
+            group["done"].wait()
+
+        if group["result"] is None:
+            ip_results = {ip_addr: "failed" for ip_addr in ip_addrs}
+        else:
+            ip_results = {ip_addr: group["result"]["ip_results"][ip_addr] for ip_addr in ip_addrs}
+        return {"result": summarize_results(ip_results), "ip_results": ip_results}
+
+    def stats(self):
+        """
+        Coalesced requests per table
+        """
+        with self.lock:
+            return {tbl: {"coalesced": count} for tbl, count in self.coalesced.items()}
+
+def parse_ip_network(ip_addr):
+    """
+    Parse IPv4/IPv6 address or CIDR, None if malformed
+    IPv6 zone dropped, IPv4-mapped IPv6 taken as the IPv4 address it maps
+    """
+    try:
+        network = ipaddress.ip_network(ip_addr.strip().split("%")[0], strict=False)
+    except (ValueError, AttributeError):
+        return None
+    if network.version == 6 and network.prefixlen >= 96 and network.network_address.ipv4_mapped:
+        network = ipaddress.ip_network((network.network_address.ipv4_mapped, network.prefixlen - 96))
+    return network
+
+def normalize_ip_addr(ip_addr):
+    """
+    Normalize IP address/CIDR to the form ipfw lists it, None if malformed
+    """
+    network = parse_ip_network(ip_addr)
+    if network is None:
+        return None
+    return network.with_prefixlen
+
+def rule_addr(network):
+    """
+    Address as ipfw prints it within rule, host without prefix length
+    """
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return network.with_prefixlen
+
+def normalize_tbl_value(value):
+    """
+    Normalize table value, skipto 04005 listed by ipfw as 4005
+    """
+    if value.isdigit():
+        return str(int(value))
+    return value
+
+def parse_rule_counters(data):
+    """
+    Parse "ipfw -a list" output into [(rule_num, packets, bytes, body)], dynamic rules skipped
+    """
+    counters = []
+    for line in data.splitlines():
+        if line.startswith("## Dynamic rules"):
+            break
+        fields = line.split(None, 3)
+        if len(fields) == 4 and fields[0].isdigit() and fields[1].isdigit() and fields[2].isdigit():
+            counters.append((int(fields[0]), int(fields[1]), int(fields[2]), fields[3].strip()))
+    return counters
+
+def parse_table_list(stream, chunk_size=65536):
+    """
+    Parse "ipfw table NAME|all list" output from binary stream chunk by chunk
+    yield (table, ip_addr, value, family) as entries arrive
+    table header yields (table, None, None, None), empty table still reported
+
+    ipfw prints entries already normalized, no regex or ipaddress per line
+    """
+    tbl = None
+    remain = ""
+    while True:
+        chunk = stream.read(chunk_size)
+        if chunk:
+            lines = (remain + chunk.decode("ascii", "replace")).split("\n")
+            remain = lines.pop()
+        else:
+            lines = [remain]
+        for line in lines:
+            if not line:
+                continue
+            if line[0] == "-":
+                # --- table(fwdlist), set(0) ---
+                start = line.find("table(")
+                end = line.find(")", start)
+                if start >= 0 and end > start:
+                    tbl = line[start + 6:end]
+                    yield tbl, None, None, None
+                continue
+            if tbl is None:
+                continue
+            ip_addr, sep, value = line.strip().partition(" ")
+            if ":" in ip_addr:
+                family = "ipv6"
+                if "/" not in ip_addr:
+                    ip_addr += "/128"
+            elif "." in ip_addr:
+                family = "ipv4"
+                if "/" not in ip_addr:
+                    ip_addr += "/32"
+            else:
+                continue
+            value = value.strip() or "0"
+            if value.isdigit() and value[0] == "0" and value != "0":
+                value = str(int(value))
+            yield tbl, ip_addr, value, family
+        if not chunk:
+            break
+
+def summarize_results(ip_results):
+    """
+    Overall result of per address results
+    """
+    if ip_results and all(ip_result == "unchanged" for ip_result in ip_results.values()):
+        return "unchanged"
+    if any(ip_result not in ("success", "unchanged") for ip_result in ip_results.values()):
+        return "failed"
+    return "success"
+
+# IPFWAddressIndex IPv4 and IPv6 entries of one table within single
+# sorted array of integer keys, values in parallel array
+#   key = family << 136 | network address << 8 | prefix length
+# IPv4 sorts before IPv6, network before its more specific networks
+# exact lookup and dedupe by bisect O(log n), longest prefix match
+# O(p log n) over the p prefix lengths present in the table
+class IPFWAddressIndex:
+    def __init__(self):
+        """
+        IPFW address index initialization
+        """
+        self.keys = []
+        self.values = []
+        # Entries per prefix length of each family, IPv4 first
+        self.prefixlens = ({}, {})
+
+    @staticmethod
+    def key(network):
+        """
+        Integer key of network
+        """
+        return (network.version == 6) << 136 | int(network.network_address) << 8 | network.prefixlen
+
+    @staticmethod
+    def network(key):
+        """
+        Network of integer key
+        """
+        if key >> 136:
+            return ipaddress.IPv6Network(((key >> 8) & ((1 << 128) - 1), key & 255))
+        return ipaddress.IPv4Network((key >> 8, key & 255))
+
+    def find(self, key):
+        """
+        Position of key, -1 if absent
+        """
+        pos = bisect.bisect_left(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            return pos
+        return -1
+
+    def add(self, network, value="0"):
+        """
+        Add or update entry, return False if network already indexed
+        """
+        key = self.key(network)
+        pos = bisect.bisect_left(self.keys, key)
+        if pos < len(self.keys) and self.keys[pos] == key:
+            self.values[pos] = value
+            return False
+        self.keys.insert(pos, key)
+        self.values.insert(pos, value)
+        counts = self.prefixlens[network.version == 6]
+        counts[network.prefixlen] = counts.get(network.prefixlen, 0) + 1
+        return True
+
+    def discard(self, network):
+        """
+        Remove entry, return False if not indexed
+        """
+        pos = self.find(self.key(network))
+        if pos < 0:
+            return False
+        del self.keys[pos]
+        del self.values[pos]
+        counts = self.prefixlens[network.version == 6]
+        counts[network.prefixlen] -= 1
+        if not counts[network.prefixlen]:
+            del counts[network.prefixlen]
+        return True
+
+    def get(self, network):
+        """
+        Value of exact entry, None if not indexed
+        """
+        pos = self.find(self.key(network))
+        if pos < 0:
+            return None
+        return self.values[pos]
+
+    def match(self, network):
+        """
+        Longest prefix entry covering network, return (network, value) or (None, None)
+        """
+        for prefixlen in sorted(self.prefixlens[network.version == 6], reverse=True):
+            if prefixlen > network.prefixlen:
+                continue
+            candidate = network.supernet(new_prefix=prefixlen)
+            pos = self.find(self.key(candidate))
+            if pos >= 0:
+                return candidate, self.values[pos]
+        return None, None
+
+    def clear(self):
+        """
+        Remove all entries
+        """
+        self.keys = []
+        self.values = []
+        self.prefixlens = ({}, {})
+
+    def __len__(self):
+        return len(self.keys)
+
+# IPFWIDAllocator pool of IDs 1..size handed to entries of a skipto table,
+# entry value is rule number base + ID, so the table itself is the
+# persistent host to ID mapping, kept by kernel and journal
+# host to ID and ID to host in dicts O(1), freed IDs reused lowest first
+# from heap, never used IDs taken from high-water mark
+# IDs handed out only become used once entry added to cache
+class IPFWIDAllocator:
+    def __init__(self, base=4000, size=999):
+        """
+        IPFW ID allocator initialization
+        """
+        self.base = base
+        self.size = size
+        self.hosts = {}
+        self.owners = {}
+        self.free = []
+        self.next_id = 1
+
+    def configure(self, base, size):
+        """
+        Set rule number base and pool size, pool rules kept after static
+        rule 03999 and before nat rule 65000 of conf/ipfw_rules.conf,
+        allowed traffic falls through pool to accept rule 65001
+        """
+        if base < 3999 or size < 1 or base + size >= 65000:
+            raise ValueError("strict host pool {base}+{size} out of rule range".format(base=base, size=size))
+        self.base = base
+        self.size = size
+        self.clear()
+
+    def add(self, host, value):
+        """
+        Mark ID of entry value used by host, value outside pool or
+        already owned by another host ignored, re-adding host fixes it
+        """
+        self.discard(host)
+        if not value.isdigit() or not 0 < int(value) - self.base <= self.size:
+            return
+        strict_id = int(value) - self.base
+        if strict_id in self.owners:
+            return
+        self.hosts[host] = strict_id
+        self.owners[strict_id] = host
+
+    def discard(self, host):
+        """
+        Release ID of host
+        """
+        strict_id = self.hosts.pop(host, None)
+        if strict_id is None:
+            return
+        if self.owners.get(strict_id) == host:
+            del self.owners[strict_id]
+            if strict_id < self.next_id:
+                heapq.heappush(self.free, strict_id)
+
+    def lookup(self, host):
+        """
+        ID of host, None if host has no ID
+        """
+        return self.hosts.get(host)
+
+    def allocate(self):
+        """
+        Lowest freed ID, else next never used ID, None if pool exhausted
+        """
+        while self.free and self.free[0] in self.owners:
+            heapq.heappop(self.free)
+        if self.free:
+            return self.free[0]
+        while self.next_id in self.owners:
+            self.next_id += 1
+        if self.next_id > self.size:
+            return None
+        return self.next_id
+
+    def clear(self):
+        """
+        Release all IDs
+        """
+        self.hosts = {}
+        self.owners = {}
+        self.free = []
+        self.next_id = 1
+
+    def stats(self):
+        """
+        Pool size and IDs used
+        """
+        return {"rule_base": self.base, "pool_size": self.size, "ids_used": len(self.owners)}
+
+# IPFWTableCache in-process copy of ipfw tables
+# loaded once at startup, updated on every succeeded mutation,
+# reconciled with kernel on configured interval
+# list requests served from here without spawning ipfw
+class IPFWTableCache:
+    def __init__(self, batch):
+        """
+        IPFW table cache initialization
+        """
+        self.batch = batch
+        self.tables = {}
+        # Rule number to list of rule bodies, same rule number can hold rule pair
+        self.rules = {}
+        self.generation = 0
+        self.tbl_generation = {}
+        self.rule_generation = {}
+        self.lock = threading.RLock()
+        self.reconcile_interval = 300
+        self.reconciler = None
+        # Redundant mutations short-circuited and mutations issued per table
+        self.noop_hits = {}
+        self.noop_misses = {}
+        self.rule_filter = re.compile(r"^(\d+)\s+(.+)$")
+        self.journal = None
+        # Tables with address index for longest prefix lookups
+        self.indexes = {"strict_hosts_list": IPFWAddressIndex()}
+        # Skipto tables whose values are IDs handed out by allocator
+        self.allocators = {}
+
+    def read_rules(self):
+        """
+        Read static rules from kernel with single ipfw process
+        """
+        rules = {}
+        for line in self.batch.backend.list_rules().splitlines():
+            if line.startswith("## Dynamic rules"):
+                break
+            rule_match = self.rule_filter.match(line)
+            if rule_match:
+                rules.setdefault(int(rule_match.group(1)), []).append(rule_match.group(2).strip())
+        return rules
+
+    def read_kernel(self):
+        """
+        Read all tables from kernel with single ipfw process
+        """
+        tables = {}
+        for tbl, ip_addr, value, family in self.stream_kernel("all"):
+            entries = tables.setdefault(tbl, {})
+            if ip_addr:
+                entries[ip_addr] = value
+        return tables
+
+    def stream_kernel(self, tbl):
+        """
+        Stream entries of table or all tables from kernel as they are listed
+        """
+        return self.batch.backend.stream_table(tbl)
+
+    def load(self):
+        """
+        Load or reconcile cache with kernel tables
+        """
+        with self.lock:
+            start_generation = self.generation
+        try:
+            kernel_tables = self.read_kernel()
+            kernel_rules = self.read_rules()
+        except OSError as e:
+            g_logger.error("load ipfw tables failed", extra=log_extra(error=str(e)))
+            return False
+
+        with self.lock:
+            # Table updated while reading kernel is newer than kernel copy
+            for tbl in set(self.tables) | set(kernel_tables):
+                if self.tbl_generation.get(tbl, 0) > start_generation:
+                    continue
+                if tbl in kernel_tables:
+                    self.tables[tbl] = kernel_tables[tbl]
+                else:
+                    del self.tables[tbl]
+                self.reindex(tbl)
+            for rule_num in set(self.rules) | set(kernel_rules):
+                if self.rule_generation.get(rule_num, 0) > start_generation:
+                    continue
+                if rule_num in kernel_rules:
+                    self.rules[rule_num] = kernel_rules[rule_num]
+                else:
+                    del self.rules[rule_num]
+        return True
+
+    def start(self, reconcile_interval):
+        """
+        Load tables and start periodic reconcile with kernel
+        """
+        self.reconcile_interval = reconcile_interval
+        self.load()
+        if self.reconcile_interval > 0 and self.reconciler is None:
+            self.reconciler = threading.Thread(target=self.reconcile, daemon=True)
+            self.reconciler.start()
+
+    def reconcile(self):
+        """
+        Reconcile worker
+        """
+        while True:
+            time.sleep(self.reconcile_interval)
+            self.load()
+
+    def touch(self, tbl):
+        """
+        Mark table updated, caller holds lock
+        """
+        self.generation += 1
+        self.tbl_generation[tbl] = self.generation
+
+    def reindex(self, tbl):
+        """
+        Rebuild address index and allocator of table, caller holds lock
+        """
+        index = self.indexes.get(tbl)
+        if index is not None:
+            index.clear()
+            for ip_addr, value in self.tables.get(tbl, {}).items():
+                network = parse_ip_network(ip_addr)
+                if network is not None:
+                    index.add(network, value)
+        allocator = self.allocators.get(tbl)
+        if allocator is not None:
+            allocator.clear()
+            for ip_addr, value in self.tables.get(tbl, {}).items():
+                allocator.add(ip_addr, value)
+
+    def add(self, tbl, ip_addr, value="0"):
+        """
+        Add entry to cached table
+        """
+        with self.lock:
+            self.tables.setdefault(tbl, {})[ip_addr] = normalize_tbl_value(value)
+            self.touch(tbl)
+            network = parse_ip_network(ip_addr) if tbl in self.indexes else None
+            if network is not None:
+                self.indexes[tbl].add(network, normalize_tbl_value(value))
+            if tbl in self.allocators:
+                self.allocators[tbl].add(ip_addr, normalize_tbl_value(value))
+            if self.journal:
+                self.journal.append(["a", tbl, ip_addr, normalize_tbl_value(value)])
+
+    def delete(self, tbl, ip_addr):
+        """
+        Delete entry from cached table
+        """
+        with self.lock:
+            self.tables.get(tbl, {}).pop(ip_addr, None)
+            self.touch(tbl)
+            network = parse_ip_network(ip_addr) if tbl in self.indexes else None
+            if network is not None:
+                self.indexes[tbl].discard(network)
+            if tbl in self.allocators:
+                self.allocators[tbl].discard(ip_addr)
+            if self.journal:
+                self.journal.append(["d", tbl, ip_addr])
+
+    def create(self, tbl):
+        """
+        Create empty cached table
+        """
+        with self.lock:
+            self.tables.setdefault(tbl, {})
+            self.touch(tbl)
+            if self.journal:
+                self.journal.append(["c", tbl])
+
+    def flush(self, tbl):
+        """
+        Flush cached table
+        """
+        with self.lock:
+            if tbl in self.tables:
+                self.tables[tbl] = {}
+            self.touch(tbl)
+            self.reindex(tbl)
+            if self.journal:
+                self.journal.append(["f", tbl])
+
+    def destroy(self, tbl):
+        """
+        Destroy cached table
+        """
+        with self.lock:
+            self.tables.pop(tbl, None)
+            self.touch(tbl)
+            self.reindex(tbl)
+            if self.journal:
+                self.journal.append(["x", tbl])
+
+    def add_rule(self, rule_num, body):
+        """
+        Add rule body under rule number
+        """
+        with self.lock:
+            self.rules.setdefault(rule_num, []).append(body)
+            self.generation += 1
+            self.rule_generation[rule_num] = self.generation
+            if self.journal:
+                self.journal.append(["r", rule_num, self.rules[rule_num]])
+
+    def delete_rule(self, rule_num):
+        """
+        Delete all rules under rule number
+        """
+        with self.lock:
+            self.rules.pop(rule_num, None)
+            self.generation += 1
+            self.rule_generation[rule_num] = self.generation
+            if self.journal:
+                self.journal.append(["r", rule_num, []])
+
+    def get_rule(self, rule_num):
+        """
+        Return rule bodies under rule number
+        """
+        with self.lock:
+            return list(self.rules.get(rule_num, []))
+
+    def lookup(self, tbl, ip_addr):
+        """
+        Return value of entry, None if table or entry not existed
+        """
+        with self.lock:
+            return self.tables.get(tbl, {}).get(ip_addr)
+
+    def match(self, tbl, ip_addr):
+        """
+        Longest prefix entry of indexed table covering address, return (ip_addr, value) or (None, None)
+        """
+        network = parse_ip_network(ip_addr)
+        with self.lock:
+            index = self.indexes.get(tbl)
+            if network is None or index is None:
+                return None, None
+            entry, value = index.match(network)
+        if entry is None:
+            return None, None
+        return entry.with_prefixlen, value
+
+    def has_table(self, tbl):
+        """
+        Check table existed
+        """
+        with self.lock:
+            return tbl in self.tables
+
+    def check_noop(self, tbl, ip_addr, op, pending_op=None):
+        """
+        Check add of existed entry or delete of absent entry, count hit/miss
+        pending_op is the last queued but not finished op of the same entry
+        Table not known by cache never regarded as noop
+        """
+        with self.lock:
+            entries = self.tables.get(tbl)
+            noop = False
+            if pending_op is not None:
+                noop = pending_op == op
+            elif entries is not None:
+                if op == "add":
+                    noop = ip_addr in entries
+                else:
+                    noop = ip_addr not in entries
+            if noop:
+                self.noop_hits[tbl] = self.noop_hits.get(tbl, 0) + 1
+            else:
+                self.noop_misses[tbl] = self.noop_misses.get(tbl, 0) + 1
+            return noop
+
+    def stats(self):
+        """
+        Return size and noop hit/miss counters per table
+        """
+        with self.lock:
+            tbl_stats = {}
+            for tbl in set(self.tables) | set(self.noop_hits) | set(self.noop_misses):
+                tbl_stats[tbl] = {
+                    "size": len(self.tables.get(tbl, {})),
+                    "noop_hits": self.noop_hits.get(tbl, 0),
+                    "noop_misses": self.noop_misses.get(tbl, 0)
+                }
+            return tbl_stats
+
+    def stream(self, tbl, chunk_size=1024):
+        """
+        Yield (ip_addr, value, family) of table, copy chunk by chunk under lock
+        """
+        with self.lock:
+            ip_addrs = list(self.tables.get(tbl, {}))
+        for start in range(0, len(ip_addrs), chunk_size):
+            with self.lock:
+                entries = self.tables.get(tbl, {})
+                chunk = [(ip_addr, entries[ip_addr]) for ip_addr in ip_addrs[start:start + chunk_size] if ip_addr in entries]
+            for ip_addr, value in chunk:
+                yield ip_addr, value, "ipv6" if ":" in ip_addr else "ipv4"
+
+    def list(self, tbl):
+        """
+        Return list of (ip_addr, value) within table
+        """
+        with self.lock:
+            return list(self.tables.get(tbl, {}).items())
+
+    def snapshot(self, tbls, rule_nums):
+        """
+        Return copy of given tables and rules
+        """
+        with self.lock:
+            tables = {tbl: dict(self.tables[tbl]) for tbl in tbls if tbl in self.tables}
+            rules = {rule_num: list(self.rules[rule_num]) for rule_num in rule_nums if rule_num in self.rules}
+            return tables, rules
+
+# IPFWExpiry time-to-live of dynamically learned table entries
+# deadlines kept in heap, refreshed entry pushed again with new deadline
+# and stale heap items skipped when popped
+# expired entries removed per table in one batch
+class IPFWExpiry:
+    def __init__(self, delete):
+        """
+        IPFW expiry initialization, delete(ip_addrs, tbl) removes entries
+        """
+        self.delete = delete
+        self.heap = []
+        self.deadlines = {}
+        self.cond = threading.Condition()
+        self.worker = None
+        self.journal = None
+
+    def schedule(self, tbl, ip_addr, ttl):
+        """
+        Expire entry after ttl seconds, refresh only extends deadline
+        """
+        deadline = time.monotonic() + ttl
+        with self.cond:
+            if self.deadlines.get((tbl, ip_addr), 0) >= deadline:
+                return
+            self.deadlines[(tbl, ip_addr)] = deadline
+            heapq.heappush(self.heap, (deadline, tbl, ip_addr))
+            if self.journal:
+                self.journal.append(["t", tbl, ip_addr, time.time() + ttl])
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, daemon=True)
+                self.worker.start()
+            self.cond.notify()
+
+    def cancel(self, tbl, ip_addr):
+        """
+        Entry deleted or made permanent, no expiry
+        """
+        with self.cond:
+            if self.deadlines.pop((tbl, ip_addr), None) is not None and self.journal:
+                self.journal.append(["t", tbl, ip_addr, None])
+
+    def deadline(self, tbl, ip_addr):
+        """
+        Return monotonic deadline of entry, None if permanent
+        """
+        with self.cond:
+            return self.deadlines.get((tbl, ip_addr))
+
+    def cancel_tbl(self, tbl):
+        """
+        Table flushed or destroyed, no expiry for its entries
+        """
+        with self.cond:
+            for key in [key for key in self.deadlines if key[0] == tbl]:
+                del self.deadlines[key]
+
+    def snapshot(self):
+        """
+        Return list of (table, ip_addr, wall clock deadline)
+        """
+        with self.cond:
+            now = time.monotonic()
+            wall_now = time.time()
+            return [(tbl, ip_addr, wall_now + deadline - now) for (tbl, ip_addr), deadline in self.deadlines.items()]
+
+    def stats(self):
+        """
+        Return number of entries with ttl per table
+        """
+        with self.cond:
+            tbl_stats = {}
+            for tbl, ip_addr in self.deadlines:
+                tbl_stats[tbl] = tbl_stats.get(tbl, 0) + 1
+            return tbl_stats
+
+    def run(self):
+        """
+        Expiry worker, wait for earliest deadline and delete expired entries
+        """
+        while True:
+            expired = {}
+            with self.cond:
+                while not expired:
+                    now = time.monotonic()
+                    while self.heap and self.heap[0][0] <= now:
+                        deadline, tbl, ip_addr = heapq.heappop(self.heap)
+                        if self.deadlines.get((tbl, ip_addr)) == deadline:
+                            del self.deadlines[(tbl, ip_addr)]
+                            expired.setdefault(tbl, []).append(ip_addr)
+                    if expired:
+                        break
+                    if self.heap:
+                        self.cond.wait(self.heap[0][0] - now)
+                    else:
+                        self.cond.wait()
+            for tbl, ip_addrs in expired.items():
+                self.delete(ip_addrs, tbl)
+
+# IPFWAggregator collapse learned addresses of a table into the minimal
+# CIDR set covering exactly the same addresses, no aggregate shorter than
+# the configured max prefix (e.g. /24 for IPv4)
+#
+# Learned set kept per table in prefix buckets of max prefix size,
+# a change only recomputes its own bucket and diffs it against entries
+# applied to kernel, only the diff goes to ipfw
+class IPFWAggregator:
+    def __init__(self):
+        """
+        IPFW aggregator initialization
+        """
+        # Table name to IPv4 max prefix, t*** strict host tables share one
+        self.tbl_prefixlen = {}
+        self.strict_prefixlen = None
+        self.prefixlen6 = 64
+        self.learned = {}
+        self.applied = {}
+        self.lock = threading.Lock()
+        self.strict_tbl_filter = re.compile(r"^t\d+$")
+
+    def enabled(self, tbl):
+        """
+        Check table configured for aggregation
+        """
+        if tbl in self.tbl_prefixlen:
+            return True
+        return self.strict_prefixlen is not None and self.strict_tbl_filter.match(tbl) is not None
+
+    def bucket(self, tbl, network):
+        """
+        Return max prefix bucket of network, network broader than max prefix is its own bucket
+        """
+        if network.version == 4:
+            prefixlen = self.tbl_prefixlen.get(tbl, self.strict_prefixlen)
+        else:
+            prefixlen = self.prefixlen6
+        if network.prefixlen <= prefixlen:
+            return network
+        return network.supernet(new_prefix=prefixlen)
+
+    def seed(self, tbl, ip_addrs):
+        """
+        First use of table, entries already in kernel regarded as learned
+        """
+        if tbl in self.learned:
+            return
+        learned = self.learned[tbl] = {}
+        applied = self.applied[tbl] = {}
+        for ip_addr in ip_addrs:
+            network = ipaddress.ip_network(ip_addr)
+            bucket = self.bucket(tbl, network)
+            learned.setdefault(bucket, set()).add(network)
+            applied.setdefault(bucket, set()).add(network)
+
+    def update(self, tbl, networks, op):
+        """
+        Apply learned add/delete, return (changed networks, kernel adds, kernel deletes)
+        Add merges with sibling aggregates upward, delete recollapses its bucket
+        """
+        learned = self.learned.setdefault(tbl, {})
+        applied = self.applied.setdefault(tbl, {})
+        changed = set()
+        targets = {}
+        for network in networks:
+            bucket = self.bucket(tbl, network)
+            members = learned.setdefault(bucket, set())
+            if op == "add" and network not in members:
+                members.add(network)
+            elif op != "add" and network in members:
+                members.discard(network)
+            else:
+                continue
+            changed.add(network)
+            if bucket not in targets:
+                targets[bucket] = set(applied.get(bucket, ()))
+            target = targets[bucket]
+
+            if op != "add":
+                target.clear()
+                target.update(ipaddress.collapse_addresses(members))
+                continue
+
+            covered = network in target
+            supernet = network
+            while not covered and supernet.prefixlen > bucket.prefixlen:
+                supernet = supernet.supernet()
+                covered = supernet in target
+            if covered:
+                continue
+
+            if network.prefixlen < network.max_prefixlen:
+                target.difference_update([aggregate for aggregate in target if aggregate.subnet_of(network)])
+            while network.prefixlen > bucket.prefixlen:
+                supernet = network.supernet()
+                subnets = supernet.subnets()
+                sibling = next(subnets)
+                if sibling == network:
+                    sibling = next(subnets)
+                if sibling not in target:
+                    break
+                target.discard(sibling)
+                network = supernet
+            target.add(network)
+
+        adds = []
+        deletes = []
+        for bucket, target in targets.items():
+            current = applied.get(bucket, set())
+            adds.extend(target - current)
+            deletes.extend(current - target)
+            if not learned[bucket]:
+                del learned[bucket]
+        return changed, adds, deletes
+
+    def commit(self, tbl, network, op):
+        """
+        Record kernel entry applied by add/delete
+        """
+        applied = self.applied.get(tbl)
+        if applied is None:
+            return
+        bucket = self.bucket(tbl, network)
+        if op == "add":
+            applied.setdefault(bucket, set()).add(network)
+        else:
+            applied.get(bucket, set()).discard(network)
+            if bucket in applied and not applied[bucket]:
+                del applied[bucket]
+
+    def clear(self, tbl):
+        """
+        Table flushed or destroyed, called with aggregator lock held and ipfw write lock not held,
+        never from batch worker, aggregation waits on worker with aggregator lock held
+        """
+        self.learned.pop(tbl, None)
+        self.applied.pop(tbl, None)
+
+    def stats(self):
+        """
+        Return learned and kernel entry count per aggregated table
+        """
+        with self.lock:
+            tbl_stats = {}
+            for tbl, learned in list(self.learned.items()):
+                tbl_stats[tbl] = {
+                    "learned_entries": sum(len(members) for members in learned.values()),
+                    "aggregated_entries": sum(len(members) for members in self.applied.get(tbl, {}).values())
+                }
+            return tbl_stats
+
+# IPFWCommonTargets shared table of targets learned by many strict hosts
+# one rule ahead of the per host rules lets every strict host reach it
+#   00475 skipto 502 ip from table(strict_hosts_list) to table(strict_common) in via bridge0
+# target learned by threshold hosts is promoted, added to strict_common
+# once and deleted from the t*** tables, demoted back into t*** tables of
+# its remaining owners once they drop below half of threshold
+#
+# Owners kept for every target of t*** tables, only owners of promoted
+# targets journaled, owners of the others are the t*** tables themselves
+# State read and changed under cache lock, lock serializes share requests
+class IPFWCommonTargets:
+    def __init__(self, state_lock):
+        """
+        IPFW common targets initialization
+        """
+        self.threshold = 0
+        self.table = "strict_common"
+        self.rule_num = 475
+        self.owners = {}
+        self.members = {}
+        self.promoted = set()
+        self.seeded = set()
+        self.tbl_filter = re.compile(r"^t\d+$")
+        self.state_lock = state_lock
+        self.lock = threading.Lock()
+        self.journal = None
+        self.promotions = 0
+        self.demotions = 0
+        self.absorbed = 0
+
+    def enabled(self, tbl):
+        """
+        Check table is strict host table sharing common targets
+        """
+        return self.threshold > 0 and self.tbl_filter.match(tbl) is not None
+
+    def demote_below(self):
+        """
+        Promoted target with fewer owners demoted
+        """
+        return max(1, self.threshold // 2)
+
+    def seed(self, tbl, ip_addrs, common_addrs):
+        """
+        Seed owners from kernel entries of table once, promoted from common table
+        """
+        with self.state_lock:
+            if self.table not in self.seeded:
+                self.seeded.add(self.table)
+                self.promoted.update(common_addrs)
+            if tbl not in self.seeded:
+                self.seeded.add(tbl)
+                for ip_addr in ip_addrs:
+                    self.own(tbl, ip_addr)
+
+    def restore(self, shared):
+        """
+        Restore journaled owners of promoted targets
+        """
+        with self.state_lock:
+            for ip_addr, tbls in shared.items():
+                for tbl in tbls:
+                    self.own(tbl, ip_addr)
+
+    def own(self, tbl, ip_addr):
+        """
+        Add table to owners of target
+        """
+        with self.state_lock:
+            self.owners.setdefault(ip_addr, set()).add(tbl)
+            self.members.setdefault(tbl, set()).add(ip_addr)
+            self.journal_owners(ip_addr)
+
+    def disown(self, tbl, ip_addr):
+        """
+        Remove table from owners of target
+        """
+        with self.state_lock:
+            owners = self.owners.get(ip_addr)
+            if owners is None or tbl not in owners:
+                return
+            owners.discard(tbl)
+            if not owners:
+                del self.owners[ip_addr]
+            self.members[tbl].discard(ip_addr)
+            self.journal_owners(ip_addr)
+
+    def promote(self, ip_addr):
+        """
+        Mark target promoted into common table
+        """
+        with self.state_lock:
+            self.promoted.add(ip_addr)
+            self.promotions += 1
+            self.journal_owners(ip_addr)
+
+    def demote(self, ip_addr):
+        """
+        Mark target moved back into owner tables
+        """
+        with self.state_lock:
+            self.promoted.discard(ip_addr)
+            self.demotions += 1
+            if self.journal:
+                self.journal.append(["s", ip_addr, []])
+
+    def journal_owners(self, ip_addr):
+        """
+        Journal owners of promoted target, caller holds state lock
+        """
+        if self.journal and ip_addr in self.promoted:
+            self.journal.append(["s", ip_addr, sorted(self.owners.get(ip_addr, ()))])
+
+    def owned(self, tbl):
+        """
+        Return targets owned by table
+        """
+        with self.state_lock:
+            return list(self.members.get(tbl, ()))
+
+    def clear(self, tbl):
+        """
+        Drop table from owners of all its targets, table flushed or destroyed
+        """
+        with self.state_lock:
+            for ip_addr in list(self.members.get(tbl, ())):
+                self.disown(tbl, ip_addr)
+
+    def snapshot(self):
+        """
+        Return owners of promoted targets, caller holds state lock
+        """
+        return {ip_addr: sorted(self.owners.get(ip_addr, ())) for ip_addr in self.promoted}
+
+    def stats(self):
+        """
+        Owned entries and promotion counters
+        """
+        with self.state_lock:
+            return {"threshold": self.threshold, "promoted": len(self.promoted),
+                    "owned_entries": sum(len(owners) for owners in self.owners.values()),
+                    "promotions": self.promotions, "demotions": self.demotions,
+                    "absorbed_adds": self.absorbed}
+
+# IPFWDomainIndex owners of learned targets by DNS domain per table
+#   domains  {table: {domain: set(ip_addr)}}
+#   refs     {table: {ip_addr: set(domain)}}
+# kernel entry added by first owner and deleted with the last one, so
+# revoking a domain deletes only its addresses no other domain resolves to
+# Entry in table before any domain claimed it owned by "" (pinned), only
+# removed by plain delete
+#
+# State read and changed under cache lock, per table lock serializes
+# domain requests of one table with their kernel updates
+class IPFWDomainIndex:
+    def __init__(self, state_lock):
+        """
+        IPFW domain index initialization
+        """
+        self.domains = {}
+        self.refs = {}
+        self.state_lock = state_lock
+        self.tbl_locks = {}
+        self.tbl_locks_lock = threading.Lock()
+        self.domain_filter = re.compile(r"^[a-z0-9_*]([a-z0-9_-]*[a-z0-9_])?(\.[a-z0-9_]([a-z0-9_-]*[a-z0-9_])?)*$")
+        self.journal = None
+
+    def normalize(self, domain):
+        """
+        Lower case domain without trailing dot, None if malformed
+        """
+        if not domain:
+            return None
+        domain = domain.strip().rstrip('.').lower()
+        if len(domain) > 253 or not self.domain_filter.match(domain):
+            return None
+        return domain
+
+    def tbl_lock(self, tbl):
+        """
+        Return lock serializing domain requests of table
+        """
+        with self.tbl_locks_lock:
+            return self.tbl_locks.setdefault(tbl, threading.Lock())
+
+    def claim(self, tbl, domain, ip_addrs):
+        """
+        Add domain to owners of addresses
+        """
+        if not ip_addrs:
+            return
+        with self.state_lock:
+            members = self.domains.setdefault(tbl, {}).setdefault(domain, set())
+            refs = self.refs.setdefault(tbl, {})
+            for ip_addr in ip_addrs:
+                members.add(ip_addr)
+                refs.setdefault(ip_addr, set()).add(domain)
+            self.journal_domain(tbl, domain)
+
+    def release(self, tbl, domain, ip_addrs):
+        """
+        Remove domain from owners of addresses, return addresses left without owner
+        """
+        orphans = []
+        with self.state_lock:
+            members = self.domains.get(tbl, {}).get(domain)
+            if members is None:
+                return orphans
+            refs = self.refs[tbl]
+            for ip_addr in ip_addrs:
+                if ip_addr not in members:
+                    continue
+                members.discard(ip_addr)
+                owners = refs.get(ip_addr)
+                owners.discard(domain)
+                if not owners:
+                    del refs[ip_addr]
+                    orphans.append(ip_addr)
+            if not members:
+                del self.domains[tbl][domain]
+            self.journal_domain(tbl, domain)
+        return orphans
+
+    def forget(self, tbl, ip_addrs):
+        """
+        Addresses deleted from table, drop them from all their owners
+        """
+        with self.state_lock:
+            refs = self.refs.get(tbl)
+            if not refs:
+                return
+            for ip_addr in ip_addrs:
+                for domain in refs.pop(ip_addr, ()):
+                    members = self.domains[tbl][domain]
+                    members.discard(ip_addr)
+                    if not members:
+                        del self.domains[tbl][domain]
+                    self.journal_domain(tbl, domain)
+
+    def owned(self, tbl, domain):
+        """
+        Return addresses owned by domain
+        """
+        with self.state_lock:
+            return list(self.domains.get(tbl, {}).get(domain, ()))
+
+    def owners(self, tbl, ip_addr):
+        """
+        Return domains owning address
+        """
+        with self.state_lock:
+            return list(self.refs.get(tbl, {}).get(ip_addr, ()))
+
+    def journal_domain(self, tbl, domain):
+        """
+        Journal addresses of domain, caller holds state lock
+        """
+        if self.journal:
+            self.journal.append(["n", tbl, domain, sorted(self.domains.get(tbl, {}).get(domain, ()))])
+
+    def restore(self, domains):
+        """
+        Restore journaled domains of tables
+        """
+        for tbl, tbl_domains in domains.items():
+            for domain, ip_addrs in tbl_domains.items():
+                self.claim(tbl, domain, ip_addrs)
+
+    def clear(self, tbl):
+        """
+        Table flushed or destroyed, no owners left
+        """
+        with self.state_lock:
+            tbl_domains = self.domains.pop(tbl, {})
+            self.refs.pop(tbl, None)
+            if self.journal:
+                for domain in tbl_domains:
+                    self.journal.append(["n", tbl, domain, []])
+
+    def snapshot(self):
+        """
+        Return addresses of every domain per table, caller holds state lock
+        """
+        return {tbl: {domain: sorted(members) for domain, members in tbl_domains.items()}
+                for tbl, tbl_domains in self.domains.items() if tbl_domains}
+
+    def stats(self):
+        """
+        Domain and owned address counts per table
+        """
+        with self.state_lock:
+            tbl_stats = {}
+            for tbl, refs in self.refs.items():
+                tbl_stats[tbl] = {"domains": len(self.domains.get(tbl, {})), "domain_entries": len(refs),
+                                  "shared_entries": sum(1 for owners in refs.values() if len(owners) > 1)}
+            return tbl_stats
+
+# IPFWLeaseIndex DHCP leases of devices and MAC blocks following them
+#   leases   {mac: set(ip_addr)}   owners {ip_addr: mac}
+#   blocked  {table: {mac: set(ip_addr added for the block)}}
+# one lease per address family per MAC, new lease replaces the previous
+# Entry of blocked table only deleted if added for a MAC block, address
+# blocked by IP before stays
+#
+# State read and changed under cache lock, lock serializes lease/block
+# changes with their kernel updates
+class IPFWLeaseIndex:
+    def __init__(self, state_lock):
+        """
+        IPFW lease index initialization
+        """
+        self.leases = {}
+        self.owners = {}
+        self.blocked = {}
+        self.state_lock = state_lock
+        self.lock = threading.Lock()
+        self.mac_filter = re.compile("^[0-9a-f]{12}$")
+        self.journal = None
+        self.events = 0
+
+    def normalize(self, mac):
+        """
+        Return MAC as aa:bb:cc:dd:ee:ff from colon, dash or dot notation, None if malformed
+        """
+        if not mac:
+            return None
+        digits = re.sub(r"[:\-.]", "", mac.strip().lower())
+        if not self.mac_filter.match(digits):
+            return None
+        return ":".join(digits[idx:idx + 2] for idx in range(0, 12, 2))
+
+    def bind(self, mac, ip_addr):
+        """
+        Lease address to MAC, return addresses released by it, caller holds state lock
+        """
+        released = []
+        prev_mac = self.owners.get(ip_addr)
+        if prev_mac == mac:
+            return released
+        if prev_mac is not None:
+            self.unbind(prev_mac, ip_addr)
+        family = ":" in ip_addr
+        for prev_addr in list(self.leases.get(mac, ())):
+            if (":" in prev_addr) == family:
+                self.unbind(mac, prev_addr)
+                released.append(prev_addr)
+        self.leases.setdefault(mac, set()).add(ip_addr)
+        self.owners[ip_addr] = mac
+        self.journal_lease(mac)
+        return released
+
+    def unbind(self, mac, ip_addr):
+        """
+        Release lease of address, caller holds state lock
+        """
+        if self.owners.get(ip_addr) != mac:
+            return
+        del self.owners[ip_addr]
+        self.leases[mac].discard(ip_addr)
+        if not self.leases[mac]:
+            del self.leases[mac]
+        self.journal_lease(mac)
+
+    def owned(self, tbl, ip_addr):
+        """
+        Return MAC whose block added address to table, caller holds state lock
+        """
+        for mac, ip_addrs in self.blocked.get(tbl, {}).items():
+            if ip_addr in ip_addrs:
+                return mac
+        return None
+
+    def own(self, tbl, mac, ip_addr):
+        """
+        Record address added to table for MAC block, caller holds state lock
+        """
+        self.blocked[tbl][mac].add(ip_addr)
+        self.journal_block(tbl, mac)
+
+    def disown(self, tbl, mac, ip_addr):
+        """
+        Record address no longer in table for MAC block, caller holds state lock
+        """
+        ip_addrs = self.blocked.get(tbl, {}).get(mac)
+        if ip_addrs is not None and ip_addr in ip_addrs:
+            ip_addrs.discard(ip_addr)
+            self.journal_block(tbl, mac)
+
+    def forget(self, tbl, ip_addrs):
+        """
+        Addresses deleted from table, no longer added for MAC blocks
+        """
+        with self.state_lock:
+            for mac, owned in self.blocked.get(tbl, {}).items():
+                if owned & set(ip_addrs):
+                    owned.difference_update(ip_addrs)
+                    self.journal_block(tbl, mac)
+
+    def journal_lease(self, mac):
+        """
+        Journal addresses leased to MAC, caller holds state lock
+        """
+        if self.journal:
+            self.journal.append(["l", mac, sorted(self.leases.get(mac, ()))])
+
+    def journal_block(self, tbl, mac):
+        """
+        Journal MAC block of table with its added addresses, null once unblocked
+        """
+        if self.journal:
+            ip_addrs = self.blocked.get(tbl, {}).get(mac)
+            self.journal.append(["m", tbl, mac, None if ip_addrs is None else sorted(ip_addrs)])
+
+    def restore(self, devices):
+        """
+        Restore journaled leases and MAC blocks
+        """
+        with self.state_lock:
+            for mac, ip_addrs in devices.get("leases", {}).items():
+                for ip_addr in ip_addrs:
+                    self.leases.setdefault(mac, set()).add(ip_addr)
+                    self.owners[ip_addr] = mac
+            for tbl, macs in devices.get("blocked", {}).items():
+                for mac, ip_addrs in macs.items():
+                    self.blocked.setdefault(tbl, {})[mac] = set(ip_addrs)
+
+    def clear(self, tbl):
+        """
+        Table flushed or destroyed, blocks stay but no address added for them left
+        """
+        with self.state_lock:
+            for mac, ip_addrs in self.blocked.get(tbl, {}).items():
+                if ip_addrs:
+                    ip_addrs.clear()
+                    self.journal_block(tbl, mac)
+
+    def snapshot(self):
+        """
+        Return leases and MAC blocks, caller holds state lock
+        """
+        return {"leases": {mac: sorted(ip_addrs) for mac, ip_addrs in self.leases.items()},
+                "blocked": {tbl: {mac: sorted(ip_addrs) for mac, ip_addrs in macs.items()}
+                            for tbl, macs in self.blocked.items() if macs}}
+
+    def stats(self):
+        """
+        Lease counts and MAC blocks per table
+        """
+        with self.state_lock:
+            return ({"leases": len(self.owners), "devices": len(self.leases), "events": self.events},
+                    {tbl: {"blocked_macs": len(macs), "mac_entries": sum(len(owned) for owned in macs.values())}
+                     for tbl, macs in self.blocked.items() if macs})
+
+# IPFWLeaseFeed polls DHCP server lease file, lease changes go to IPFWIntf
+#   isc      dhcpd.leases, append-only "lease IP { ... }" blocks, read from
+#            last offset, whole file again once dhcpd rewrote it
+#   dnsmasq  dnsmasq.leases "expiry mac ip hostname clientid" lines,
+#            rewritten by dnsmasq, read whole on change
+# Leases kept as {ip_addr: (mac, ends)}, only difference against leases
+# applied before handed over, expired leases released on poll
+class IPFWLeaseFeed:
+    def __init__(self, path, apply, lease_format="isc", interval=2):
+        """
+        IPFW lease feed initialization, apply(changes) takes [(mac, ip_addr, bound)]
+        """
+        self.path = path
+        self.apply = apply
+        self.lease_format = lease_format
+        self.interval = interval
+        self.leases = {}
+        self.applied = {}
+        self.offset = 0
+        self.inode = None
+        self.mtime = None
+        self.partial = ""
+        self.worker = None
+        self.isc_filter = re.compile(r"lease\s+([0-9a-fA-F.:]+)\s*\{([^}]*)\}")
+        self.isc_ends_filter = re.compile(r"ends\s+(?:\d+\s+(\d+/\d+/\d+\s+\d+:\d+:\d+)|epoch\s+(\d+)|never)")
+        self.isc_state_filter = re.compile(r"(?<!next )(?<!rewind )binding state\s+(\w+)")
+        self.isc_mac_filter = re.compile(r"hardware ethernet\s+([0-9a-fA-F:]+)")
+
+    def start(self):
+        """
+        Start polling worker
+        """
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def run(self):
+        """
+        Lease feed worker
+        """
+        while True:
+            try:
+                self.poll()
+            except (OSError, ValueError) as e:
+                g_logger.warning("lease feed poll failed", extra=log_extra(path=self.path, error=str(e)))
+            time.sleep(self.interval)
+
+    def poll(self):
+        """
+        Read lease file changes and apply difference, return applied changes
+        """
+        stat = os.stat(self.path)
+        if self.lease_format == "dnsmasq":
+            if stat.st_mtime != self.mtime:
+                self.mtime = stat.st_mtime
+                with open(self.path, 'r') as lease_file:
+                    self.leases = self.parse_dnsmasq(lease_file.read())
+        else:
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                # dhcpd rewrote the file, start over
+                self.inode = stat.st_ino
+                self.offset = 0
+                self.partial = ""
+                self.leases = {}
+            if stat.st_size > self.offset:
+                with open(self.path, 'r') as lease_file:
+                    lease_file.seek(self.offset)
+                    data = lease_file.read()
+                    self.offset = lease_file.tell()
+                self.parse_isc(self.partial + data)
+
+        now = time.time()
+        current = {ip_addr: mac for ip_addr, (mac, ends) in self.leases.items() if ends is None or ends > now}
+        changes = []
+        for ip_addr, mac in self.applied.items():
+            if current.get(ip_addr) != mac:
+                changes.append((mac, ip_addr, False))
+        for ip_addr, mac in current.items():
+            if self.applied.get(ip_addr) != mac:
+                changes.append((mac, ip_addr, True))
+        self.applied = current
+        if changes:
+            self.apply(changes)
+        return changes
+
+    def parse_dnsmasq(self, data):
+        """
+        Parse dnsmasq leases, expiry 0 never ends
+        """
+        leases = {}
+        for line in data.splitlines():
+            fields = line.split()
+            if len(fields) < 3 or fields[0] == "duid":
+                continue
+            ip_addr = normalize_ip_addr(fields[2])
+            if ip_addr is None or not fields[0].isdigit():
+                continue
+            # DHCPv6 lines carry IAID instead of MAC
+            if ":" in ip_addr and len(fields[1].split(":")) != 6:
+                continue
+            leases[ip_addr] = (fields[1].lower(), int(fields[0]) or None)
+        return leases
+
+    def parse_isc(self, data):
+        """
+        Parse complete lease blocks, keep trailing partial block for next read
+        """
+        end = 0
+        for lease_match in self.isc_filter.finditer(data):
+            end = lease_match.end()
+            ip_addr = normalize_ip_addr(lease_match.group(1))
+            body = lease_match.group(2)
+            state_match = self.isc_state_filter.search(body)
+            mac_match = self.isc_mac_filter.search(body)
+            if ip_addr is None:
+                continue
+            if not mac_match or (state_match and state_match.group(1) != "active"):
+                self.leases.pop(ip_addr, None)
+                continue
+            ends = None
+            ends_match = self.isc_ends_filter.search(body)
+            if ends_match and ends_match.group(1):
+                ends = calendar.timegm(time.strptime(ends_match.group(1), "%Y/%m/%d %H:%M:%S"))
+            elif ends_match and ends_match.group(2):
+                ends = int(ends_match.group(2))
+            self.leases[ip_addr] = (mac_match.group(1).lower(), ends)
+        # Block being written by dhcpd completed on next read
+        start = data.rfind("lease ", end)
+        self.partial = data[start:] if start >= 0 and "}" not in data[start:] else ""
+
+# IPFWCounters samples rule counters with one "ipfw -a list" per interval,
+# keeps per interval deltas of the last history samples
+#   layout   (rule_num, body) of every rule, shared by samples until
+#            ruleset changes
+#   samples  (timestamp, layout, packets, bytes), deltas as array("Q")
+#            in layout order
+# API returns rows sparse as flat [pos, packets, bytes, ...] of rules with
+# hits, rule texts only when client layout id differs from current one
+# First read only sets baseline, counter going backwards (zeroed, rule
+# reloaded) counts from zero
+#
+# ipfw tables keep no per entry counters, table hits are hits of rules
+# matching on table(name), strict host t*** hits split into allowed and
+# denied by its rule pair
+class IPFWCounters:
+    def __init__(self, batch, history=360):
+        """
+        IPFW counters initialization
+        """
+        self.batch = batch
+        self.interval = 0
+        self.samples = deque(maxlen=history)
+        self.previous = None
+        self.layout = ()
+        self.layout_id = ""
+        self.lock = threading.Lock()
+        self.worker = None
+        self.tbl_filter = re.compile(r"table\(([^,)]+)")
+        self.strict_filter = re.compile(r"^t\d+$")
+
+    def start(self, interval):
+        """
+        Start sampling worker, interval 0 disables sampling
+        """
+        self.interval = interval
+        if interval and self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+
+    def run(self):
+        """
+        Sampling worker
+        """
+        while True:
+            try:
+                self.sample()
+            except (OSError, ValueError) as e:
+                g_logger.warning("sample rule counters failed", extra=log_extra(error=str(e)))
+            time.sleep(self.interval)
+
+    def sample(self):
+        """
+        Read all rule counters and record deltas since previous read
+        """
+        counters = parse_rule_counters(self.batch.backend.list_counters())
+        now = time.time()
+        current = {}
+        seen = {}
+        layout = []
+        packets = array.array("Q")
+        octets = array.array("Q")
+        for rule_num, rule_packets, rule_bytes, body in counters:
+            # Same body twice under one number kept apart by occurrence
+            occurrence = seen[(rule_num, body)] = seen.get((rule_num, body), -1) + 1
+            key = (rule_num, body, occurrence)
+            prev_packets, prev_bytes = (self.previous or {}).get(key, (0, 0))
+            if rule_packets < prev_packets or rule_bytes < prev_bytes:
+                prev_packets, prev_bytes = 0, 0
+            current[key] = (rule_packets, rule_bytes)
+            layout.append((rule_num, body))
+            packets.append(rule_packets - prev_packets)
+            octets.append(rule_bytes - prev_bytes)
+
+        with self.lock:
+            baseline = self.previous is None
+            self.previous = current
+            layout = tuple(layout)
+            if layout != self.layout:
+                self.layout = layout
+                self.layout_id = hashlib.sha1(json.dumps(layout).encode("utf-8")).hexdigest()[:12]
+            if not baseline:
+                self.samples.append((now, self.layout, packets, octets))
+
+    def window(self, samples=None):
+        """
+        Return (timestamps, layout, packets rows, bytes rows) of last samples on latest layout
+        """
+        with self.lock:
+            window = list(self.samples)
+        if samples:
+            window = window[-samples:]
+        if not window:
+            return [], (), [], []
+        layout = window[-1][1]
+        packet_rows = []
+        byte_rows = []
+        for timestamp, sample_layout, packets, octets in window:
+            if sample_layout is layout:
+                packet_rows.append(packets.tolist())
+                byte_rows.append(octets.tolist())
+                continue
+            # Ruleset changed within window, rules missing in older sample count zero
+            positions = dict(zip(sample_layout, range(len(sample_layout))))
+            packet_rows.append([packets[positions[rule]] if rule in positions else 0 for rule in layout])
+            byte_rows.append([octets[positions[rule]] if rule in positions else 0 for rule in layout])
+        return [timestamp for timestamp, sample_layout, packets, octets in window], layout, packet_rows, byte_rows
+
+    def rule_counters(self, samples=None, layout_id=None):
+        """
+        Per interval packet/byte deltas of rules with hits, one row per sample
+        rule texts left out when layout_id of client still current
+        """
+        timestamps, layout, packet_rows, byte_rows = self.window(samples)
+        rows = []
+        for packets, octets in zip(packet_rows, byte_rows):
+            row = []
+            for pos, rule_packets in enumerate(packets):
+                if rule_packets:
+                    row.extend((pos, rule_packets, octets[pos]))
+            rows.append(row)
+        result = {"result": "success", "interval": self.interval, "timestamps": timestamps,
+                  "layout": self.layout_id, "hits": rows}
+        if layout_id != self.layout_id:
+            result["rules"] = ["{num:05d} {body}".format(num=rule_num, body=body) for rule_num, body in layout]
+        return result
+
+    def table_counters(self, samples=None):
+        """
+        Per interval hits of tables and strict hosts, summed over rules matching on them
+        strict host as [table, allowed hits, denied hits]
+        """
+        timestamps, layout, packet_rows, byte_rows = self.window(samples)
+        positions = {}
+        strict_hosts = {}
+        for pos, (rule_num, body) in enumerate(layout):
+            for tbl in set(self.tbl_filter.findall(body)):
+                positions.setdefault(tbl, []).append(pos)
+                if not self.strict_filter.match(tbl):
+                    continue
+                words = body.split()
+                host = words[words.index("from") + 1] if "from" in words else tbl
+                strict_host = strict_hosts.setdefault(host, {"table": tbl, "allowed": [], "denied": []})
+                strict_host["denied" if words[0] in ("deny", "reject", "unreach", "unreach6") else "allowed"].append(pos)
+
+        def hits(rows, rule_positions):
+            return [sum(row[pos] for pos in rule_positions) for row in rows]
+
+        # Tables and strict hosts without any hit within window left out
+        tables = {}
+        for tbl, rule_positions in positions.items():
+            packets = hits(packet_rows, rule_positions)
+            if any(packets):
+                tables[tbl] = {"packets": packets, "bytes": hits(byte_rows, rule_positions)}
+        strict = {}
+        for host, strict_host in strict_hosts.items():
+            allowed = hits(packet_rows, strict_host["allowed"])
+            denied = hits(packet_rows, strict_host["denied"])
+            if any(allowed) or any(denied):
+                strict[host] = [strict_host["table"], allowed, denied]
+        return {"result": "success", "interval": self.interval, "timestamps": timestamps,
+                "tables": tables, "strict_hosts": strict}
+
+    def hot_rules(self, samples=None, top=10):
+        """
+        Rules with most packets within window and rules without any packet
+        """
+        timestamps, layout, packet_rows, byte_rows = self.window(samples)
+        packet_totals = [sum(column) for column in zip(*packet_rows)]
+        byte_totals = [sum(column) for column in zip(*byte_rows)]
+        rules = ["{num:05d} {body}".format(num=rule_num, body=body) for rule_num, body in layout]
+        ranked = sorted(range(len(rules)), key=lambda pos: packet_totals[pos], reverse=True)
+        return {"result": "success", "samples": len(timestamps),
+                "seconds": timestamps[-1] - timestamps[0] + self.interval if timestamps else 0,
+                "hot": [{"rule": rules[pos], "packets": packet_totals[pos], "bytes": byte_totals[pos]}
+                        for pos in ranked[:top] if packet_totals[pos]],
+                "dead": [rules[pos] for pos in range(len(rules)) if not packet_totals[pos]]}
+
+# IPFWJournal append-only journal of mutations applied to kernel
+# one json record per line, replayed on top of the last snapshot at startup
+# journal compacted into new snapshot once it grows over compact_records,
+# snapshot written to temporary file, synced and renamed over the old one
+#
+# Records only set state, replay of journal already within snapshot is harmless
+#   ["a", table, ip_addr, value]    ["d", table, ip_addr]
+#   ["c", table]  ["f", table]  ["x", table]
+#   ["r", rule_num, [rule bodies]]  ["t", table, ip_addr, deadline|null]
+#   ["s", ip_addr, [owner tables]]  owners of promoted common target, [] once demoted
+#   ["n", table, domain, [ip_addrs]]  addresses owned by domain, [] once revoked
+#
+# Only tables and rules mutated through the service are tracked,
+# static ones are left to ipfw.sh
+class IPFWJournal:
+    def __init__(self, path, compact_records=100000, sync=False):
+        """
+        IPFW journal initialization
+        """
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.compact_records = compact_records
+        self.sync = sync
+        self.journal_file = None
+        self.records = 0
+        self.tables = set()
+        self.rule_nums = set()
+        self.lock = threading.Lock()
+        self.compact_needed = threading.Event()
+
+    def read(self):
+        """
+        Read snapshot and replay journal, return {"tables", "rules", "ttls", "shared", "domains", "devices"}
+        """
+        tables = {}
+        rules = {}
+        ttls = {}
+        shared = {}
+        domains = {}
+        devices = {"leases": {}, "blocked": {}}
+        try:
+            with open(self.snapshot_path, 'r') as snapshot_file:
+                snapshot = json.load(snapshot_file)
+            tables = snapshot["tables"]
+            rules = {int(rule_num): bodies for rule_num, bodies in snapshot["rules"].items()}
+            ttls = {(tbl, ip_addr): deadline for tbl, ip_addr, deadline in snapshot["ttls"]}
+            shared = snapshot.get("shared", {})
+            domains = snapshot.get("domains", {})
+            devices = snapshot.get("devices", devices)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            g_logger.error("load journal snapshot failed", extra=log_extra(path=self.snapshot_path, error=str(e)))
+
+        records = 0
+        try:
+            with open(self.path, 'r') as journal_file:
+                for line in journal_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Torn record of crash while appending, nothing valid after it
+                        g_logger.warning("journal truncated", extra=log_extra(path=self.path, records=records))
+                        break
+                    records += 1
+                    op = record[0]
+                    if op == "a":
+                        tables.setdefault(record[1], {})[record[2]] = record[3]
+                    elif op == "d":
+                        tables.get(record[1], {}).pop(record[2], None)
+                        ttls.pop((record[1], record[2]), None)
+                    elif op == "c":
+                        tables.setdefault(record[1], {})
+                    elif op in ("f", "x"):
+                        if op == "f" and record[1] in tables:
+                            tables[record[1]] = {}
+                        else:
+                            tables.pop(record[1], None)
+                        for key in [key for key in ttls if key[0] == record[1]]:
+                            del ttls[key]
+                    elif op == "r":
+                        if record[2]:
+                            rules[record[1]] = record[2]
+                        else:
+                            rules.pop(record[1], None)
+                    elif op == "t":
+                        if record[3] is None:
+                            ttls.pop((record[1], record[2]), None)
+                        else:
+                            ttls[(record[1], record[2])] = record[3]
+                    elif op == "s":
+                        if record[2]:
+                            shared[record[1]] = record[2]
+                        else:
+                            shared.pop(record[1], None)
+                    elif op == "n":
+                        if record[3]:
+                            domains.setdefault(record[1], {})[record[2]] = record[3]
+                        else:
+                            domains.get(record[1], {}).pop(record[2], None)
+                    elif op == "l":
+                        if record[2]:
+                            devices["leases"][record[1]] = record[2]
+                        else:
+                            devices["leases"].pop(record[1], None)
+                    elif op == "m":
+                        if record[3] is None:
+                            devices["blocked"].get(record[1], {}).pop(record[2], None)
+                        else:
+                            devices["blocked"].setdefault(record[1], {})[record[2]] = record[3]
+        except FileNotFoundError:
+            pass
+
+        self.tables = set(tables)
+        self.rule_nums = set(rules)
+        return {"tables": tables, "rules": rules,
+                "ttls": [(tbl, ip_addr, deadline) for (tbl, ip_addr), deadline in ttls.items()],
+                "shared": shared, "domains": domains, "devices": devices}
+
+    def append(self, record):
+        """
+        Append one record, caller holds lock of the state it journals
+        """
+        with self.lock:
+            if record[0] in ("a", "d", "c", "f"):
+                self.tables.add(record[1])
+            elif record[0] == "r":
+                self.rule_nums.add(record[1])
+            if self.journal_file is None:
+                return
+            self.journal_file.write(json.dumps(record, separators=(',', ':')) + "\n")
+            self.journal_file.flush()
+            if self.sync:
+                os.fsync(self.journal_file.fileno())
+            self.records += 1
+            if self.records >= self.compact_records:
+                self.compact_needed.set()
+
+    def compact(self, tables, rules, ttls, shared, domains, devices):
+        """
+        Write snapshot of current state and start empty journal
+        caller holds locks of journaled state, no record lost in between
+        """
+        with self.lock:
+            snapshot_tmp = self.snapshot_path + ".tmp"
+            with open(snapshot_tmp, 'w') as snapshot_file:
+                json.dump({"tables": tables, "rules": {str(rule_num): bodies for rule_num, bodies in rules.items()},
+                           "ttls": ttls, "shared": shared, "domains": domains, "devices": devices}, snapshot_file, separators=(',', ':'))
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(snapshot_tmp, self.snapshot_path)
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+            self.journal_file = open(self.path, 'w')
+            self.records = 0
+
+# IPFWIntf direct opeate on ipfw firewall command
+# This is the operating system kernel relevant part
+class IPFWIntf:
+    def __init__(self, batch, cache):
+        """
+        IPFW intf initialization
+        """
+        self.batch = batch
+        self.cache = cache
+        # Decide and queue mutations in the same order kernel applies them
+        # IPFWBatch worker is the single writer of kernel state
+        self.write_lock = threading.Lock()
+        # (table, ip_addr) to ops queued but not finished, oldest first
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.expiry = IPFWExpiry(self.del_ips_from_tbl)
+        self.aggregator = IPFWAggregator()
+        self.scheduler = IPFWScheduler(batch)
+        self.counters = IPFWCounters(batch)
+        self.common = IPFWCommonTargets(cache.lock)
+        self.domains = IPFWDomainIndex(cache.lock)
+        self.devices = IPFWLeaseIndex(cache.lock)
+        self.journal = None
+        self.compactor = None
+        # Strict host ID n owns rule pair strict_ids.base + n, rules 04001-04999 by default
+        self.strict_ids = IPFWIDAllocator()
+        self.cache.allocators["strict_hosts_list"] = self.strict_ids
+
+    def start_journal(self, journal):
+        """
+        Restore journaled state into kernel, then journal every applied mutation
+        """
+        self.journal = journal
+        result = self.restore()
+        self.cache.journal = journal
+        self.common.journal = journal
+        self.domains.journal = journal
+        self.devices.journal = journal
+        self.expiry.journal = journal
+        self.compact_journal()
+        if self.compactor is None:
+            self.compactor = threading.Thread(target=self.run_compactor, daemon=True)
+            self.compactor.start()
+        return result
+
+    def restore(self):
+        """
+        Restore journaled tables, rules and ttl missing in kernel with single ipfw load
+        """
+        start = time.monotonic()
+        state = self.journal.read()
+        commands = []
+        callbacks = []
+
+        def restore_callback(op, *args):
+            def on_done(succeeded):
+                if succeeded:
+                    op(*args)
+            return on_done
+
+        with self.write_lock:
+            for tbl, entries in state["tables"].items():
+                kernel_entries = dict(self.cache.list(tbl))
+                if not self.cache.has_table(tbl):
+                    commands.append("table {table} create type addr".format(table=tbl))
+                    callbacks.append(restore_callback(self.cache.create, tbl))
+                for ip_addr, value in entries.items():
+                    kernel_value = kernel_entries.get(ip_addr)
+                    if kernel_value == value:
+                        continue
+                    if kernel_value is not None:
+                        commands.append("table {table} delete {ip_addr}".format(table=tbl, ip_addr=ip_addr))
+                        callbacks.append(restore_callback(self.cache.delete, tbl, ip_addr))
+                    if value == "0":
+                        commands.append("table {table} add {ip_addr}".format(table=tbl, ip_addr=ip_addr))
+                    else:
+                        commands.append("table {table} add {ip_addr} {value}".format(table=tbl, ip_addr=ip_addr, value=value))
+                    callbacks.append(restore_callback(self.cache.add, tbl, ip_addr, value))
+
+            for rule_num, bodies in sorted(state["rules"].items()):
+                existed_rules = self.cache.get_rule(rule_num)
+                if existed_rules == bodies:
+                    continue
+                if existed_rules:
+                    commands.append("delete {rule_num}".format(rule_num=rule_num))
+                    callbacks.append(restore_callback(self.cache.delete_rule, rule_num))
+                for body in bodies:
+                    commands.append("add {rule_num} {body}".format(rule_num=rule_num, body=body))
+                    callbacks.append(restore_callback(self.cache.add_rule, rule_num, body))
+
+            status = []
+            if commands:
+                status = self.batch.load(commands, callbacks)
+
+        self.common.restore(state["shared"])
+        self.domains.restore(state["domains"])
+        self.devices.restore(state["devices"])
+
+        now = time.time()
+        for tbl, ip_addr, deadline in state["ttls"]:
+            if self.cache.lookup(tbl, ip_addr) is not None:
+                self.expiry.schedule(tbl, ip_addr, max(deadline - now, 0))
+
+        result = {"restored": status.count(True), "failed": status.count(False),
+                  "seconds": time.monotonic() - start}
+        g_logger.info("restore from journal", extra=log_extra(path=self.journal.path, **result))
+        return result
+
+    def compact_journal(self):
+        """
+        Compact journal into snapshot of tracked tables, rules and ttl
+        """
+        with self.cache.lock:
+            with self.expiry.cond:
+                tables, rules = self.cache.snapshot(self.journal.tables, self.journal.rule_nums)
+                ttls = [ttl for ttl in self.expiry.snapshot() if ttl[0] in tables]
+                try:
+                    self.journal.compact(tables, rules, ttls, self.common.snapshot(), self.domains.snapshot(),
+                                         self.devices.snapshot())
+                except OSError as e:
+                    g_logger.error("compact journal failed", extra=log_extra(path=self.journal.path, error=str(e)))
+
+    def run_compactor(self):
+        """
+        Compactor worker, compact journal once it grows over limit
+        """
+        while True:
+            self.journal.compact_needed.wait()
+            self.journal.compact_needed.clear()
+            self.compact_journal()
+
+    def list_src_ip(self):
+        """
+        return a list of source IP addresses
+        """
+        return self.list_ip_from_tbl("blocklist")
+
+    def block_src_ip(self, src_ip_addr):
+        """
+        block src ip to blocklist table
+        """
+        return self.add_ip_to_tbl(src_ip_addr, "blocklist")
+
+    def unblock_src_ip(self, src_ip_addr):
+        """
+        Unblock src ip from blocklist table
+        """
+        return self.del_ip_from_tbl(src_ip_addr, "blocklist")
+
+    def list_target_ip(self):
+        """
+        list target ip from tblocklist
+        """
+        return self.list_ip_from_tbl("tblocklist")
+
+    def block_target_ip(self, tgt_ip_addr):
+        """
+        block target ip to tblocklist table
+        """
+        return self.add_ip_to_tbl(tgt_ip_addr, "tblocklist")
+
+    def unblock_target_ip(self, tgt_ip_addr):
+        """
+        Unblock target ip from tblocklist table
+        """
+        return self.del_ip_from_tbl(tgt_ip_addr, "tblocklist")
+
+    def strict_host_id(self, ip_addr, allocate=False, exact=False):
+        """
+        Return ID of strict host, ID n owns table t{n:03d} and rule pair strict_ids.base + n
+        None if address malformed, host unknown or pool exhausted
+
+        Registered host found in O(1), otherwise any address within registered
+        IPv6 host prefix found by longest prefix match, unless exact
+        allocate hands unknown host the lowest free ID, caller holds write_lock
+        """
+        host_addr = normalize_ip_addr(ip_addr)
+        if host_addr is None:
+            return None
+        with self.cache.lock:
+            strict_id = self.strict_ids.lookup(host_addr)
+            if strict_id is None and not (allocate or exact):
+                entry, value = self.cache.match("strict_hosts_list", host_addr)
+                if entry is not None:
+                    strict_id = self.strict_ids.lookup(entry)
+            if strict_id is None and allocate:
+                strict_id = self.strict_ids.allocate()
+        return strict_id
+
+    def strict_host_names(self, strict_id):
+        """
+        Return (target table, rule number) of strict host ID
+        """
+        return "t{num:03d}".format(num=strict_id), self.strict_ids.base + strict_id
+
+    def strict_host_table(self, mon_addr):
+        """
+        Target table of strict host, None if not resolved
+        """
+        strict_id = self.strict_host_id(mon_addr)
+        if strict_id is None:
+            return None
+        return self.strict_host_names(strict_id)[0]
+
+    def add_ip_to_skipto_tbl(self, ip_addr, tbl, reset=False):
+        """
+        Add client IP to skipto table
+
+        Only missing strict host entry, t*** table and 04*** rule pair are
+        created, learned targets within t*** survive re-adding the host
+        reset destroys and recreates all of them
+        """
+        network = parse_ip_network(ip_addr)
+        if network is None:
+            return {"result": "failed"}
+        host_addr = network.with_prefixlen
+        ip_addr = rule_addr(network)
+        if reset:
+            self.release_common(self.strict_host_table(host_addr))
+
+        with self.write_lock:
+            strict_id = self.strict_host_id(host_addr, allocate=True)
+            if strict_id is None:
+                g_logger.warning("strict host pool exhausted", extra=log_extra(ip_addr=ip_addr, **self.strict_ids.stats()))
+                return {"result": "failed"}
+            target_table, rule_num = self.strict_host_names(strict_id)
+            skipto = "{rule_num:05d}".format(rule_num=rule_num)
+
+            # ipfw reads batch lines without shell, table(...) no quote required
+            rule_pair = [
+                "skipto 502 ip from {ip_addr} to table({table}) via bridge0".format(ip_addr=ip_addr, table=target_table),
+                "deny ip from {ip_addr} to not table({table}) via bridge0".format(ip_addr=ip_addr, table=target_table)
+            ]
+
+            commands = []
+            value = self.cache.lookup(tbl, host_addr)
+            if reset or value != normalize_tbl_value(skipto):
+                if value is not None:
+                    commands.append(("host_del", "table {table} delete {ip_addr}".format(table=tbl, ip_addr=host_addr)))
+                commands.append(("host_add", "table {table} add {ip_addr} {skipto}".format(table=tbl, ip_addr=host_addr, skipto=skipto)))
+
+            if reset:
+                commands.append(("tbl_destroy", "table {table} destroy".format(table=target_table)))
+            if reset or not self.cache.has_table(target_table):
+                commands.append(("tbl_create", "table {table} create type addr".format(table=target_table)))
+
+            existed_rules = self.cache.get_rule(rule_num)
+            rule_in_place = len(existed_rules) == len(rule_pair)
+            for body in existed_rules:
+                if "from {ip_addr} ".format(ip_addr=ip_addr) not in body or "table({table})".format(table=target_table) not in body:
+                    rule_in_place = False
+            if reset or not rule_in_place:
+                if reset or existed_rules:
+                    commands.append(("rule_del", "delete {rule_num}".format(rule_num=rule_num)))
+                for body in rule_pair:
+                    commands.append(("rule_add", "add {rule_num} {body}".format(rule_num=rule_num, body=body)))
+
+            if not commands:
+                return {"result": "unchanged"}
+
+            status = self.batch.execute_many([command for op, command in commands])
+            destroyed = False
+            g_logger.debug("strict host add", extra=log_extra(ip_addr=ip_addr, commands=commands, status=status))
+            cmd_res = "success"
+            rule_idx = 0
+            for (op, command), succeeded in zip(commands, status):
+                if op == "rule_add":
+                    body = rule_pair[rule_idx]
+                    rule_idx += 1
+                if not succeeded:
+                    # Clean up of not existed entry/table/rule is allowed to fail
+                    if op in ("host_add", "tbl_create", "rule_add"):
+                        cmd_res = "failed"
+                    continue
+                if op == "host_del":
+                    self.cache.delete(tbl, host_addr)
+                elif op == "host_add":
+                    self.cache.add(tbl, host_addr, skipto)
+                elif op == "tbl_destroy":
+                    self.cache.destroy(target_table)
+                    self.expiry.cancel_tbl(target_table)
+                    destroyed = True
+                    self.common.clear(target_table)
+                    self.domains.clear(target_table)
+                    self.devices.clear(target_table)
+                elif op == "tbl_create":
+                    self.cache.create(target_table)
+                elif op == "rule_del":
+                    self.cache.delete_rule(rule_num)
+                elif op == "rule_add":
+                    self.cache.add_rule(rule_num, body)
+
+        if destroyed:
+            with self.aggregator.lock:
+                self.aggregator.clear(target_table)
+        return {"result": cmd_res}
+
+    def del_ip_from_skipto_tbl(self, ip_addr, tbl):
+        """
+        Del client IP from skipto table
+        """
+        cmd_res = "success"
+        host_addr = normalize_ip_addr(ip_addr)
+        if not host_addr:
+            return {"result": "failed"}
+        self.release_common(self.strict_host_table(host_addr))
+
+        with self.write_lock:
+            strict_id = self.strict_host_id(host_addr, exact=True)
+            if strict_id is None:
+                return {"result": "failed"}
+            target_table, rule_num = self.strict_host_names(strict_id)
+            commands = [
+                "delete {rule_num}".format(rule_num=rule_num),
+                "table {table} destroy".format(table=target_table),
+                "table {table} delete {ip_addr}".format(table=tbl, ip_addr=host_addr)
+            ]
+            status = self.batch.execute_many(commands)
+            if status[0]:
+                self.cache.delete_rule(rule_num)
+            if status[1]:
+                self.cache.destroy(target_table)
+                self.expiry.cancel_tbl(target_table)
+                self.common.clear(target_table)
+                self.domains.clear(target_table)
+                self.devices.clear(target_table)
+            if status[2]:
+                self.cache.delete(tbl, host_addr)
+            if not all(status):
+                cmd_res = "failed"
+
+        if status[1]:
+            with self.aggregator.lock:
+                self.aggregator.clear(target_table)
+        return {"result": cmd_res}
+
+    def list_ip_from_skipto_tbl(self, tbl):
+        """
+        List all IPs from skipto table
+        """
+        jsonobj = {"result": "success", "ip_list": []}
+        for ip_addr, value in self.cache.list(tbl):
+            jsonobj["ip_list"].append("{ip_addr} {value}\n".format(ip_addr=ip_addr, value=value))
+        return jsonobj
+
+    def add_ip_to_tbl(self, ip_addr, tbl, ttl=None):
+        """
+        Add new IP address to the tbl indicated table, removed after ttl seconds if given
+        """
+        self.scheduler.admit(tbl, 1)
+        return {"result": self.update_ips_in_tbl([ip_addr], tbl, "add", ttl)["result"]}
+
+    def del_ip_from_tbl(self, ip_addr, tbl):
+        """
+        Del IP address from tbl indicated table
+        """
+        return {"result": self.del_ips_from_tbl([ip_addr], tbl)["result"]}
+
+    def add_ips_to_tbl(self, ip_addrs, tbl, ttl=None):
+        """
+        Add list of IP addresses/CIDRs to the tbl indicated table in one batch
+        """
+        self.scheduler.admit(tbl, len(ip_addrs))
+        return self.update_ips_in_tbl(ip_addrs, tbl, "add", ttl)
+
+    def del_ips_from_tbl(self, ip_addrs, tbl):
+        """
+        Del list of IP addresses/CIDRs from the tbl indicated table in one batch
+        Deleted or expired entries no longer owned by any domain or MAC block
+        """
+        result = self.update_ips_in_tbl(ip_addrs, tbl, "delete")
+        deleted = [normalize_ip_addr(ip_addr) for ip_addr, ip_result in result["ip_results"].items()
+                   if ip_result in ("success", "unchanged")]
+        self.domains.forget(tbl, deleted)
+        self.devices.forget(tbl, deleted)
+        return result
+
+    def update_ips_in_tbl(self, ip_addrs, tbl, op, ttl=None, learned=True):
+        """
+        Apply table add/delete for all addresses, return per address result
+        Added entries with ttl expire, re-add extends ttl without kernel
+        learned False for kernel entries computed by aggregator
+        """
+        if learned and self.aggregator.enabled(tbl):
+            return self.scheduler.coalesce((tbl, op, ttl), ip_addrs, self.aggregate_ips_in_tbl, tbl, op, ttl)
+        if learned and self.shared(tbl):
+            return self.scheduler.coalesce((tbl, op, ttl), ip_addrs, self.share_ips_in_tbl, tbl, op, ttl)
+
+        return self.wait_ips_in_tbl(self.submit_ips_to_tbl(ip_addrs, tbl, op), ttl, learned)
+
+    def shared(self, tbl):
+        """
+        Check learned entries of table go through common targets
+        """
+        return self.common.enabled(tbl) and not self.aggregator.enabled(tbl)
+
+    def submit_ips_to_tbl(self, ip_addrs, tbl, op):
+        """
+        Queue table add/delete for all addresses without waiting, return pending state
+        """
+        ip_results = {}
+        norm_addrs = {}
+        valid_addrs = []
+        with self.write_lock:
+            for ip_addr in ip_addrs:
+                norm_addr = normalize_ip_addr(ip_addr)
+                if not norm_addr:
+                    ip_results[ip_addr] = "malformed"
+                    continue
+                if ip_addr in ip_results:
+                    continue
+                norm_addrs[ip_addr] = norm_addr
+                with self.inflight_lock:
+                    pending_ops = self.inflight.get((tbl, norm_addr))
+                    pending_op = pending_ops[-1] if pending_ops else None
+                    if self.cache.check_noop(tbl, norm_addr, op, pending_op):
+                        # Same entry already applied or queued to kernel, nothing to issue
+                        ip_results[ip_addr] = "unchanged"
+                        continue
+                    self.inflight.setdefault((tbl, norm_addr), []).append(op)
+                ip_results[ip_addr] = None
+                valid_addrs.append((ip_addr, norm_addr))
+
+            commands = ["table {table} {op} {ip_addr}".format(table=tbl, op=op, ip_addr=norm_addr) for ip_addr, norm_addr in valid_addrs]
+            callbacks = [self.entry_callback(tbl, norm_addr, op) for ip_addr, norm_addr in valid_addrs]
+            requests = self.batch.submit(commands, callbacks, self.scheduler.priority(tbl))
+
+        return tbl, op, ip_results, norm_addrs, valid_addrs, requests
+
+    def wait_ips_in_tbl(self, pending, ttl=None, learned=True):
+        """
+        Wait for queued table add/delete, return per address result
+        """
+        tbl, op, ip_results, norm_addrs, valid_addrs, requests = pending
+        status = [request.wait() for request in requests]
+
+        for (ip_addr, norm_addr), succeeded in zip(valid_addrs, status):
+            ip_results[ip_addr] = "success" if succeeded else "failed"
+
+        for ip_addr, norm_addr in norm_addrs.items():
+            if not learned or ip_results[ip_addr] not in ("success", "unchanged"):
+                continue
+            if op == "add" and ttl:
+                self.expiry.schedule(tbl, norm_addr, ttl)
+            else:
+                self.expiry.cancel(tbl, norm_addr)
+
+        return {"result": summarize_results(ip_results), "ip_results": ip_results}
+
+    def sync_ips_in_tbl(self, ip_addrs, tbl, ttl=None, kernel=False):
+        """
+        Make table hold exactly given addresses, only the difference goes to kernel
+        Diff against cache, cache reloaded from kernel first if kernel is True
+        ip_results keyed by normalized address, deletes have no request string
+        """
+        ip_results = {}
+        desired = {}
+        for ip_addr in ip_addrs:
+            norm_addr = normalize_ip_addr(ip_addr)
+            if not norm_addr:
+                ip_results[ip_addr] = "malformed"
+                continue
+            desired[norm_addr] = ip_addr
+
+        if kernel:
+            self.cache.load()
+
+        aggregated = self.aggregator.enabled(tbl)
+        if aggregated:
+            with self.aggregator.lock:
+                self.aggregator.seed(tbl, [ip_addr for ip_addr, value in self.cache.list(tbl)])
+                current = set(network.with_prefixlen for members in self.aggregator.learned.get(tbl, {}).values() for network in members)
+        elif self.shared(tbl):
+            with self.common.lock:
+                self.common.seed(tbl, [ip_addr for ip_addr, value in self.cache.list(tbl)],
+                                 [ip_addr for ip_addr, value in self.cache.list(self.common.table)])
+            current = set(self.common.owned(tbl))
+        else:
+            current = set(ip_addr for ip_addr, value in self.cache.list(tbl))
+
+        # With ttl every desired entry refreshed, entries in place stay unchanged
+        if ttl:
+            adds = list(desired)
+        else:
+            adds = [norm_addr for norm_addr in desired if norm_addr not in current]
+        deletes = [ip_addr for ip_addr in current if ip_addr not in desired]
+        self.scheduler.admit(tbl, len(adds))
+
+        if aggregated:
+            results = [self.aggregate_ips_in_tbl(adds, tbl, "add", ttl), self.aggregate_ips_in_tbl(deletes, tbl, "delete")]
+        elif self.shared(tbl):
+            results = [self.share_ips_in_tbl(adds, tbl, "add", ttl), self.share_ips_in_tbl(deletes, tbl, "delete")]
+        else:
+            # Adds and deletes join the same ipfw batch
+            pending = [self.submit_ips_to_tbl(adds, tbl, "add"), self.submit_ips_to_tbl(deletes, tbl, "delete")]
+            results = [self.wait_ips_in_tbl(pending[0], ttl), self.wait_ips_in_tbl(pending[1])]
+
+        for result in results:
+            ip_results.update(result["ip_results"])
+        # Deleted entries no longer owned by any domain or MAC block
+        released = [ip_addr for ip_addr in deletes if results[1]["ip_results"].get(ip_addr) in ("success", "unchanged")]
+        self.domains.forget(tbl, released)
+        self.devices.forget(tbl, released)
+        added = sum(1 for ip_addr in adds if results[0]["ip_results"].get(ip_addr) == "success")
+        deleted = sum(1 for ip_addr in deletes if results[1]["ip_results"].get(ip_addr) == "success")
+        result = summarize_results(ip_results) if ip_results else "unchanged"
+        return {"result": result, "added": added, "deleted": deleted, "ip_results": ip_results}
+
+    def aggregate_ips_in_tbl(self, ip_addrs, tbl, op, ttl=None):
+        """
+        Apply learned add/delete to aggregated table, only CIDR diff goes to kernel
+        New aggregates added before covered entries deleted, no traffic gap
+        """
+        ip_results = {}
+        networks = {}
+        for ip_addr in ip_addrs:
+            norm_addr = normalize_ip_addr(ip_addr)
+            if not norm_addr:
+                ip_results[ip_addr] = "malformed"
+                continue
+            networks[ip_addr] = ipaddress.ip_network(norm_addr)
+
+        with self.aggregator.lock:
+            self.aggregator.seed(tbl, [ip_addr for ip_addr, value in self.cache.list(tbl)])
+            changed, adds, deletes = self.aggregator.update(tbl, networks.values(), op)
+
+            kernel_failed = False
+            for kernel_op, kernel_networks in (("add", adds), ("delete", deletes)):
+                if not kernel_networks:
+                    continue
+                kernel_addrs = [network.with_prefixlen for network in kernel_networks]
+                kernel_results = self.update_ips_in_tbl(kernel_addrs, tbl, kernel_op, learned=False)["ip_results"]
+                for network in kernel_networks:
+                    if kernel_results[network.with_prefixlen] in ("success", "unchanged"):
+                        self.aggregator.commit(tbl, network, kernel_op)
+                    else:
+                        kernel_failed = True
+
+        for ip_addr, network in networks.items():
+            if network not in changed:
+                ip_results[ip_addr] = "unchanged"
+            elif kernel_failed:
+                ip_results[ip_addr] = "failed"
+            else:
+                ip_results[ip_addr] = "success"
+            if ip_results[ip_addr] not in ("success", "unchanged"):
+                continue
+            if op == "add" and ttl:
+                self.expiry.schedule(tbl, network.with_prefixlen, ttl)
+            else:
+                self.expiry.cancel(tbl, network.with_prefixlen)
+
+        return {"result": summarize_results(ip_results), "ip_results": ip_results}
+
+    def ensure_common(self):
+        """
+        Create common targets table and its rule if missing, return True if in place
+        """
+        common = self.common
+        rule_body = "skipto 502 ip from table(strict_hosts_list) to table({table}) in via bridge0".format(table=common.table)
+        commands = []
+        with self.write_lock:
+            if not self.cache.has_table(common.table):
+                commands.append(("tbl_create", "table {table} create type addr".format(table=common.table)))
+            # Rule in place from ipfw.sh kept as is
+            if not self.cache.get_rule(common.rule_num):
+                commands.append(("rule_add", "add {rule_num} {body}".format(rule_num=common.rule_num, body=rule_body)))
+            if not commands:
+                return True
+            status = self.batch.execute_many([command for op, command in commands])
+            for (op, command), succeeded in zip(commands, status):
+                if not succeeded:
+                    continue
+                if op == "tbl_create":
+                    self.cache.create(common.table)
+                elif op == "rule_add":
+                    self.cache.add_rule(common.rule_num, rule_body)
+        if not all(status):
+            g_logger.error("create common targets table failed", extra=log_extra(table=common.table, rule_num=common.rule_num))
+        return all(status)
+
+    def apply_groups(self, groups, op):
+        """
+        Apply op of {table: [ip_addr]} within one batch, return {(table, ip_addr): succeeded}
+        """
+        pending = [self.submit_ips_to_tbl(ip_addrs, tbl, op) for tbl, ip_addrs in groups.items() if ip_addrs]
+        applied = {}
+        for tbl_pending in pending:
+            ip_results = self.wait_ips_in_tbl(tbl_pending, learned=False)["ip_results"]
+            for ip_addr, ip_result in ip_results.items():
+                applied[(tbl_pending[0], ip_addr)] = ip_result in ("success", "unchanged")
+        return applied
+
+    def share_ips_in_tbl(self, ip_addrs, tbl, op, ttl=None):
+        """
+        Apply learned add/delete to strict host table sharing common targets
+        Target owned by threshold hosts promoted to common table and removed
+        from owner tables, re-added to remaining owners before demoted
+        """
+        ip_results = {}
+        norm_addrs = {}
+        for ip_addr in ip_addrs:
+            norm_addr = normalize_ip_addr(ip_addr)
+            if not norm_addr:
+                ip_results[ip_addr] = "malformed"
+                continue
+            norm_addrs[ip_addr] = norm_addr
+
+        common = self.common
+        with common.lock:
+            with self.cache.lock:
+                common.seed(tbl, [ip_addr for ip_addr, value in self.cache.list(tbl)],
+                            [ip_addr for ip_addr, value in self.cache.list(common.table)])
+                plans = {}
+                for norm_addr in set(norm_addrs.values()):
+                    owners = common.owners.get(norm_addr, set())
+                    promoted = norm_addr in common.promoted
+                    if op == "add":
+                        if tbl in owners:
+                            plans[norm_addr] = ("unchanged", ())
+                        elif promoted:
+                            plans[norm_addr] = ("absorb", ())
+                        elif len(owners) + 1 >= common.threshold:
+                            plans[norm_addr] = ("promote", sorted(owners))
+                        else:
+                            plans[norm_addr] = ("add", ())
+                    else:
+                        if tbl not in owners:
+                            plans[norm_addr] = ("unchanged", ())
+                        elif not promoted:
+                            plans[norm_addr] = ("delete", ())
+                        elif len(owners) - 1 < common.demote_below():
+                            plans[norm_addr] = ("demote", sorted(owners - {tbl}))
+                        else:
+                            plans[norm_addr] = ("keep", ())
+
+            if any(plan == "promote" for plan, owners in plans.values()) and not self.ensure_common():
+                for norm_addr, (plan, owners) in plans.items():
+                    if plan == "promote":
+                        plans[norm_addr] = ("add", ())
+
+            # New entries in place before old ones deleted, no traffic gap
+            adds = {}
+            for norm_addr, (plan, owners) in plans.items():
+                if plan == "promote":
+                    adds.setdefault(common.table, []).append(norm_addr)
+                elif plan == "add":
+                    adds.setdefault(tbl, []).append(norm_addr)
+                elif plan == "demote":
+                    for owner in owners:
+                        adds.setdefault(owner, []).append(norm_addr)
+            added = self.apply_groups(adds, "add")
+
+            deletes = {}
+            for norm_addr, (plan, owners) in plans.items():
+                if plan == "promote" and added[(common.table, norm_addr)]:
+                    for owner in owners:
+                        deletes.setdefault(owner, []).append(norm_addr)
+                elif plan == "delete":
+                    deletes.setdefault(tbl, []).append(norm_addr)
+                elif plan == "demote" and all(added[(owner, norm_addr)] for owner in owners):
+                    deletes.setdefault(common.table, []).append(norm_addr)
+            deleted = self.apply_groups(deletes, "delete")
+
+            results = {}
+            with self.cache.lock:
+                for norm_addr, (plan, owners) in plans.items():
+                    result = "success"
+                    if plan == "unchanged":
+                        result = "unchanged"
+                    elif plan == "absorb":
+                        common.own(tbl, norm_addr)
+                        common.absorbed += 1
+                    elif plan == "add":
+                        if added[(tbl, norm_addr)]:
+                            common.own(tbl, norm_addr)
+                        else:
+                            result = "failed"
+                    elif plan == "promote":
+                        if added[(common.table, norm_addr)]:
+                            common.own(tbl, norm_addr)
+                            common.promote(norm_addr)
+                        else:
+                            result = "failed"
+                    elif plan == "delete":
+                        if deleted[(tbl, norm_addr)]:
+                            common.disown(tbl, norm_addr)
+                        else:
+                            result = "failed"
+                    elif plan == "keep":
+                        common.disown(tbl, norm_addr)
+                    elif plan == "demote":
+                        common.disown(tbl, norm_addr)
+                        if deleted.get((common.table, norm_addr)):
+                            common.demote(norm_addr)
+                        else:
+                            # Remaining owners still reach it through common table
+                            result = "failed"
+                    results[norm_addr] = result
+
+        for ip_addr, norm_addr in norm_addrs.items():
+            ip_results[ip_addr] = results[norm_addr]
+            if results[norm_addr] not in ("success", "unchanged"):
+                continue
+            if op == "add" and ttl:
+                self.expiry.schedule(tbl, norm_addr, ttl)
+            else:
+                self.expiry.cancel(tbl, norm_addr)
+
+        return {"result": summarize_results(ip_results), "ip_results": ip_results}
+
+    def learned_in(self, tbl, ip_addr):
         """
-        return a list of source IP addresses
+        Check address learned in table, through aggregator or common targets when enabled
         """
-        command = "ipfw table blocklist list"
-        if g_dummy_test:
-            print("Request to list all src ip within blocklist")
-        else:
-            ip_list = subprocess.Popen(['ipfw','table blocklist list'], stdout=subprocess.PIPE)
-            jsonobj = {"result": "success", "ip_list": []}
-            for line in ip_list.stdout.readlines():
-                ip_addr_str = line.decode("utf-8")
-                ip_addr_match = self.ip_addr_filter.match(ip_addr_str)
-                if ip_addr_match:
-                    if ip_addr_match.group(1):
-                        ip_addr = ip_addr_match.group(1)
-                        print("source of line data   ", ip_addr)
-                        jsonobj["ip_list"].append(ip_addr)
-            return jsonobj
+        if self.aggregator.enabled(tbl):
+            network = ipaddress.ip_network(ip_addr)
+            with self.aggregator.lock:
+                self.aggregator.seed(tbl, [entry for entry, value in self.cache.list(tbl)])
+                return network in self.aggregator.learned[tbl].get(self.aggregator.bucket(tbl, network), ())
+        if self.shared(tbl):
+            with self.common.lock:
+                self.common.seed(tbl, [entry for entry, value in self.cache.list(tbl)],
+                                 [entry for entry, value in self.cache.list(self.common.table)])
+            return tbl in self.common.owners.get(ip_addr, ())
+        return self.cache.lookup(tbl, ip_addr) is not None
 
-    def block_src_ip(self, src_ip_addr):
+    def add_domain_ips(self, domain, ip_addrs, tbl, ttl=None, reset=False):
         """
-        block src ip to blocklist table
+        Add addresses resolved from domain to table, domain becomes one of their owners
+        reset releases addresses of domain not given, deleted if no other owner left
+        Entry owned by domain without ttl stays permanent, ttl of other owners ignored
         """
-        command = "ipfw table blocklist add {ip_addr}".format(ip_addr=src_ip_addr)
-        if g_dummy_test:
-            print("Request to block source IP addr ", src_ip_addr, " command = ", command)
-        else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
+        ip_results = {}
+        norm_addrs = {}
+        for ip_addr in ip_addrs:
+            norm_addr = normalize_ip_addr(ip_addr)
+            if not norm_addr:
+                ip_results[ip_addr] = "malformed"
+                continue
+            norm_addrs[ip_addr] = norm_addr
+        self.scheduler.admit(tbl, len(norm_addrs))
 
-    def unblock_src_ip(self, src_ip_addr):
+        results = {}
+        released = []
+        with self.domains.tbl_lock(tbl):
+            adds = []
+            for norm_addr in set(norm_addrs.values()):
+                owners = self.domains.owners(tbl, norm_addr)
+                if not owners and self.learned_in(tbl, norm_addr):
+                    # Entry added without domain stays until deleted explicitly
+                    self.domains.claim(tbl, "", [norm_addr])
+                    owners = [""]
+                if ttl and [owner for owner in owners if owner != domain] and not self.expiry.deadline(tbl, norm_addr):
+                    results[norm_addr] = "unchanged"
+                else:
+                    adds.append(norm_addr)
+            # Owned before queued, revoke of other owner queued later keeps entry
+            self.domains.claim(tbl, domain, list(results) + adds)
+            wait_adds = self.submit_domain_ips(adds, tbl, "add", ttl)
+            if reset:
+                released = [norm_addr for norm_addr in self.domains.owned(tbl, domain) if norm_addr not in norm_addrs.values()]
+                wait_deletes = self.submit_domain_ips(self.domains.release(tbl, domain, released), tbl, "delete")
+
+        results.update(wait_adds())
+        self.domains.release(tbl, domain, [norm_addr for norm_addr, result in results.items() if result == "failed"])
+        deleted = {}
+        if reset:
+            deleted = wait_deletes()
+            # Entry still in kernel, keep it owned so that release can be retried
+            self.domains.claim(tbl, domain, [ip_addr for ip_addr, result in deleted.items() if result == "failed"])
+
+        for ip_addr, norm_addr in norm_addrs.items():
+            ip_results[ip_addr] = results[norm_addr]
+        ip_results.update(deleted)
+        return {"result": summarize_results(ip_results) if ip_results else "unchanged", "ip_results": ip_results,
+                "released": len(released), "deleted": list(deleted.values()).count("success")}
+
+    def revoke_domain(self, domain, tbl):
         """
-        Unblock src ip from blocklist table
+        Remove domain from owners of all its addresses in table
+        addresses left without owner deleted from kernel in one batch, no table scan
         """
-        command = "ipfw table blocklist delete {ip_addr}".format(ip_addr=src_ip_addr)
-        if g_dummy_test:
-            print("Request to unblock source IP addr ", src_ip_addr, " command ", command)
+        with self.domains.tbl_lock(tbl):
+            released = self.domains.owned(tbl, domain)
+            wait_deletes = self.submit_domain_ips(self.domains.release(tbl, domain, released), tbl, "delete")
+
+        deleted = wait_deletes()
+        # Entry still in kernel, keep it owned so that revoke can be retried
+        self.domains.claim(tbl, domain, [ip_addr for ip_addr, result in deleted.items() if result == "failed"])
+        if not released:
+            result = "unchanged"
         else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
+            result = summarize_results(deleted) if deleted else "success"
+        return {"result": result, "ip_results": deleted, "released": len(released),
+                "deleted": list(deleted.values()).count("success")}
 
-    def list_target_ip(self):
+    def submit_domain_ips(self, ip_addrs, tbl, op, ttl=None):
         """
-        list target ip from tblocklist
+        Queue kernel update of domain owned addresses, caller holds table lock of domain index
+        Aggregated and shared tables applied in place under their own lock
+        Return function waiting for per address result
         """
-        command = "ipfw table tblocklist list"
-        if g_dummy_test:
-            print("List all blocked target IPs")
-        else:
-            ip_list = subprocess.Popen(['ipfw','table tblocklist list'], stdout=subprocess.PIPE)
-            jsonobj = {"result": "success", "ip_list": []}
-            for line in ip_list.stdout.readlines():
-                ip_addr_str = line.decode("utf-8")
-                ip_addr_match = self.ip_addr_filter.match(ip_addr_str)
-                if ip_addr_match:
-                    if ip_addr_match.group(1):
-                        ip_addr = ip_addr_match.group(1)
-                        print("source of line data   ", ip_addr)
-                        jsonobj["ip_list"].append(ip_addr)
-            return jsonobj
+        if self.aggregator.enabled(tbl) or self.shared(tbl):
+            ip_results = self.update_ips_in_tbl(ip_addrs, tbl, op, ttl)["ip_results"]
 
-    def block_target_ip(self, tgt_ip_addr):
-        """
-        block target ip to tblocklist table
-        """
-        command = "ipfw table tblocklist add {ip_addr}".format(ip_addr=tgt_ip_addr)
-        if g_dummy_test:
-            print("Request to block target IP addr ", tgt_ip_addr, " command = ", command)
-        else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
+            def wait_applied():
+                return ip_results
+            return wait_applied
 
-    def unblock_target_ip(self, tgt_ip_addr):
+        pending = self.submit_ips_to_tbl(ip_addrs, tbl, op)
+
+        def wait_pending():
+            return self.wait_ips_in_tbl(pending, ttl)["ip_results"]
+        return wait_pending
+
+    def list_domain_ips(self, tbl, domain=None, ip_addr=None):
         """
-        Unblock target ip from tblocklist table
+        List addresses of domain, owners of address, or all domains of table
         """
-        command = "ipfw table tblocklist delete {ip_addr}".format(ip_addr=tgt_ip_addr)
-        if g_dummy_test:
-            print("Request to unblock target IP addr ", tgt_ip_addr, " command = ", command)
-        else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
+        if domain:
+            return {"result": "success", "ip_list": sorted(self.domains.owned(tbl, domain))}
+        if ip_addr:
+            norm_addr = normalize_ip_addr(ip_addr)
+            if not norm_addr:
                 return {"result": "failed"}
+            return {"result": "success", "domains": sorted(self.domains.owners(tbl, norm_addr))}
+        with self.cache.lock:
+            return {"result": "success", "domains": self.domains.snapshot().get(tbl, {})}
 
-    def add_ip_to_skipto_tbl(self, ip_addr, tbl):
+    def block_src_mac(self, mac, tbl="blocklist"):
         """
-        Add client IP to skipto table
+        Block device by MAC, addresses leased to it now and later added to table
         """
-        idx = ip_addr.rsplit('.')[3]
+        with self.devices.lock:
+            with self.cache.lock:
+                macs = self.devices.blocked.setdefault(tbl, {})
+                if mac not in macs:
+                    macs[mac] = set()
+                    self.devices.journal_block(tbl, mac)
+                    result = "success"
+                else:
+                    result = "unchanged"
+                leased = [ip_addr for ip_addr in sorted(self.devices.leases.get(mac, ())) if ip_addr not in macs[mac]]
+            # Address already blocked by IP stays owned by that block
+            adds = [ip_addr for ip_addr in leased if not self.learned_in(tbl, ip_addr)]
+            ip_results = self.submit_domain_ips(adds, tbl, "add")()
+            with self.cache.lock:
+                for ip_addr, ip_result in ip_results.items():
+                    if ip_result in ("success", "unchanged"):
+                        self.devices.own(tbl, mac, ip_addr)
 
-        skipto = "04{num}".format(num=idx.zfill(3))
-        command = "ipfw table {table} add {ip_addr} {skipto}".format(table=tbl, ip_addr=ip_addr, skipto=skipto)
-        if g_dummy_test:
-            print("Request to add IP ", ip_addr, " to table ", tbl, " command = ", command)
-        else:
-            status = os.system(command)
-        
-        target_table = "t{num}".format(num=idx.zfill(3))
-
-        clean_tbl_command = "ipfw table {table} destroy".format(table=target_table)
-        os.system(clean_tbl_command)
-
-        add_tbl_command = "ipfw table {table} create type addr".format(table=target_table)
-        if g_dummy_test:
-            print("create target filter table ", ip_addr, " command ", add_tbl_command)
-        else:
-            status = os.system(add_tbl_command)
-        
-        print(add_tbl_command)
+        if ip_results:
+            result = summarize_results(ip_results)
+        return {"result": result, "mac": mac, "ip_results": ip_results}
 
-        rule_num = "04{num}".format(num=idx.zfill(3))
-        delete_if_existed = "ipfw delete {rule_num}".format(rule_num=rule_num)
-        os.system(delete_if_existed)
+    def unblock_src_mac(self, mac, tbl="blocklist"):
+        """
+        Unblock device by MAC, addresses added for its block deleted from table
+        """
+        with self.devices.lock:
+            with self.cache.lock:
+                owned = self.devices.blocked.get(tbl, {}).pop(mac, None)
+                if owned is None:
+                    return {"result": "unchanged", "mac": mac, "ip_results": {}}
+                self.devices.journal_block(tbl, mac)
+            # Address also learned from domain stays for its domain
+            deletes = [ip_addr for ip_addr in sorted(owned) if not self.domains.owners(tbl, ip_addr)]
+            ip_results = self.submit_domain_ips(deletes, tbl, "delete")()
+            failed = [ip_addr for ip_addr, ip_result in ip_results.items() if ip_result == "failed"]
+            if failed:
+                # Still blocked in kernel, keep MAC block so that unblock can be retried
+                with self.cache.lock:
+                    self.devices.blocked.setdefault(tbl, {})[mac] = set(failed)
+                    self.devices.journal_block(tbl, mac)
 
-        print("delete if existed  ", delete_if_existed)
+        return {"result": summarize_results(ip_results) if ip_results else "success",
+                "mac": mac, "ip_results": ip_results}
 
-        update_forward_command = "ipfw add {rule_num} skipto 502 ip from {ip_addr} to 'table({table})' via bridge0".format(rule_num=rule_num, ip_addr=ip_addr, table=target_table)
-        if g_dummy_test:
-            print("Add target table filter for ", target_table, " failed")
-        else:
-            status = os.system(update_forward_command)
+    def apply_leases(self, changes):
+        """
+        Apply lease changes [(mac, ip_addr, bound)] from DHCP server
+        MAC block follows device to new address, released address unblocked,
+        table updates of all changes queued before waiting on any
+        """
+        with self.devices.lock:
+            touched = set()
+            with self.cache.lock:
+                for mac, ip_addr, bound in changes:
+                    ip_addr = normalize_ip_addr(ip_addr)
+                    if not ip_addr:
+                        continue
+                    self.devices.events += 1
+                    touched.add(ip_addr)
+                    if bound:
+                        touched.update(self.devices.bind(mac, ip_addr))
+                    else:
+                        self.devices.unbind(mac, ip_addr)
 
-        print("forward  ", update_forward_command)
+                plans = {}
+                for tbl, macs in self.devices.blocked.items():
+                    adds = []
+                    deletes = []
+                    for ip_addr in sorted(touched):
+                        mac = self.devices.owners.get(ip_addr)
+                        owner = self.devices.owned(tbl, ip_addr)
+                        if mac in macs and owner is not None:
+                            # Address moved between blocked devices, entry stays
+                            if owner != mac:
+                                self.devices.disown(tbl, owner, ip_addr)
+                                self.devices.own(tbl, mac, ip_addr)
+                        elif mac in macs:
+                            adds.append((mac, ip_addr))
+                        elif owner is not None:
+                            deletes.append((owner, ip_addr))
+                    if adds or deletes:
+                        plans[tbl] = (adds, deletes)
 
-        drop_packet = "ipfw add {rule_num} deny ip from {ip_addr} to not 'table({table})' via bridge0".format(rule_num=rule_num, ip_addr=ip_addr, table=target_table)
-        if g_dummy_test:
-            print("Add packet drop rule ", drop_packet)
-        else:
-            status = os.system(drop_packet)
+            waits = []
+            for tbl, (adds, deletes) in plans.items():
+                adds = [(mac, ip_addr) for mac, ip_addr in adds if not self.learned_in(tbl, ip_addr)]
+                kept = [(mac, ip_addr) for mac, ip_addr in deletes if self.domains.owners(tbl, ip_addr)]
+                deletes = [(mac, ip_addr) for mac, ip_addr in deletes if (mac, ip_addr) not in kept]
+                waits.append((tbl, adds, deletes, kept,
+                              self.submit_domain_ips([ip_addr for mac, ip_addr in adds], tbl, "add"),
+                              self.submit_domain_ips([ip_addr for mac, ip_addr in deletes], tbl, "delete")))
 
-        print(update_forward_command)
+            ip_results = {}
+            for tbl, adds, deletes, kept, wait_adds, wait_deletes in waits:
+                added = wait_adds()
+                deleted = wait_deletes()
+                with self.cache.lock:
+                    for mac, ip_addr in adds:
+                        if added.get(ip_addr) in ("success", "unchanged"):
+                            self.devices.own(tbl, mac, ip_addr)
+                    for mac, ip_addr in deletes + kept:
+                        if deleted.get(ip_addr) != "failed":
+                            self.devices.disown(tbl, mac, ip_addr)
+                for ip_addr, ip_result in list(added.items()) + list(deleted.items()):
+                    ip_results["{table} {ip_addr}".format(table=tbl, ip_addr=ip_addr)] = ip_result
 
-        return {"result": "success"}
+        return {"result": summarize_results(ip_results) if ip_results else "unchanged",
+                "leases": len(touched), "ip_results": ip_results}
 
-    def del_ip_from_skipto_tbl(self, ip_addr, tbl):
+    def list_block_src_mac(self, tbl, mac=None):
         """
-        Del client IP from skipto table
+        List blocked MACs of table with leased addresses, or addresses leased to MAC
         """
-        cmd_res = "success"
-        idx = ip_addr.rsplit('.')[3]
-
-        target_table = "t{num}".format(num=idx.zfill(3))
-        rule_num = "04{num}".format(num=idx.zfill(3))
-        del_fwd_rule_cmd = "ipfw delete {rule_num}".format(rule_num=rule_num)
-        status = os.system(del_fwd_rule_cmd)
-        if status != 0:
-            cmd_res = "failed"
-        
-        del_t_tbl_cmd = "ipfw table {table} destroy".format(table=target_table)
-        status = os.system(del_t_tbl_cmd)
-        if status != 0:
-            cmd_res = "failed"
-        
-        del_ip_from_tbl_cmd = "ipfw table {table} del {ip_addr}".format(table=tbl, ip_addr=ip_addr)
-        status = os.system(del_ip_from_tbl_cmd)
-        if status != 0:
-            cmd_res = "failed"
-        
-        return {"result": cmd_res}
+        with self.cache.lock:
+            if mac:
+                return {"result": "success", "mac": mac, "blocked": mac in self.devices.blocked.get(tbl, {}),
+                        "ip_list": sorted(self.devices.leases.get(mac, ()))}
+            return {"result": "success",
+                    "macs": {mac: sorted(self.devices.leases.get(mac, ()))
+                             for mac in sorted(self.devices.blocked.get(tbl, {}))}}
 
-    def list_ip_from_skipto_tbl(self, tbl):
+    def release_common(self, tbl):
         """
-        List all IPs from skipto table
+        Drop table from owners of its targets before flush or destroy,
+        promoted targets left with too few owners demoted
         """
-        if g_dummy_test:
-            print("Reuqest to list IP from skipto table ", tbl)
-        else:
-            cmdline = "table {table} list".format(table=tbl)
-            ip_list = subprocess.Popen(['ipfw', cmdline], stdout=subprocess.PIPE)
-            jsonobj = {"result": "success", "ip_list": []}
-            for line in ip_list.stdout.readlines():
-                ip_addr_str = line.decode("utf-8")
-                jsonobj["ip_list"].append(ip_addr_str)
-            return jsonobj
+        if tbl is None or not self.shared(tbl):
+            return
+        owned = self.common.owned(tbl)
+        if owned:
+            self.share_ips_in_tbl(owned, tbl, "delete")
 
-    def add_ip_to_tbl(self, ip_addr, tbl):
+    def entry_callback(self, tbl, ip_addr, op):
         """
-        Add new IP address to the tbl indicated table
+        Build callback updating cache and inflight ops once kernel applied op
         """
-        command = "ipfw table {table} add {ip_addr}".format(table=tbl, ip_addr=ip_addr)
-        if g_dummy_test:
-            print("Request to add IP ", ip_addr, " to predefined table ", tbl, " command = ", command)
-        else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
+        def on_done(succeeded):
+            with self.inflight_lock:
+                if succeeded:
+                    if op == "add":
+                        self.cache.add(tbl, ip_addr)
+                    else:
+                        self.cache.delete(tbl, ip_addr)
+                pending_ops = self.inflight[(tbl, ip_addr)]
+                pending_ops.pop(0)
+                if not pending_ops:
+                    del self.inflight[(tbl, ip_addr)]
+        return on_done
 
-    def del_ip_from_tbl(self, ip_addr, tbl):
-        """
-        Del IP address from tbl indicated table
-        """
-        command = "ipfw table {table} delete {ip_addr}".format(table=tbl, ip_addr=ip_addr)
-        if g_dummy_test:
-            print("Request to delete IP ", ip_addr, " from predefined table ", tbl, " command = ", command)
-        else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
-    
     def list_ip_from_tbl(self, tbl):
         """
         List all IP address within tbl
         """
-        if g_dummy_test:
-            print("Reuqest to list IP from table ", tbl)
-        else:
-            cmdline = "table {table} list".format(table=tbl)
-            ip_list = subprocess.Popen(['ipfw', cmdline], stdout=subprocess.PIPE)
-            jsonobj = {"result": "success", "ip_list": []}
-            for line in ip_list.stdout.readlines():
-                ip_addr_str = line.decode("utf-8")
-                ip_addr_match = self.ip_addr_filter.match(ip_addr_str)
-                if ip_addr_match:
-                    if ip_addr_match.group(1):
-                        ip_addr = ip_addr_match.group(1)
-                        print("source of line data   ", ip_addr)
-                        jsonobj["ip_list"].append(ip_addr)
+        jsonobj = {"result": "success", "ip_list": []}
+        if self.shared(tbl):
+            # Promoted targets live in common table, list what table owns
+            jsonobj["ip_list"] = sorted(self.common.owned(tbl))
             return jsonobj
+        for ip_addr, value in self.cache.list(tbl):
+            jsonobj["ip_list"].append(ip_addr)
+        return jsonobj
 
     def flush_tbl(self, tbl):
         """
         Flush Table 
         """
-        command = "ipfw table {table} flush".format(table=tbl)
-        if g_dummy_test:
-            print("Request to flush table ", tbl)
+        command = "table {table} flush".format(table=tbl)
+        self.release_common(tbl)
+
+        def on_done(succeeded):
+            if succeeded:
+                with self.inflight_lock:
+                    self.cache.flush(tbl)
+                self.expiry.cancel_tbl(tbl)
+                self.common.clear(tbl)
+                self.domains.clear(tbl)
+                self.devices.clear(tbl)
+
+        # No aggregation of table between kernel flush and its learned state cleared
+        with self.aggregator.lock:
+            with self.write_lock:
+                request = self.batch.submit([command], [on_done], self.scheduler.priority(tbl))[0]
+            succeeded = request.wait()
+            if succeeded:
+                self.aggregator.clear(tbl)
+        if succeeded:
+            return {"result": "success"}
         else:
-            status = os.system(command)
-            if status == 0:
-                return {"result": "success"}
-            else:
-                return {"result": "failed"}
+            return {"result": "failed"}
 
-g_ipfw_intf = IPFWIntf()
+g_ipfw_batch = IPFWBatch()
+g_ipfw_cache = IPFWTableCache(g_ipfw_batch)
+g_ipfw_intf = IPFWIntf(g_ipfw_batch, g_ipfw_cache)
 
 parser = reqparse.RequestParser()
 parser.add_argument('ip_addr')
 parser.add_argument('mon_addr')
 parser.add_argument('psk')
+parser.add_argument('table')
+parser.add_argument('ip_addrs', action='append')
+parser.add_argument('reset', type=inputs.boolean, default=False)
+parser.add_argument('kernel', type=inputs.boolean, default=False)
+parser.add_argument('ttl', type=int)
+parser.add_argument('domain')
+parser.add_argument('mac')
+parser.add_argument('release', type=inputs.boolean, default=False)
+parser.add_argument('samples', type=int)
+parser.add_argument('top', type=int, default=10)
+parser.add_argument('layout')
+
+def request_args():
+    """
+    Parsed request arguments, parsed once per request
+    """
+    if "args" not in g:
+        g.args = parser.parse_args()
+    return g.args
+
+# PSKAuth preshared key authentication of write requests
+# either psk argument compared in constant time, or HMAC signed request
+# so psk never travels with the request
+#   X-UM-Timestamp  unix time of request, accepted within window
+#   X-UM-Nonce      unique per request, replay within window rejected
+#   X-UM-Signature  hex HMAC-SHA256 of "timestamp\nnonce\nMETHOD\npath\nbody" keyed by psk
+class PSKAuth:
+    def __init__(self, window=300, hmac_only=False):
+        """
+        PSK authentication initialization
+        """
+        self.window = window
+        self.hmac_only = hmac_only
+        self.nonces = set()
+        self.nonce_expiry = deque()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def sign(psk, timestamp, nonce, method, path, body):
+        """
+        Return hex signature of request
+        """
+        message = "{timestamp}\n{nonce}\n{method}\n{path}\n".format(timestamp=timestamp, nonce=nonce, method=method, path=path).encode("utf-8") + body
+        return hmac.new(psk.encode("utf-8"), message, hashlib.sha256).hexdigest()
+
+    def check(self, psk):
+        """
+        Authenticate current request against psk
+        """
+        signature = request.headers.get("X-UM-Signature")
+        if signature is None:
+            if self.hmac_only:
+                return False
+            session_psk = request_args()['psk']
+            return session_psk is not None and hmac.compare_digest(session_psk.encode("utf-8"), psk.encode("utf-8"))
+
+        timestamp = request.headers.get("X-UM-Timestamp", "")
+        nonce = request.headers.get("X-UM-Nonce", "")
+        try:
+            skew = abs(time.time() - float(timestamp))
+        except ValueError:
+            return False
+        if skew > self.window or not nonce:
+            return False
+        expected = self.sign(psk, timestamp, nonce, request.method, request.path, request.get_data(cache=True))
+        if not hmac.compare_digest(signature.encode("utf-8"), expected.encode("utf-8")):
+            return False
+
+        with self.lock:
+            # Nonce remembered as long as its timestamp can be accepted
+            now = time.monotonic()
+            while self.nonce_expiry and self.nonce_expiry[0][0] <= now:
+                self.nonces.discard(self.nonce_expiry.popleft()[1])
+            if nonce in self.nonces:
+                return False
+            self.nonces.add(nonce)
+            self.nonce_expiry.append((now + 2 * self.window, nonce))
+        return True
+
+g_psk_auth = PSKAuth()
+
+# Tables allowed to be updated through bulk requests
+g_bulk_tables = ["blocklist", "tblocklist", "fwdlist", "lockdownlist", "dmzallowlist"]
+# Source tables device can be blocked in by MAC
+g_mac_tables = ["blocklist", "lockdownlist"]
 
 class MainPage(Resource):
     def get(self):
         return {'DynamicFirewall': 'IPFW Dynamic Firewall'}
 
+class TableStats(Resource):
+    def get(self):
+        """
+        Table sizes and redundant add/delete counters
+        """
+        tbl_stats = g_ipfw_cache.stats()
+        for tbl, ttl_entries in g_ipfw_intf.expiry.stats().items():
+            tbl_stats.setdefault(tbl, {})["ttl_entries"] = ttl_entries
+        for tbl, aggregate_stats in g_ipfw_intf.aggregator.stats().items():
+            tbl_stats.setdefault(tbl, {}).update(aggregate_stats)
+        for tbl, domain_stats in g_ipfw_intf.domains.stats().items():
+            tbl_stats.setdefault(tbl, {}).update(domain_stats)
+        lease_stats, device_stats = g_ipfw_intf.devices.stats()
+        for tbl, block_stats in device_stats.items():
+            tbl_stats.setdefault(tbl, {}).update(block_stats)
+        for tbl, schedule_stats in g_ipfw_intf.scheduler.stats().items():
+            tbl_stats.setdefault(tbl, {}).update(schedule_stats)
+        for tbl, throttled in list(g_metrics.throttled.items()):
+            tbl_stats.setdefault(tbl, {})["throttled"] = throttled
+        tbl_stats.setdefault("strict_hosts_list", {}).update(g_ipfw_intf.strict_ids.stats())
+        if g_ipfw_intf.common.threshold:
+            common_stats = g_ipfw_intf.common.stats()
+            common_stats["kernel_entries"] = sum(stats["size"] for tbl, stats in tbl_stats.items()
+                                                 if g_ipfw_intf.common.enabled(tbl) or tbl == g_ipfw_intf.common.table)
+            tbl_stats.setdefault(g_ipfw_intf.common.table, {}).update(common_stats)
+        return {'table_stats': tbl_stats, 'lease_stats': lease_stats}
+
 class ListBlockSrcIP(Resource):
     def get(self):
         """
@@ -342,12 +3788,7 @@ class AddBlockSrcIP(Resource):
         """
         Post add block src IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_block_src_ip": "authentication failed"}
-
-        src_ip_addr = parser.parse_args()['ip_addr']
+        src_ip_addr = request_args()['ip_addr']
         if src_ip_addr:
             return g_ipfw_intf.block_src_ip(src_ip_addr)
         else:
@@ -360,12 +3801,7 @@ class DelBlockSrcIP(Resource):
         """
         Post del block src IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_block_src_ip": "authentication failed"}
-        
-        src_ip_addr = parser.parse_args()['ip_addr']
+        src_ip_addr = request_args()['ip_addr']
         if src_ip_addr:
             return g_ipfw_intf.unblock_src_ip(src_ip_addr)
         else:
@@ -373,29 +3809,71 @@ class DelBlockSrcIP(Resource):
 
 class AddBlockSrcMAC(Resource):
     def get(self):
-        return {'usage': "POST to add blocked src MAC addr"}
+        return {'usage': "POST to add blocked src MAC addr, table blocklist or lockdownlist"}
     def post(self):
         """
         Post add block src MAC
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_block_src_mac": "authentication failed"}
-        
+        args = request_args()
+        mac = g_ipfw_intf.devices.normalize(args['mac'])
+        tbl_name = args['table'] or "blocklist"
+        if tbl_name not in g_mac_tables:
+            return {"add_block_src_mac": "wrong table provided"}
+        if mac:
+            return g_ipfw_intf.block_src_mac(mac, tbl_name)
+        else:
+            return {"add_block_src_mac": "malformed request"}
 
 class DelBlockSrcMAC(Resource):
     def get(self):
-        return {'usage': "POST to del blocked src MAC addr"}
+        return {'usage': "POST to del blocked src MAC addr, table blocklist or lockdownlist"}
     def post(self):
         """
         Post del block src MAC
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_block_src_mac": "authentication failed"}
+        args = request_args()
+        mac = g_ipfw_intf.devices.normalize(args['mac'])
+        tbl_name = args['table'] or "blocklist"
+        if tbl_name not in g_mac_tables:
+            return {"del_block_src_mac": "wrong table provided"}
+        if mac:
+            return g_ipfw_intf.unblock_src_mac(mac, tbl_name)
+        else:
+            return {"del_block_src_mac": "malformed request"}
+
+class ListBlockSrcMAC(Resource):
+    def get(self):
+        """
+        List blocked MACs with their leased addresses, or addresses leased to mac
+        """
+        args = request_args()
+        tbl_name = args['table'] or "blocklist"
+        if tbl_name not in g_mac_tables:
+            return {"list_block_src_mac": "wrong table provided"}
+        mac = None
+        if args['mac']:
+            mac = g_ipfw_intf.devices.normalize(args['mac'])
+            if not mac:
+                return {"list_block_src_mac": "malformed request"}
+        return g_ipfw_intf.list_block_src_mac(tbl_name, mac)
 
+class UpdateLease(Resource):
+    """
+    DHCP server hook pushing lease of mac to ip_addr, release drops it
+    """
+    def get(self):
+        return {"usage": "POST mac and ip_addr on lease, with release true once lease ends"}
+    def post(self):
+        """
+        POST Update lease
+        """
+        args = request_args()
+        mac = g_ipfw_intf.devices.normalize(args['mac'])
+        ip_addr = normalize_ip_addr(args['ip_addr']) if args['ip_addr'] else None
+        if mac and ip_addr:
+            return g_ipfw_intf.apply_leases([(mac, ip_addr, not args['release'])])
+        else:
+            return {"update_lease": "malformed request"}
 
 class ListBlockTargetIP(Resource):
     def get(self):
@@ -413,12 +3891,7 @@ class AddBlockTargetIP(Resource):
         """
         Post add block target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_block_target_ip": "authentication failed"}
-            
-        tgt_ip_addr = parser.parse_args()['ip_addr']
+        tgt_ip_addr = request_args()['ip_addr']
         if tgt_ip_addr:
             return g_ipfw_intf.block_target_ip(tgt_ip_addr)
         else:
@@ -431,12 +3904,7 @@ class DelBlockTargetIP(Resource):
         """
         Post del block target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_block_target_ip": "authentication failed"}
-
-        tgt_ip_addr = parser.parse_args()['ip_addr']
+        tgt_ip_addr = request_args()['ip_addr']
         if tgt_ip_addr:
             return g_ipfw_intf.unblock_target_ip(tgt_ip_addr)
         else:
@@ -449,14 +3917,9 @@ class AddFwdTargetIp(Resource):
         """
         Post add forward target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_fwd_target_ip": "authentication failed"}
-
-        fwd_tgt_ip_addr = parser.parse_args()['ip_addr']
+        fwd_tgt_ip_addr = request_args()['ip_addr']
         if fwd_tgt_ip_addr:
-            return g_ipfw_intf.add_ip_to_tbl(fwd_tgt_ip_addr, "fwdlist")
+            return g_ipfw_intf.add_ip_to_tbl(fwd_tgt_ip_addr, "fwdlist", request_args()['ttl'])
         else:
             return {"add_fwd_target_ip": "malformed request"}
 
@@ -467,12 +3930,7 @@ class DelFwdTargetIp(Resource):
         """
         Post del forward target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_fwd_target_ip": "authentication failed"}
-
-        fwd_tgt_ip_addr = parser.parse_args()['ip_addr']
+        fwd_tgt_ip_addr = request_args()['ip_addr']
         if fwd_tgt_ip_addr:
             return g_ipfw_intf.del_ip_from_tbl(fwd_tgt_ip_addr, "fwdlist")
         else:
@@ -485,12 +3943,7 @@ class ClrFwdTargetIp(Resource):
         """
         Post clr forward target IPs within table fwdlist
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"clr_fwd_target_ip": "authentication failed"}
-
-        fwd_tgt_table = parser.parse_args()['table']
+        fwd_tgt_table = request_args()['table']
         if fwd_tgt_table:
             if fwd_tgt_table == "fwdlist":
                 return g_ipfw_intf.flush_tbl(fwd_tgt_table)
@@ -511,12 +3964,7 @@ class AddLockDownIP(Resource):
         """
         POST add lockdown device IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_lockdown_dev_ip": "authentication failed"}
-
-        lockdown_dev_ip_addr = parser.parse_args()['ip_addr']
+        lockdown_dev_ip_addr = request_args()['ip_addr']
         if lockdown_dev_ip_addr:
             return g_ipfw_intf.add_ip_to_tbl(lockdown_dev_ip_addr, "lockdownlist")
         else:
@@ -529,12 +3977,7 @@ class DelLockDownIP(Resource):
         """
         POST delete lockdown device IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_lockdown_dev_ip": "authentication failed"}
-
-        lockdown_dev_ip_addr = parser.parse_args()['ip_addr']
+        lockdown_dev_ip_addr = request_args()['ip_addr']
         if lockdown_dev_ip_addr:
             return g_ipfw_intf.del_ip_from_tbl(lockdown_dev_ip_addr, "lockdownlist")
         else:
@@ -552,14 +3995,9 @@ class DMZAllowTargetIP(Resource):
         """
         Post add DMZ target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_dmz_target_ip": "authentication failed"}
-
-        dmz_tgt_ip_addr = parser.parse_args()['ip_addr']
+        dmz_tgt_ip_addr = request_args()['ip_addr']
         if dmz_tgt_ip_addr:
-            return g_ipfw_intf.add_ip_to_tbl(dmz_tgt_ip_addr, "dmzallowlist")
+            return g_ipfw_intf.add_ip_to_tbl(dmz_tgt_ip_addr, "dmzallowlist", request_args()['ttl'])
         else:
             return {"add_dmz_target_ip": "malformed request"}
 
@@ -573,12 +4011,7 @@ class DMZBlockTargetIP(Resource):
         """
         Post remove DMZ target IP
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_dmz_target_ip": "authentication failed"}
-
-        dmz_tgt_ip_addr = parser.parse_args()['ip_addr']
+        dmz_tgt_ip_addr = request_args()['ip_addr']
         if dmz_tgt_ip_addr:
             return g_ipfw_intf.del_ip_from_tbl(dmz_tgt_ip_addr, "dmzallowlist")
         else:
@@ -593,12 +4026,15 @@ class DMZListTargetIP(Resource):
         return {'list_dmz_allow_target_ip': result_obj}
         
 api.add_resource(MainPage, '/')
+api.add_resource(TableStats, '/table_stats')
 # Inernal network connected device block control
 api.add_resource(ListBlockSrcIP, '/list_block_src_ip')
 api.add_resource(AddBlockSrcIP, '/add_block_src_ip')
 api.add_resource(DelBlockSrcIP, '/del_block_src_ip')
 api.add_resource(AddBlockSrcMAC, '/add_block_src_mac')
 api.add_resource(DelBlockSrcMAC, '/del_block_src_mac')
+api.add_resource(ListBlockSrcMAC, '/list_block_src_mac')
+api.add_resource(UpdateLease, '/update_lease')
 # Block target IP for access controlling
 api.add_resource(ListBlockTargetIP, '/list_block_target_ip')
 api.add_resource(AddBlockTargetIP, '/add_block_target_ip')
@@ -629,19 +4065,15 @@ class AddStrictMonClient(Resource):
     DMZ/Main Router strict access control mode Add device
     """
     def get(self):
-        return {'usage': "POST to Add host to strict_hosts_list table"}
+        return {'usage': "POST to Add host to strict_hosts_list table, reset to recreate its target table and rules"}
     def post(self):
         """
         Post Add new device to strict_hosts_list
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_strict_mon_host": "authentication failed"}
-
-        strict_mon_ip_addr = parser.parse_args()['ip_addr']
+        strict_mon_ip_addr = request_args()['ip_addr']
         if strict_mon_ip_addr:
-            return g_ipfw_intf.add_ip_to_skipto_tbl(strict_mon_ip_addr, "strict_hosts_list")
+            reset = request_args()['reset']
+            return g_ipfw_intf.add_ip_to_skipto_tbl(strict_mon_ip_addr, "strict_hosts_list", reset)
         else:
             return {"add_strict_mon_host": "malformed request"}
 
@@ -655,12 +4087,7 @@ class DelStrictMonClient(Resource):
         """
         Post Del device from strict_hosts_list
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_strict_mon_host": "authentication failed"}
-
-        strict_mon_ip_addr = parser.parse_args()['ip_addr']
+        strict_mon_ip_addr = request_args()['ip_addr']
         if strict_mon_ip_addr:
             return g_ipfw_intf.del_ip_from_skipto_tbl(strict_mon_ip_addr, "strict_hosts_list")
         else:
@@ -673,6 +4100,98 @@ class ListStrictMonClient(Resource):
     def get(self):
         return g_ipfw_intf.list_ip_from_skipto_tbl("strict_hosts_list")
 
+class StreamTable(Resource):
+    """
+    Stream table entries as chunked JSON, with value and address family
+    """
+    def get(self):
+        """
+        GET table or mon_addr, kernel to read ipfw instead of cached copy
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+        if not tbl_name:
+            return {"stream_table": "malformed request"}
+
+        if args['kernel']:
+            entries = ((ip_addr, value, family) for tbl, ip_addr, value, family in g_ipfw_cache.stream_kernel(tbl_name) if ip_addr)
+        else:
+            entries = g_ipfw_cache.stream(tbl_name)
+
+        def generate():
+            yield '{{"result": "success", "table": {table}, "entries": ['.format(table=json.dumps(tbl_name))
+            # One HTTP chunk per group of entries, not per entry
+            chunk = []
+            sep = ""
+            for ip_addr, value, family in entries:
+                chunk.append('{{"ip_addr": "{ip_addr}", "value": {value}, "family": "{family}"}}'.format(ip_addr=ip_addr, value=json.dumps(value), family=family))
+                if len(chunk) == 512:
+                    yield sep + ", ".join(chunk)
+                    chunk = []
+                    sep = ", "
+            if chunk:
+                yield sep + ", ".join(chunk)
+            yield ']}'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+api.add_resource(StreamTable, '/stream_table')
+
+class MetricsPage(Resource):
+    """
+    Prometheus text format metrics
+    """
+    def get(self):
+        """
+        GET request counters/latency, ipfw process/batch and table gauges
+        """
+        gauges = {
+            "um_firewall_table_entries": [('{{table="{table}"}}'.format(table=tbl), stats["size"])
+                                          for tbl, stats in sorted(g_ipfw_cache.stats().items())],
+            "um_firewall_ipfw_queue_depth": [('{{priority="{priority}"}}'.format(priority=priority), g_ipfw_batch.queued(priority))
+                                             for priority in g_ipfw_batch.priorities],
+            "um_firewall_ipfw_inflight_entries": [("", len(g_ipfw_intf.inflight))],
+            "um_firewall_ttl_entries": [("", sum(g_ipfw_intf.expiry.stats().values()))],
+            "um_firewall_counter_samples": [("", len(g_ipfw_intf.counters.samples))]
+        }
+        return Response(g_metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+api.add_resource(MetricsPage, '/metrics')
+
+class RuleCounters(Resource):
+    """
+    Per interval packet/byte deltas of rules with hits, last samples or whole history
+    rule texts sent again only when layout differs from given one
+    """
+    def get(self):
+        args = request_args()
+        return g_ipfw_intf.counters.rule_counters(args['samples'], args['layout'])
+
+class TableCounters(Resource):
+    """
+    Per interval hits of tables and strict hosts
+    """
+    def get(self):
+        return g_ipfw_intf.counters.table_counters(request_args()['samples'])
+
+class HotRules(Resource):
+    """
+    Top rules by packets and rules without hits within last samples
+    """
+    def get(self):
+        args = request_args()
+        if args['top'] < 0:
+            return {"hot_rules": "malformed request"}
+        return g_ipfw_intf.counters.hot_rules(args['samples'], args['top'])
+
+# Rule counters sampled every counter_interval seconds
+api.add_resource(RuleCounters, '/rule_counters')
+api.add_resource(TableCounters, '/table_counters')
+api.add_resource(HotRules, '/hot_rules')
+
 api.add_resource(AddStrictMonClient, '/add_strict_mon_host')
 api.add_resource(DelStrictMonClient, '/del_strict_mon_host')
 api.add_resource(ListStrictMonClient, '/list_strict_mon_host')
@@ -687,18 +4206,12 @@ class AddTargetForMonClient(Resource):
         """
         POST Add target IP to mon host access table
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"add_target_for_strict_host": "authentication failed"}
-
-        strict_mon_ip_addr = parser.parse_args()["mon_addr"]
-        target_ip_addr = parser.parse_args()['ip_addr']
-        if strict_mon_ip_addr and target_ip_addr:
-            print("add target ", strict_mon_ip_addr, " target_ip ", target_ip_addr)
-            idx = strict_mon_ip_addr.rsplit('.')[3]
-            tbl_name = "t{num}".format(num=idx.zfill(3))
-            return g_ipfw_intf.add_ip_to_tbl(target_ip_addr, tbl_name)
+        strict_mon_ip_addr = request_args()["mon_addr"]
+        target_ip_addr = request_args()['ip_addr']
+        tbl_name = g_ipfw_intf.strict_host_table(strict_mon_ip_addr) if strict_mon_ip_addr else None
+        if tbl_name and target_ip_addr:
+            g_logger.debug("add target for strict host", extra=log_extra(mon_addr=strict_mon_ip_addr, ip_addr=target_ip_addr))
+            return g_ipfw_intf.add_ip_to_tbl(target_ip_addr, tbl_name, request_args()['ttl'])
         else:
             return {"add_target_for_strict_host": "malformed request"}
 
@@ -712,16 +4225,10 @@ class DelTargetForMonClient(Resource):
         """
         POST Del target IP from mon host access table
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"del_target_for_strict_host": "authentication failed"}
-
-        strict_mon_ip_addr = parser.parse_args()["mon_addr"]
-        target_ip_addr = parser.parse_args()["ip_addr"]
-        if strict_mon_ip_addr and target_ip_addr:
-            idx = strict_mon_ip_addr.rsplit('.')[3]
-            tbl_name = "t{num}".format(num=idx.zfill(3))
+        strict_mon_ip_addr = request_args()["mon_addr"]
+        target_ip_addr = request_args()["ip_addr"]
+        tbl_name = g_ipfw_intf.strict_host_table(strict_mon_ip_addr) if strict_mon_ip_addr else None
+        if tbl_name and target_ip_addr:
             return g_ipfw_intf.del_ip_from_tbl(target_ip_addr, tbl_name)
         else:
             return {"del_target_for_strict_host": "malformed request"}
@@ -731,10 +4238,9 @@ class ListTargetForMonClient(Resource):
     DMZ/Main Router list access target ip from strict mon host
     """
     def get(self):
-        mon_addr = parser.parse_args()["mon_addr"]
-        if mon_addr:
-            idx = mon_addr.rsplit('.')[3]
-            tbl_name = "t{num}".format(num=idx.zfill(3))
+        mon_addr = request_args()["mon_addr"]
+        tbl_name = g_ipfw_intf.strict_host_table(mon_addr) if mon_addr else None
+        if tbl_name:
             return g_ipfw_intf.list_ip_from_tbl(tbl_name)
         else:
             return {"list_target_for_strict_host": "malformed request"}
@@ -749,27 +4255,342 @@ class CleanTargetForMonClient(Resource):
         """
         POST Clean all IP from mon target table
         """
-        if g_psk:
-            session_psk = parser.parse_args()['psk']
-            if session_psk != g_psk:
-                return {"clean_target_for_strict_host": "authentication failed"}
-
-        mon_addr = parser.parse_args()["mon_addr"]
-        if mon_addr:
-            idx = mon_addr.rsplit('.')[3]
-            tbl_name = "t{num}".format(num=idx.zfill(3))
+        mon_addr = request_args()["mon_addr"]
+        tbl_name = g_ipfw_intf.strict_host_table(mon_addr) if mon_addr else None
+        if tbl_name:
             return g_ipfw_intf.flush_tbl(tbl_name)
         else:
             return {"clean_taget_for_strict_host": "malformed request"}
 
 
+class AddBulkIP(Resource):
+    """
+    Add JSON array of IP addresses/CIDRs to table or strict mon host table
+    """
+    def get(self):
+        return {"usage": "POST ip_addrs array with table or mon_addr to add IP addrs in one request"}
+    def post(self):
+        """
+        POST Add IP addresses in bulk
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        ip_addrs = args['ip_addrs']
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"add_bulk_ip": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"add_bulk_ip": "wrong table provided"}
+
+        if ip_addrs:
+            return g_ipfw_intf.add_ips_to_tbl(ip_addrs, tbl_name, args['ttl'])
+        else:
+            return {"add_bulk_ip": "malformed request"}
+
+class SyncTable(Resource):
+    """
+    Replace content of table or strict mon host table with JSON array of IP addresses/CIDRs
+    """
+    def get(self):
+        return {"usage": "PUT full ip_addrs array with table or mon_addr, only the difference applied"}
+    def put(self):
+        """
+        PUT Desired IP addresses of table
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        ip_addrs = args['ip_addrs']
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"sync_table": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"sync_table": "wrong table provided"}
+
+        # Empty array is a valid desired state, missing array is not
+        if ip_addrs is None and "ip_addrs" not in (request.get_json(silent=True) or {}):
+            return {"sync_table": "malformed request"}
+        return g_ipfw_intf.sync_ips_in_tbl(ip_addrs or [], tbl_name, args['ttl'], args['kernel'])
+
+class DelBulkIP(Resource):
+    """
+    Del JSON array of IP addresses/CIDRs from table or strict mon host table
+    """
+    def get(self):
+        return {"usage": "POST ip_addrs array with table or mon_addr to del IP addrs in one request"}
+    def post(self):
+        """
+        POST Del IP addresses in bulk
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        ip_addrs = args['ip_addrs']
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"del_bulk_ip": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"del_bulk_ip": "wrong table provided"}
+
+        if ip_addrs:
+            return g_ipfw_intf.del_ips_from_tbl(ip_addrs, tbl_name)
+        else:
+            return {"del_bulk_ip": "malformed request"}
+
 # Add allowed target IP for strict controlled client within internal network
 api.add_resource(AddTargetForMonClient, '/add_target_for_strict_host')
 api.add_resource(DelTargetForMonClient, '/del_target_for_strict_host')
 api.add_resource(ListTargetForMonClient, '/list_target_for_strict_host') 
 api.add_resource(CleanTargetForMonClient, '/clean_target_for_strict_host')
+# Bulk update of table or strict mon host table, one request per DNS answer
+api.add_resource(AddBulkIP, '/add_bulk_ip')
+api.add_resource(DelBulkIP, '/del_bulk_ip')
+api.add_resource(SyncTable, '/sync_table')
+
+class AddDomainIP(Resource):
+    """
+    Add IP addresses resolved from domain to table or strict mon host table
+    """
+    def get(self):
+        return {"usage": "POST domain and ip_addrs array with table or mon_addr, reset drops addresses not given"}
+    def post(self):
+        """
+        POST Add IP addresses owned by domain
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        domain = g_ipfw_intf.domains.normalize(args['domain'])
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"add_domain_ip": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"add_domain_ip": "wrong table provided"}
+
+        if domain and args['ip_addrs']:
+            return g_ipfw_intf.add_domain_ips(domain, args['ip_addrs'], tbl_name, args['ttl'], args['reset'])
+        else:
+            return {"add_domain_ip": "malformed request"}
+
+class RevokeDomain(Resource):
+    """
+    Revoke domain from table or strict mon host table, addresses no other domain owns deleted
+    """
+    def get(self):
+        return {"usage": "POST domain with table or mon_addr to revoke domain"}
+    def post(self):
+        """
+        POST Revoke domain
+        """
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        domain = g_ipfw_intf.domains.normalize(args['domain'])
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"revoke_domain": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"revoke_domain": "wrong table provided"}
+
+        if domain:
+            return g_ipfw_intf.revoke_domain(domain, tbl_name)
+        else:
+            return {"revoke_domain": "malformed request"}
+
+class ListDomainIP(Resource):
+    """
+    List IP addresses of domain, domains owning ip_addr, or all domains of table
+    """
+    def get(self):
+        args = request_args()
+        tbl_name = args['table']
+        mon_addr = args['mon_addr']
+        domain = None
+        if args['domain']:
+            domain = g_ipfw_intf.domains.normalize(args['domain'])
+            if not domain:
+                return {"list_domain_ip": "malformed request"}
+        if mon_addr and not tbl_name:
+            tbl_name = g_ipfw_intf.strict_host_table(mon_addr)
+            if not tbl_name:
+                return {"list_domain_ip": "malformed request"}
+        elif tbl_name not in g_bulk_tables:
+            return {"list_domain_ip": "wrong table provided"}
+
+        return g_ipfw_intf.list_domain_ips(tbl_name, domain, args['ip_addr'])
+
+# Targets learned from DNS answers, owned by domain
+api.add_resource(AddDomainIP, '/add_domain_ip')
+api.add_resource(RevokeDomain, '/revoke_domain')
+api.add_resource(ListDomainIP, '/list_domain_ip')
+
+def make_ssl_context(tls_cert=None, tls_key=None):
+    """
+    Build server TLS context from configured certificate and key
+    Same context lives for whole process, its session cache and session
+    tickets let clients resume instead of full handshake
+    Without certificate fallback to adhoc certificate generated per start
+    """
+    if not tls_cert:
+        return generate_adhoc_ssl_context()
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(tls_cert, tls_key)
+    context.options &= ~ssl.OP_NO_TICKET
+    return context
+
+# KeepAliveRequestHandler speak HTTP/1.1, client reuse one connection
+# for many requests, streamed responses sent chunked
+#
+# Worker serves requests already received, connection going idle is
+# handed back to server with parked set instead of waiting on worker,
+# werkzeug 2.1+ answers with "Connection: close", then only new
+# connections get parked
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"
+    parked = False
+
+    def handle_one_request(self):
+        """
+        Serve one request, park connection once no further request buffered
+        """
+        super().handle_one_request()
+        if not self.close_connection and not self.buffered():
+            self.parked = True
+            self.close_connection = True
+
+    def buffered(self):
+        """
+        Check next request already received, without waiting for it
+        """
+        if isinstance(self.connection, ssl.SSLSocket) and self.connection.pending():
+            return True
+        timeout = self.connection.gettimeout()
+        self.connection.settimeout(0)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            self.connection.settimeout(timeout)
+
+# PooledWSGIServer accept requests concurrently with fixed worker pool
+# reads served from table cache in parallel, mutations serialized by
+# IPFWIntf through the IPFWBatch worker
+#
+# Connections without pending request parked on selector thread, not on
+# workers, so idle or silent peers never hold back API calls
+#   new connection      parked until first bytes, up to handshake_timeout
+#   idle keep-alive     parked until next request, up to keepalive_timeout
+#   on worker           TLS handshake and request read each bounded by
+#                       handshake_timeout
+class PooledWSGIServer(BaseWSGIServer):
+    def __init__(self, host, port, app, workers=8, ssl_context=None, keepalive_timeout=30, handshake_timeout=2):
+        """
+        Pooled WSGI server initialization
+        """
+        super().__init__(host, port, app, handler=KeepAliveRequestHandler)
+        self.ssl_context = ssl_context
+        self.keepalive_timeout = keepalive_timeout
+        self.handshake_timeout = handshake_timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.selector = selectors.DefaultSelector()
+        # Parked connections handed to selector thread through queue
+        self.parking = deque()
+        self.parking_lock = threading.Lock()
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.parker = threading.Thread(target=self.run_parker, daemon=True)
+        self.parker.start()
+
+    def process_request(self, request, client_address):
+        """
+        Park accepted connection until its first bytes arrive
+        """
+        # Headers and body written separately, don't wait for delayed ACK
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.park(request, client_address, self.handshake_timeout)
+
+    def park(self, request, client_address, timeout):
+        """
+        Hand connection to selector thread, closed if not readable within timeout
+        """
+        with self.parking_lock:
+            self.parking.append((request, client_address, time.monotonic() + timeout))
+        try:
+            self.wakeup_send.send(b"\0")
+        except BlockingIOError:
+            pass
+
+    def run_parker(self):
+        """
+        Selector thread, readable connection goes to worker pool, expired one closed
+        """
+        deadlines = {}
+        while True:
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadline for client_address, deadline in deadlines.values()) - time.monotonic())
+            for key, events in self.selector.select(timeout):
+                if key.fileobj is self.wakeup_recv:
+                    try:
+                        while self.wakeup_recv.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                client_address, deadline = deadlines.pop(key.fileobj)
+                self.pool.submit(self.process_request_worker, key.fileobj, client_address)
+
+            with self.parking_lock:
+                parking = list(self.parking)
+                self.parking.clear()
+            for request, client_address, deadline in parking:
+                try:
+                    self.selector.register(request, selectors.EVENT_READ)
+                except (OSError, ValueError):
+                    self.shutdown_request(request)
+                    continue
+                deadlines[request] = (client_address, deadline)
+
+            now = time.monotonic()
+            for request, (client_address, deadline) in list(deadlines.items()):
+                if deadline <= now:
+                    self.selector.unregister(request)
+                    del deadlines[request]
+                    self.shutdown_request(request)
+
+    def process_request_worker(self, request, client_address):
+        """
+        Serve requests received on connection, park it again once idle
+        """
+        parked = False
+        try:
+            request.settimeout(self.handshake_timeout)
+            if self.ssl_context and not isinstance(request, ssl.SSLSocket):
+                request = self.ssl_context.wrap_socket(request, server_side=True)
+            handler = self.RequestHandlerClass(request, client_address, self)
+            if handler.parked:
+                self.park(request, client_address, self.keepalive_timeout)
+                parked = True
+        except (OSError, ssl.SSLError):
+            pass
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if not parked:
+                self.shutdown_request(request)
 
 if __name__ == '__main__':
+    setup_logging()
     um_firewall_config = "/etc/um_firewall.conf"
 
     if sys.argv[1]:
@@ -779,9 +4600,11 @@ if __name__ == '__main__':
         config_file = open(um_firewall_config, 'r')
         config = json.load(config_file)
     except BaseException as e:
-        print("Loading configuration file ", um_firewall_config, " failed with exception ", e)
+        g_logger.error("load configuration failed", extra=log_extra(path=um_firewall_config, error=str(e)))
         sys.exit()
 
+    setup_logging(config.get("log_level", "INFO"), config.get("log_syslog"), config.get("log_rate_limit", 20))
+
     um_firewall_host = "127.0.0.1"
     if "host" in config:
         um_firewall_host = config["host"]
@@ -793,4 +4616,117 @@ if __name__ == '__main__':
     if "psk" in config:
         g_psk = config["psk"]
 
-    app.run(ssl_context='adhoc', host=um_firewall_host, port=um_firewall_port)
+    if "hmac_window" in config:
+        g_psk_auth.window = config["hmac_window"]
+
+    if "hmac_only" in config:
+        g_psk_auth.hmac_only = config["hmac_only"]
+
+    ipfw_path = "ipfw"
+    if "ipfw_path" in config:
+        ipfw_path = config["ipfw_path"]
+
+    # Dummy test runs on simulated ipfw
+    um_firewall_backend = "batch"
+    if "backend" in config:
+        um_firewall_backend = config["backend"]
+    if g_dummy_test:
+        um_firewall_backend = "sim"
+    g_ipfw_batch.backend = make_backend(um_firewall_backend, ipfw_path)
+
+    if "batch_window" in config:
+        g_ipfw_batch.window = config["batch_window"]
+
+    reconcile_interval = 300
+    if "reconcile_interval" in config:
+        reconcile_interval = config["reconcile_interval"]
+
+    if config.get("aggregate_tables"):
+        g_ipfw_intf.aggregator.tbl_prefixlen = config["aggregate_tables"]
+
+    if "aggregate_strict_hosts" in config:
+        g_ipfw_intf.aggregator.strict_prefixlen = config["aggregate_strict_hosts"]
+
+    if "aggregate_prefix6" in config:
+        g_ipfw_intf.aggregator.prefixlen6 = config["aggregate_prefix6"]
+
+    if "strict_rule_base" in config or "strict_pool_size" in config:
+        try:
+            g_ipfw_intf.strict_ids.configure(config.get("strict_rule_base", 4000), config.get("strict_pool_size", 999))
+        except ValueError as e:
+            g_logger.error("strict host pool configuration failed", extra=log_extra(error=str(e)))
+            sys.exit()
+
+    if "strict_common_threshold" in config:
+        g_ipfw_intf.common.threshold = config["strict_common_threshold"]
+
+    if "prioritize" in config:
+        g_ipfw_intf.scheduler.enabled = config["prioritize"]
+
+    if "critical_tables" in config:
+        g_ipfw_intf.scheduler.critical_tables = set(config["critical_tables"])
+
+    if "bulk_rate" in config:
+        g_ipfw_intf.scheduler.bulk_rate = config["bulk_rate"]
+
+    if "bulk_burst" in config:
+        g_ipfw_intf.scheduler.bulk_burst = config["bulk_burst"]
+
+    if "max_bulk_queue" in config:
+        g_ipfw_intf.scheduler.max_queue = config["max_bulk_queue"]
+
+    g_ipfw_cache.start(reconcile_interval)
+
+    counter_interval = 10
+    if "counter_interval" in config:
+        counter_interval = config["counter_interval"]
+    if "counter_history" in config:
+        g_ipfw_intf.counters.samples = deque(maxlen=config["counter_history"])
+    g_ipfw_intf.counters.start(counter_interval)
+
+    if config.get("journal_path"):
+        journal = IPFWJournal(config["journal_path"], config.get("journal_compact_records", 100000),
+                              config.get("journal_sync", False))
+        try:
+            g_ipfw_intf.start_journal(journal)
+        except OSError as e:
+            g_logger.error("start journal failed", extra=log_extra(path=config["journal_path"], error=str(e)))
+            sys.exit()
+
+    if config.get("lease_file"):
+        lease_feed = IPFWLeaseFeed(config["lease_file"], g_ipfw_intf.apply_leases,
+                                   config.get("lease_format", "isc"), config.get("lease_poll", 2))
+        # Leases restored from journal, ones gone from lease file meanwhile released on first poll
+        with g_ipfw_cache.lock:
+            lease_feed.applied = dict(g_ipfw_intf.devices.owners)
+        lease_feed.start()
+
+    um_firewall_server = "pool"
+    if "server" in config:
+        um_firewall_server = config["server"]
+
+    um_firewall_workers = 8
+    if "workers" in config:
+        um_firewall_workers = config["workers"]
+
+    um_firewall_keepalive = 30
+    if "keepalive_timeout" in config:
+        um_firewall_keepalive = config["keepalive_timeout"]
+
+    um_firewall_handshake = 2
+    if "handshake_timeout" in config:
+        um_firewall_handshake = config["handshake_timeout"]
+
+    try:
+        ssl_context = make_ssl_context(config.get("tls_cert"), config.get("tls_key"))
+    except (OSError, ssl.SSLError) as e:
+        g_logger.error("load TLS certificate failed", extra=log_extra(error=str(e)))
+        sys.exit()
+
+    if um_firewall_server == "dev":
+        app.run(ssl_context=ssl_context, host=um_firewall_host, port=um_firewall_port)
+    else:
+        server = PooledWSGIServer(um_firewall_host, um_firewall_port, app, um_firewall_workers,
+                                  ssl_context=ssl_context, keepalive_timeout=um_firewall_keepalive,
+                                  handshake_timeout=um_firewall_handshake)
+        server.serve_forever()